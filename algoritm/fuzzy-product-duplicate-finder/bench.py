@@ -0,0 +1,251 @@
+"""
+bench.py — бенчмарк конвейера поиска дубликатов на синтетических данных.
+
+Для каждого уровня (1k/10k/100k/1m строк каталога) генерирует воспроизводимый
+набор через rand.generate и в отдельном процессе замеряет стадии exam.py:
+загрузку, нормализацию, построение TF-IDF, поиск кандидатов и точную оценку.
+Для каждой стадии пишется время и пиковый RSS процесса, итог — JSON отчёт.
+Отдельно замеряется время `import exam` в чистом процессе: тяжёлые
+библиотеки (sklearn, scipy, rapidfuzz) должны импортироваться лениво.
+Для TF-IDF в TFIDF_DTYPE проверяется, что top-k кандидатов совпадает
+с расчётом во float64 (доля найденных float64 кандидатов, topk_recall).
+
+Запуск:
+    python bench.py --tiers 1k 10k --out bench_report.json
+    python bench.py --tiers 10k --baseline bench_report.json   # проверка регрессий
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+
+# Уровни: имя -> (строк каталога, новых товаров)
+TIERS = {
+    "1k": (1_000, 100),
+    "10k": (10_000, 1_000),
+    "100k": (100_000, 5_000),
+    "1m": (1_000_000, 10_000),
+}
+DEFAULT_TIERS = ["1k", "10k", "100k"]
+SEED = 12345
+REGRESSION_TOLERANCE = 0.25   # допустимое замедление стадии относительно базового отчёта
+MIN_STAGE_SEC = 0.05          # стадии быстрее этого не проверяются на регрессию (шум)
+
+IMPORT_REPEATS = 3            # запусков для замера времени импорта (берётся минимум)
+MIN_TOPK_RECALL = 0.99        # минимальная доля float64 top-k кандидатов, найденных в TFIDF_DTYPE
+
+HERE = Path(__file__).resolve().parent
+
+
+class StageTimer:
+    """Собирает время и пиковый RSS (peak_rss_mb, обычно exam.peak_rss_mb) по стадиям."""
+
+    def __init__(self, peak_rss_mb):
+        self.stages = {}
+        self.peak_rss_mb = peak_rss_mb
+
+    def run(self, name, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.stages[name] = {
+            "sec": round(time.perf_counter() - t0, 4),
+            "peak_rss_mb": self.peak_rss_mb(),
+        }
+        print(f"[INFO]   {name}: {self.stages[name]['sec']}s, peak RSS {self.stages[name]['peak_rss_mb']} MB")
+        return result
+
+
+def measure_import_sec(repeats=IMPORT_REPEATS):
+    """
+    Время `import exam` в новом интерпретаторе (минимум из repeats запусков).
+
+    Returns:
+        Словарь {"sec", "modules"}: время и какие из тяжёлых библиотек оказались загружены
+    """
+    code = ("import sys, time; t = time.perf_counter(); import exam; sec = time.perf_counter() - t; "
+            "import json; print(json.dumps({'sec': round(sec, 4), 'modules': "
+            "sorted(m for m in ('sklearn', 'scipy', 'rapidfuzz') if m in sys.modules)}))")
+    runs = [json.loads(subprocess.run([sys.executable, "-c", code], cwd=str(HERE), stdout=subprocess.PIPE,
+                                      text=True, check=True).stdout.splitlines()[-1])
+            for _ in range(repeats)]
+    best = min(runs, key=lambda r: r["sec"])
+    print(f"[INFO] import exam: {best['sec']}s, heavy modules loaded: {best['modules'] or 'none'}")
+    return best
+
+def topk_agreement(candidates, reference):
+    """
+    Сравнивает списки кандидатов с эталонными (например, float32 против float64).
+
+    Args:
+        candidates: Списки (индекс_в_каталоге, оценка) для каждого нового товара
+        reference: Эталонные списки в том же формате
+
+    Returns:
+        Словарь {"topk_recall": доля эталонных кандидатов, найденных в candidates,
+                 "same_topk": доля товаров с совпадающим множеством кандидатов}
+    """
+    found = total = same = 0
+    for cur, ref in zip(candidates, reference):
+        cur_set = {idx for idx, _ in cur}
+        ref_set = {idx for idx, _ in ref}
+        found += len(cur_set & ref_set)
+        total += len(ref_set)
+        same += cur_set == ref_set
+    return {"topk_recall": round(found / total, 6) if total else 1.0,
+            "same_topk": round(same / len(reference), 6) if reference else 1.0}
+
+def run_tier(catalog_path, new_path):
+    """
+    Замеряет стадии exam.py на готовых файлах (вызывается в отдельном процессе).
+
+    Returns:
+        Словарь {"stages": {стадия: {"sec", "peak_rss_mb"}},
+                 "precision": сравнение top-k с float64 или None}
+    """
+    sys.path.insert(0, str(HERE))
+    import exam
+
+    timer = StageTimer(exam.peak_rss_mb)
+    # ленивый импорт sklearn/rapidfuzz — отдельной стадией, чтобы не смешивать его с build_tfidf_index
+    timer.run("import_libs", lambda: (exam.tfidf_available(), exam.rapidfuzz_available()))
+    cat_ids, cat_titles = timer.run("load_tab_file", lambda: exam.load_tab_file(catalog_path))
+    new_ids, new_titles = exam.load_tab_file(new_path)
+
+    def normalize():
+        exam.normalize_text_cached.cache_clear()
+        cat_norm = exam.safe_fill_empty([exam.normalize_text_cached(t) for t in cat_titles], cat_titles)
+        new_norm = exam.safe_fill_empty([exam.normalize_text_cached(t) for t in new_titles], new_titles)
+        return cat_norm, new_norm
+
+    cat_norm, new_norm = timer.run("normalize", normalize)
+    _, cat_tfidf, new_tfidf = timer.run("build_tfidf_index", exam.build_tfidf_index, cat_norm, new_norm)
+    precision = None
+    if cat_tfidf is not None:
+        candidates = timer.run("candidate_search", exam.batch_candidate_search_tfidf,
+                               new_tfidf, cat_tfidf, exam.TOP_K_CANDIDATES)
+        # вне замеров: тот же поиск во float64 как эталон точности
+        _, cat64, new64 = exam.build_tfidf_index(cat_norm, new_norm, dtype="float64")
+        reference = exam.batch_candidate_search_tfidf(new64, cat64, exam.TOP_K_CANDIDATES)
+        precision = dict(topk_agreement(candidates, reference), dtype=str(cat_tfidf.dtype))
+        print(f"[INFO] {precision['dtype']} top-k recall vs float64: {precision['topk_recall']}")
+    else:
+        token_index = exam.TokenInvertedIndex([set(s.split()) for s in cat_norm])
+        candidates = timer.run("candidate_search", lambda: [
+            token_index.search(set(s.split()), exam.TOP_K_CANDIDATES) for s in new_norm])
+
+    def scoring():
+        cat_tokens = exam.TokenizedTitles(cat_norm)
+        new_tokens = cat_tokens.encode(new_norm)
+        cands = exam.prune_candidates(candidates, new_tokens, cat_tokens) if exam.PRUNE_CANDIDATES else candidates
+        return exam.score_items(0, cands, cat_ids, cat_titles, cat_norm, new_titles, new_norm,
+                                cat_sets=cat_tokens.sets, new_sets=new_tokens.sets)
+
+    timer.run("scoring", scoring)
+    return {"stages": timer.stages, "precision": precision}
+
+
+def bench_tier(name, seed=SEED, workdir=None):
+    """
+    Генерирует набор уровня name и запускает run_tier в дочернем процессе,
+    чтобы пиковый RSS относился только к этому уровню.
+
+    Returns:
+        Словарь с размерами набора, временем генерации и стадиями
+    """
+    sys.path.insert(0, str(HERE))
+    import rand
+
+    n_catalog, n_new = TIERS[name]
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        catalog_path = Path(tmp) / "catalog.txt"
+        new_path = Path(tmp) / "new_items.txt"
+        t0 = time.perf_counter()
+        rand.generate(catalog_path, new_path, n_catalog, n_new, seed=seed)
+        gen_sec = round(time.perf_counter() - t0, 4)
+        print(f"[INFO] Tier {name}: {n_catalog} catalog rows, {n_new} new items")
+        proc = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--run-tier", str(catalog_path), str(new_path)],
+            stdout=subprocess.PIPE, text=True, check=True,
+        )
+    lines = proc.stdout.splitlines()
+    print("\n".join(ln for ln in lines if ln.startswith("[INFO]")))
+    result = json.loads(lines[-1])
+    return {"catalog_rows": n_catalog, "new_items": n_new, "seed": seed,
+            "generate_sec": gen_sec, **result}
+
+
+def find_regressions(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Сравнивает отчёт с базовым и возвращает стадии, замедлившиеся больше чем на tolerance,
+    а также уровни, где top-k в TFIDF_DTYPE расходится с float64 сильнее MIN_TOPK_RECALL.
+
+    Returns:
+        Список строк-описаний регрессий
+    """
+    problems = []
+    old_import = baseline.get("import", {}).get("sec")
+    new_import = report.get("import", {}).get("sec")
+    if old_import is not None and new_import is not None and old_import >= MIN_STAGE_SEC \
+            and new_import > old_import * (1 + tolerance):
+        problems.append(f"import: {old_import}s -> {new_import}s")
+    if report.get("import", {}).get("modules"):
+        problems.append(f"import: eager import of {', '.join(report['import']['modules'])}")
+    for tier, data in report["tiers"].items():
+        recall = (data.get("precision") or {}).get("topk_recall")
+        if recall is not None and recall < MIN_TOPK_RECALL:
+            problems.append(f"{tier}/precision: top-k recall vs float64 {recall}")
+        base = baseline.get("tiers", {}).get(tier)
+        if not base:
+            continue
+        for stage, cur in data["stages"].items():
+            old = base["stages"].get(stage)
+            if not old or old["sec"] < MIN_STAGE_SEC:
+                continue
+            if cur["sec"] > old["sec"] * (1 + tolerance):
+                problems.append(f"{tier}/{stage}: {old['sec']}s -> {cur['sec']}s")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark for the duplicate-finder pipeline")
+    parser.add_argument("--tiers", nargs="+", choices=list(TIERS), default=DEFAULT_TIERS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--out", default="bench_report.json", help="JSON отчёт")
+    parser.add_argument("--baseline", help="базовый отчёт для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--workdir", help="каталог для временных наборов данных")
+    parser.add_argument("--run-tier", nargs=2, metavar=("CATALOG", "NEW"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_tier:
+        result = run_tier(*args.run_tier)
+        print(json.dumps(result))
+        return 0
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "import": measure_import_sec(),
+        "tiers": {name: bench_tier(name, args.seed, args.workdir) for name in args.tiers},
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Saved benchmark report to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = find_regressions(report, json.load(f), args.tolerance)
+        for p in problems:
+            print(f"[WARN] regression {p}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
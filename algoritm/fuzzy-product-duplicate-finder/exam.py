@@ -9,12 +9,28 @@ exam.py — нечёткий поиск дубликатов товаров.
 Выход: JSON файл с найденными дубликатами
 """
 
+import argparse
+import codecs
+import gzip
+import heapq
 import json
+import multiprocessing
+import os
 import re
+import sys
+import time
+import weakref
+import zlib
 import numpy as np
 
+from array import array
+from collections import OrderedDict, namedtuple
+
 from pathlib import Path
-from functools import lru_cache
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from functools import update_wrapper, wraps
 from typing import List, Tuple, Any, Optional
 
 
@@ -24,11 +40,36 @@ from typing import List, Tuple, Any, Optional
 SIMILARITY_THRESHOLD: float = 0.80   # итоговый порог 0..1
 TOP_K_CANDIDATES: int = 12        # число кандидатов для детальной дооценки
 TFIDF_CHAR_NGRAM: Tuple = (2, 5)    # char ngram диапазон для TF-IDF (устойчивее для коротких названий)
+TFIDF_DTYPE: str = "float32"       # точность TF-IDF матриц и сходств: "float32" (вдвое меньше памяти) или "float64"
+TFIDF_FEATURES: str = "vocab"     # признаки TF-IDF: "vocab" (словарь n-грамм) или "hashing" (без словаря, --features)
+HASHING_N_FEATURES: int = 1 << 20  # число хэш-корзин в режиме "hashing" (фиксированный размер IDF и матриц)
+CANDIDATE_MODE: str = "tfidf"     # поиск кандидатов: "tfidf" (точный) или "lsh" (MinHash-LSH, --candidates)
+LSH_BANDS: int = 20               # полос LSH: больше полос — выше recall и больше кандидатов
+LSH_ROWS: int = 5                 # строк сигнатуры в полосе: больше строк — меньше кандидатов
+LSH_MAX_CANDIDATES: int = 512     # предел пула корзин на запрос (строки с наибольшим числом общих полос)
+LSH_SHINGLE: int = 3              # длина символьного шингла для MinHash
+USE_BLOCKING: bool = False        # сравнивать только внутри блоков бренд/категория/память (--blocking)
+CANDIDATE_CHUNK_SIZE: int = 256   # строк новых товаров на один блок пакетного поиска (ограничивает пиковую память)
+SCORING_WORKERS: int = 1          # процессов для точной оценки кандидатов и сборки индекса (--workers)
+BATCH_LEXICAL: bool = True        # оценивать все пары одним вызовом rapidfuzz.process.cpdist
+STREAM_BATCH_SIZE: int = 1000     # новых товаров на пакет в потоковом режиме (--chunk-size)
+ENCODING_SNIFF_BYTES: int = 65536 # объём начала файла для определения кодировки
+SPEC_FILTER: bool = True          # отклонять кандидатов с противоречащими характеристиками до точной оценки
+SPEC_FILTER_KEYS: Tuple = ("storage", "inches")   # характеристики жёсткого фильтра (ещё доступен "color")
+SCREEN_INCH_TOLERANCE: float = 0.05  # диагонали, различающиеся меньше, считаются одинаковыми
+PRUNE_CANDIDATES: bool = True     # отбрасывать кандидатов, чья верхняя граница оценки ниже порога
+EXACT_MATCH_FAST_PATH: bool = True  # совпадение нормализованного названия/набора токенов — сразу score 1.0
+SMALL_INPUT_ROWS: int = 500     # каталог меньше — TF-IDF не строится: кандидаты по токенам, без импорта sklearn
+STATS_PREFIX: str = "dupfinder"   # префикс метрик в Prometheus textfile (--stats FILE.prom)
+NORMALIZE_CACHE_BYTES: int = 64 << 20   # бюджет памяти кэша normalize_text_cached
+LEXICAL_CACHE_BYTES: int = 32 << 20     # бюджет памяти кэша lexical_score
 
 # Пути к файлам
 CATALOG_FILE = "catalog.txt"
 NEW_FILE = "new_items.txt"
 OUTPUT_FILE = "duplicates.json"
+INDEX_DIR = "catalog_index"       # каталог с сохранённым TF-IDF индексом (--build-index / --index)
+NORM_CACHE_FILE = None            # файл кэша нормализации между запусками (--norm-cache)
 
 # Флаги обработки
 USE_PREPROCESSING = True      # включить текстовую нормализацию перед векторизацией
@@ -39,6 +80,9 @@ RE_LETTER_DIGIT = re.compile(r'([a-zа-я])([0-9])')
 RE_DIGIT_SLASH_DIGIT = re.compile(r'(\d)\s*/\s*(\d)')
 RE_PUNCTUATION = re.compile(r'[^\w\s\+\/\-]')
 RE_MULTISPACE = re.compile(r'\s+')
+RE_STORAGE = re.compile(r'(\d+)\s*/\s*(\d+)')
+RE_WORD = re.compile(r'[\w\-]+')
+RE_INCHES = re.compile(r'(?<![\d.,])(\d{1,2}(?:[.,]\d{1,2})?)\s*(?:"|”|″|\'\'|дюйм\w*|inch\w*)')
 
 # Словари для нормализации текста
 UNIT_MAP = {
@@ -54,6 +98,20 @@ BRAND_FIXES = {
     'huawei': 'huawei', 'huaweI': 'huawei'
 }
 
+# Ключи блокировки: известные бренды и категории товаров (по исходному названию,
+# т.к. GENERIC_MAP удаляет слова «телефон»/«смартфон» при нормализации)
+BLOCK_BRANDS = {
+    'xiaomi', 'huawei', 'honor', 'samsung', 'apple', 'iphone', 'ipad', 'irbis', 'lenovo',
+    'realme', 'oppo', 'vivo', 'poco', 'redmi', 'nokia', 'google', 'oneplus', 'tecno', 'infinix',
+}
+BRAND_ALIASES = {'iphone': 'apple', 'ipad': 'apple', 'redmi': 'xiaomi', 'poco': 'xiaomi'}
+CATEGORY_MAP = {
+    'телефон': 'phone', 'смартфон': 'phone', 'phone': 'phone', 'smartphone': 'phone',
+    'планшет': 'tablet', 'tablet': 'tablet',
+    'робот-пылесос': 'vacuum', 'пылесос': 'vacuum', 'vacuum': 'vacuum',
+    'часы': 'watch', 'watch': 'watch',
+}
+
 COLOR_MAP = {
     'черный': 'black', 'белый': 'white', 'синий': 'blue',
     'красный': 'red', 'зеленый': 'green', 'желтый': 'yellow',
@@ -66,33 +124,403 @@ COLOR_MAP = {
     'gold': 'gold', 'silver': 'silver'
 }
 
-# Флаги доступности внешних библиотек
-TFIDF_AVAILABLE: bool = False
-RAPIDFUZZ_AVAILABLE: bool = False
+# Флаги доступности внешних библиотек: None — ещё не проверялось
+# (библиотеки импортируются лениво, см. tfidf_available/rapidfuzz_available)
+TFIDF_AVAILABLE: Optional[bool] = None
+RAPIDFUZZ_AVAILABLE: Optional[bool] = None
 
 # ==================== ИМПОРТ ОПЦИОНАЛЬНЫХ БИБЛИОТЕК ====================
+# sklearn + scipy импортируются секунды, rapidfuzz — десятки миллисекунд.
+# Импорт откладывается до первой стадии, которой они действительно нужны:
+# маленькие входы (SMALL_INPUT_ROWS), fallback-режимы и --help их не ждут.
 
-try:
-    from sklearn.feature_extraction.text import TfidfVectorizer
-    from sklearn.metrics.pairwise import linear_kernel
-    TFIDF_AVAILABLE = True
-except Exception:
-    TFIDF_AVAILABLE = False
+from difflib import SequenceMatcher
+
+TfidfVectorizer = None
+HashingVectorizer = None
+sparse = None
+fuzz = None
+cpdist = None
+
+def tfidf_available():
+    """Импортирует sklearn/scipy при первом вызове; True, если TF-IDF доступен."""
+    global TFIDF_AVAILABLE, TfidfVectorizer, HashingVectorizer, sparse
+    if TFIDF_AVAILABLE is None:
+        try:
+            from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+            from scipy import sparse
+            TFIDF_AVAILABLE = True
+        except Exception:
+            TFIDF_AVAILABLE = False
+    return TFIDF_AVAILABLE
+
+def rapidfuzz_available():
+    """Импортирует rapidfuzz при первом вызове; True, если он установлен."""
+    global RAPIDFUZZ_AVAILABLE, fuzz, cpdist
+    if RAPIDFUZZ_AVAILABLE is None:
+        try:
+            from rapidfuzz import fuzz
+            try:
+                from rapidfuzz.process import cpdist   # rapidfuzz >= 3.6
+            except ImportError:
+                cpdist = None
+            RAPIDFUZZ_AVAILABLE = True
+        except Exception:
+            RAPIDFUZZ_AVAILABLE = False
+    return RAPIDFUZZ_AVAILABLE
+
+# ==================== ИНСТРУМЕНТИРОВАНИЕ ====================
+# Время и пиковая память по стадиям плюс счётчики конвейера. Сбор включён
+# всегда (несколько вызовов perf_counter на стадию), выгрузка — по --stats.
 
 try:
-    from rapidfuzz import fuzz
-    RAPIDFUZZ_AVAILABLE = True
-except Exception:
-    RAPIDFUZZ_AVAILABLE = False
-    from difflib import SequenceMatcher
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+# кэшированные функции, чья статистика попаданий попадает в отчёт
+INSTRUMENTED_CACHES = ("normalize_text_cached", "lexical_score")
+
+def peak_rss_mb():
+    """Пиковый RSS текущего процесса в мегабайтах (None, если недоступно)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+class PipelineStats:
+    """
+    Время стадий и счётчики одного запуска конвейера.
+
+    Стадии накапливаются: в потоковом режиме process_all вызывается на каждый
+    пакет, и время стадии суммируется по всем вызовам. Стадии могут быть
+    вложенными (например, scoring внутри save_results в потоковом режиме).
+
+    Использование:
+        with STATS.stage("normalize"):
+            ...
+        @STATS.timed()
+        def build_tfidf_index(...): ...
+        STATS.count("matches_emitted", n)
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Сбрасывает стадии и счётчики (начало нового запуска)."""
+        self.stages = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Контекстный менеджер: добавляет время блока к стадии name."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            st = self.stages.setdefault(name, {"sec": 0.0, "calls": 0, "peak_rss_mb": None})
+            st["sec"] += time.perf_counter() - t0
+            st["calls"] += 1
+            st["peak_rss_mb"] = peak_rss_mb()
+
+    def timed(self, name=None):
+        """Декоратор: каждый вызов функции учитывается как стадия name (по умолчанию — имя функции)."""
+        def decorator(fn):
+            stage_name = name or fn.__name__
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """Увеличивает счётчик name на n."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        Текущее состояние в виде словаря для JSON.
+
+        Returns:
+            Словарь {"wall_sec", "peak_rss_mb", "stages", "counters", "caches"}
+        """
+        caches = {}
+        for fname in INSTRUMENTED_CACHES:
+            fn = globals().get(fname)
+            if fn is not None and hasattr(fn, "cache_info"):
+                info = fn.cache_info()
+                caches[fname] = {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+                                 "bytes": getattr(info, "bytes", None),
+                                 "evictions": getattr(info, "evictions", None)}
+        return {
+            "wall_sec": round(time.perf_counter() - self.started, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {k: {"sec": round(v["sec"], 4), "calls": v["calls"], "peak_rss_mb": v["peak_rss_mb"]}
+                       for k, v in self.stages.items()},
+            "counters": dict(self.counters),
+            "caches": caches,
+        }
+
+    def to_prometheus(self, prefix=STATS_PREFIX):
+        """
+        Состояние в текстовом формате Prometheus (для node_exporter textfile collector).
+
+        Returns:
+            Строка с метриками
+        """
+        snap = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_wall_seconds gauge",
+            f"{prefix}_wall_seconds {snap['wall_sec']}",
+            f"# TYPE {prefix}_stage_seconds gauge",
+        ]
+        lines += [f'{prefix}_stage_seconds{{stage="{k}"}} {v["sec"]}' for k, v in snap["stages"].items()]
+        lines.append(f"# TYPE {prefix}_stage_calls gauge")
+        lines += [f'{prefix}_stage_calls{{stage="{k}"}} {v["calls"]}' for k, v in snap["stages"].items()]
+        if snap["peak_rss_mb"] is not None:
+            lines += [f"# TYPE {prefix}_peak_rss_bytes gauge",
+                      f"{prefix}_peak_rss_bytes {int(snap['peak_rss_mb'] * 1024 * 1024)}"]
+        lines.append(f"# TYPE {prefix}_events gauge")
+        lines += [f'{prefix}_events{{name="{k}"}} {v}' for k, v in snap["counters"].items()]
+        lines.append(f"# TYPE {prefix}_cache_requests gauge")
+        for k, v in snap["caches"].items():
+            lines.append(f'{prefix}_cache_requests{{cache="{k}",result="hit"}} {v["hits"]}')
+            lines.append(f'{prefix}_cache_requests{{cache="{k}",result="miss"}} {v["misses"]}')
+        lines.append(f"# TYPE {prefix}_cache_bytes gauge")
+        lines += [f'{prefix}_cache_bytes{{cache="{k}"}} {v["bytes"]}'
+                  for k, v in snap["caches"].items() if v["bytes"] is not None]
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """
+        Атомарно записывает статистику: .prom — формат Prometheus, иначе JSON.
+
+        Args:
+            path: Путь к файлу статистики
+        """
+        tmp = Path(str(path) + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            if str(path).endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+        print(f"[INFO] Saved pipeline stats to {path}")
+
+STATS = PipelineStats()
+
+# ==================== КЭШИ ====================
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxbytes", "currsize", "bytes", "evictions"])
+
+class ByteBudgetCache:
+    """
+    LRU кэш функции с ограничением по занимаемой памяти, а не по числу записей.
+
+    Размер записи оценивается как sys.getsizeof ключа (каждой строки пары)
+    и значения плюс ENTRY_OVERHEAD на узел словаря. При превышении max_bytes
+    вытесняются самые давно использованные записи; запись больше бюджета
+    не кэшируется вовсе. Интерфейс совместим с lru_cache: cache_info(),
+    cache_clear(); дополнительно items()/update() для сохранения между запусками.
+
+    Ключ — сам аргумент для функций одного аргумента, иначе кортеж аргументов.
+    """
+
+    ENTRY_OVERHEAD = 120   # узел OrderedDict + ссылки, байт (оценка)
+
+    def __init__(self, fn, max_bytes):
+        update_wrapper(self, fn)
+        self.fn = fn
+        self.max_bytes = max_bytes
+        self.cache_clear()
+
+    def __call__(self, *args):
+        key = args[0] if len(args) == 1 else args
+        data = self._data
+        if key in data:
+            self.hits += 1
+            data.move_to_end(key)
+            return data[key]
+        self.misses += 1
+        value = self.fn(*args)
+        self._put(key, value)
+        return value
+
+    def _entry_size(self, key, value):
+        parts = key if isinstance(key, tuple) else (key,)
+        return sum(sys.getsizeof(k) for k in parts) + sys.getsizeof(value) + self.ENTRY_OVERHEAD
+
+    def _put(self, key, value):
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= self._entry_size(key, old)
+        self._data[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            k, v = self._data.popitem(last=False)
+            self.bytes -= self._entry_size(k, v)
+            self.evictions += 1
+
+    def cache_info(self):
+        """Статистика в духе functools.lru_cache: попадания, промахи, записи, байты."""
+        return CacheInfo(self.hits, self.misses, self.max_bytes, len(self._data), self.bytes, self.evictions)
+
+    def cache_clear(self):
+        """Очищает кэш и статистику."""
+        self._data = OrderedDict()
+        self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def items(self):
+        """Пары (ключ, значение) от давно использованных к недавним."""
+        return list(self._data.items())
+
+    def update(self, pairs):
+        """Добавляет готовые пары (ключ, значение) без вызова функции."""
+        for key, value in pairs:
+            self._put(key, value)
+
+def bounded_cache(max_bytes):
+    """Декоратор: оборачивает функцию в ByteBudgetCache с бюджетом max_bytes."""
+    def decorator(fn):
+        return ByteBudgetCache(fn, max_bytes)
+    return decorator
 
 # ----------------- Функция 1: надежный погрузчик -----------------
+def detect_encoding(path, sample_size=ENCODING_SNIFF_BYTES):
+    """
+    Определяет кодировку файла по первым sample_size байтам.
+
+    Порядок проверки: BOM utf-16 / utf-8, затем декодирование образца как
+    utf-8 (обрезанный на границе многобайтовый символ не считается ошибкой),
+    иначе cp1251. Файл целиком при этом не читается.
+
+    Args:
+        path: Путь к файлу
+        sample_size: Размер образца в байтах
+
+    Returns:
+        Имя кодировки для open()
+    """
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+def resolve_encoding(path, block_size=1 << 20):
+    """
+    Определяет кодировку (detect_encoding) и проверяет её на всём файле.
+
+    Образец в начале файла может быть валидным utf-8, а дальше встретится
+    строка в cp1251. Файл проверяется двоичным проходом инкрементальным
+    декодером — до того, как потоковое чтение отдаст первый пакет.
+
+    Args:
+        path: Путь к файлу
+        block_size: Размер блока двоичного чтения
+
+    Returns:
+        Имя кодировки для open()
+    """
+    enc = detect_encoding(path)
+    if enc != "utf-8":
+        return enc
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        # utf-8 образец оказался валидным, а файл дальше — нет
+        return "cp1251"
+    return enc
+
+def _parse_line(ln, path):
+    """
+    Разбирает строку ID<TAB>Title.
+
+    Returns:
+        Кортеж (id, title) или None для пустых и некорректных строк
+    """
+    if not ln or not ln.strip():
+        return None
+    # Если в файле фигурирует буквальная последовательность '\t' — заменяем
+    if '\\t' in ln:
+        ln = ln.replace('\\t', '\t')
+        
+    # Разделение строки на ID и Title
+    if "\t" in ln:
+        parts = ln.split("\t", 1)  # Разделяем только по первому табу
+    else:
+        # fallback: split по 2+ пробелам
+        parts = re.split(r"\s{1,}", ln, maxsplit=1)
+        if len(parts) == 1:
+            parts = ln.split(" ", 1)  # last resort
+    if len(parts) != 2:
+        print(f"[WARN] skipping malformed line in {path!r}: {ln!r}")
+        return None
+    return parts[0].strip(), parts[1].strip()
+
+def iter_tab_file(path, batch_size=STREAM_BATCH_SIZE, encoding=None):
+    """
+    Потоково читает файл ID<TAB>Title пакетами фиксированного размера.
+
+    Кодировка определяется и проверяется по всему файлу до первого пакета
+    (resolve_encoding), в памяти одновременно находится не больше batch_size строк.
+
+    Args:
+        path: Путь к файлу
+        batch_size: Количество записей в пакете
+        encoding: Кодировка (по умолчанию — resolve_encoding)
+
+    Yields:
+        Кортежи (список идентификаторов, список названий) длиной до batch_size
+
+    Raises:
+        FileNotFoundError: Если файл не существует
+        IOError: Если файл не декодируется определённой кодировкой
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(f"File not found: {path}")
+    enc = encoding or resolve_encoding(path)
+    batch_size = max(1, int(batch_size))
+    ids, titles = [], []
+    try:
+        with open(path, encoding=enc) as f:
+            for ln in f:
+                parsed = _parse_line(ln.rstrip("\n\r"), path)
+                if parsed is None:
+                    continue
+                ids.append(parsed[0])
+                titles.append(parsed[1])
+                if len(ids) >= batch_size:
+                    yield ids, titles
+                    ids, titles = [], []
+    except UnicodeDecodeError as e:
+        raise IOError(f"Cannot decode file {path} as {enc}: {e}") from e
+    if ids:
+        yield ids, titles
+
 def load_tab_file(path):
     """
     Загружает файл в формате ID<TAB>Title с автоматическим определением кодировки.
     
     Алгоритм:
-    1. Пробует кодировки: utf-8, cp1251, utf-16
+    1. Определяет кодировку (utf-16/utf-8 BOM, utf-8, cp1251) и проверяет её на всём файле
     2. Заменяет буквальные '\t' на реальную табуляцию
     3. Использует fallback разделение по 2+ пробелам при отсутствии табуляции
     
@@ -106,63 +534,55 @@ def load_tab_file(path):
         FileNotFoundError: Если файл не существует
         IOError: Если не удалось прочитать файл ни в одной кодировке
     """
-    encodings_to_try = ['utf-8', 'cp1251', 'utf-16']
-    raw_lines = None
-    p = Path(path)
-    if not p.exists():
+    if not Path(path).exists():
         raise FileNotFoundError(f"File not found: {path}")
-    
-    # Попытка чтения в разных кодировках
-    for enc in encodings_to_try:
-        try:
-            with open(path, encoding=enc) as f:
-                raw_lines = [ln.rstrip("\n\r") for ln in f]
-            print(f"[DEBUG] Loaded {path} with encoding {enc}, {len(raw_lines)} lines")
-            break
-        except Exception:
-            raw_lines = None
-    if raw_lines is None:
-        raise IOError(f"Cannot read file {path} with encodings {encodings_to_try}")
-
-    ids = []
-    titles = []
-    for ln in raw_lines:
-        if not ln or not ln.strip():
-            continue
-        # Если в файле фигурирует буквальная последовательность '\t' — заменяем
-        if '\\t' in ln:
-            ln = ln.replace('\\t', '\t')
-            
-        # Разделение строки на ID и Title
-        if "\t" in ln:
-            parts = ln.split("\t", 1)  # Разделяем только по первому табу
-        else:
-            # fallback: split по 2+ пробелам
-            parts = re.split(r"\s{1,}", ln, maxsplit=1)
-            if len(parts) == 1:
-                parts = ln.split(" ", 1)  # last resort
-        if len(parts) != 2:
-            print(f"[WARN] skipping malformed line in {path!r}: {ln!r}")
-            continue
-        ids.append(parts[0].strip())
-        titles.append(parts[1].strip())
+    enc = resolve_encoding(path)
+    batches = list(iter_tab_file(path, sys.maxsize, enc))
+    ids, titles = batches[0] if batches else ([], [])
+    print(f"[DEBUG] Loaded {path} with encoding {enc}, {len(ids)} records")
     return ids, titles
 
 # ----------------- Функция 2: Нормализовать текст -----------------
 # Правила нормализации: lower, унификация единиц, удаление лишних символов,
 # разделение границ, сохранение + и / (для S10+ и 8/256)
 
+def compile_word_map():
+    """
+    Компилирует UNIT_MAP, GENERIC_MAP и COLOR_MAP в одно регулярное выражение.
+
+    Вместо ~40 вызовов re.sub на каждую строку получается одна альтернация
+    \b(?:k1|k2|...)\b и таблица замен. Ключи отсортированы по убыванию длины,
+    чтобы 'робот-пылесос' и 'дюйма' имели приоритет над 'пылесос' и 'дюйм'.
+    При совпадении ключей в нескольких словарях побеждает более ранний
+    (UNIT → GENERIC → COLOR), как при прежнем последовательном применении.
+
+    Вызывается при импорте; после изменения словарей во время работы
+    нужно вызвать повторно.
+    """
+    global RE_WORD_MAP, WORD_MAP
+    table = {}
+    for mapping in (UNIT_MAP, GENERIC_MAP, COLOR_MAP):
+        for k, v in mapping.items():
+            table.setdefault(k, v)
+    keys = sorted(table, key=len, reverse=True)
+    WORD_MAP = table
+    RE_WORD_MAP = re.compile(r'\b(?:' + '|'.join(re.escape(k) for k in keys) + r')\b')
+
+def _replace_word(m):
+    return WORD_MAP[m.group(0)]
+
+compile_word_map()
+
 def normalize_text(s: str):
     """
     Нормализует название товара для улучшения сравнения.
     
     Выполняет последовательность преобразований:
     1. Приведение к нижнему регистру
-    2. Стандартизация единиц измерения (ГБ → GB)
-    3. Удаление/замена общих слов
-    4. Стандартизация цветов
-    5. Разделение цифро-буквенных границ
-    6. Удаление лишних символов
+    2. Стандартизация единиц измерения (ГБ → GB), удаление/замена общих
+       слов и стандартизация цветов — за один проход RE_WORD_MAP
+    3. Разделение цифро-буквенных границ
+    4. Удаление лишних символов
     
     Args:
         text: Исходное название товара
@@ -177,15 +597,8 @@ def normalize_text(s: str):
         s0 = s.lower()
         # заменить кавычки на дюймы
         s0 = s0.replace('"', ' inch ').replace('”', ' inch ').replace('“', ' inch ')
-        # заменить блоки
-        for k, v in UNIT_MAP.items():
-            s0 = re.sub(r'\b' + re.escape(k) + r'\b', v, s0)
-        # удаление или сопоставление общих слов
-        for k, v in GENERIC_MAP.items():
-            s0 = re.sub(r'\b' + re.escape(k) + r'\b', v, s0)
-        # цвета
-        for k, v in COLOR_MAP.items():
-            s0 = re.sub(r'\b' + re.escape(k) + r'\b', v, s0)
+        # единицы, общие слова и цвета — один проход скомпилированной альтернации
+        s0 = RE_WORD_MAP.sub(_replace_word, s0)
         # отдельные границы между цифрами и буквами: "8/256GB" -> "8/256 gb" т.д.
         s0 = RE_DIGIT_SLASH_DIGIT.sub(r'\1/\2', s0)
         s0 = RE_DIGIT_LETTER.sub(r'\1 \2', s0)
@@ -198,13 +611,13 @@ def normalize_text(s: str):
             s0 = s0.replace(k, v)
         return s0
 
-@lru_cache(maxsize=10000)
+@bounded_cache(NORMALIZE_CACHE_BYTES)
 def normalize_text_cached(s: str):
     """
     Кэшированная версия функции normalize_text.
     
     Ускоряет обработку при повторяющихся названиях за счёт
-    сохранения результатов в LRU кэше.
+    сохранения результатов в LRU кэше с бюджетом NORMALIZE_CACHE_BYTES.
     
     Args:
         text: Исходное название товара
@@ -214,6 +627,107 @@ def normalize_text_cached(s: str):
     """
     return normalize_text(s)
 
+NORM_CACHE_VERSION = 1
+
+def _normalize_fingerprint():
+    """Контрольная сумма настроек нормализации: при их изменении сохранённый кэш недействителен."""
+    cfg = [NORM_CACHE_VERSION, USE_PREPROCESSING, UNIT_MAP, GENERIC_MAP, COLOR_MAP, BRAND_FIXES]
+    return zlib.crc32(json.dumps(cfg, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+def save_normalize_cache(path=NORM_CACHE_FILE):
+    """
+    Сохраняет кэш normalize_text_cached в JSON (атомарно).
+
+    Записи пишутся в порядке LRU, поэтому после загрузки вытесняться
+    первыми будут те же давно не использованные названия.
+
+    Args:
+        path: Файл кэша
+
+    Returns:
+        Количество сохранённых записей
+    """
+    entries = normalize_text_cached.items()
+    tmp = Path(str(path) + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": _normalize_fingerprint(), "entries": entries}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    print(f"[INFO] Saved {len(entries)} normalized titles to {path}")
+    return len(entries)
+
+def load_normalize_cache(path=NORM_CACHE_FILE):
+    """
+    Загружает кэш нормализации, сохранённый save_normalize_cache.
+
+    Отсутствующий файл или кэш, построенный с другими словарями
+    нормализации, игнорируются.
+
+    Args:
+        path: Файл кэша
+
+    Returns:
+        Количество загруженных записей
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("fingerprint") != _normalize_fingerprint():
+        print(f"[WARN] Normalization settings changed — ignoring cache {path}")
+        return 0
+    normalize_text_cached.update(data["entries"])
+    print(f"[INFO] Loaded {len(data['entries'])} normalized titles from {path}")
+    return len(data["entries"])
+
+def extract_block_keys(s: str):
+    """
+    Извлекает из названия ключи блокировки: бренд, категорию и память.
+
+    Категория берётся из исходного названия, до нормализации, которая
+    удаляет слова «телефон»/«смартфон». Бренды сводятся через BRAND_ALIASES
+    (redmi → xiaomi, iphone → apple), память — к виду "8/256".
+
+    Args:
+        text: Исходное название товара
+
+    Returns:
+        Кортеж (brand, category, storage); отсутствующий ключ — None
+    """
+    s0 = (s or "").lower()
+    brand = category = None
+    for tok in RE_WORD.findall(s0):
+        for part in (tok, *tok.split('-')) if '-' in tok else (tok,):
+            if brand is None and part in BLOCK_BRANDS:
+                brand = BRAND_ALIASES.get(part, part)
+            if category is None and part in CATEGORY_MAP:
+                category = CATEGORY_MAP[part]
+    m = RE_STORAGE.search(s0)
+    storage = f"{int(m.group(1))}/{int(m.group(2))}" if m else None
+    return brand, category, storage
+
+def extract_specs(s: str):
+    """
+    Извлекает из названия характеристики для жёсткого фильтра кандидатов.
+
+    Как и extract_block_keys, работает по исходному названию: нормализация
+    разбивает «10.1"» на «10 1 inch», а здесь диагональ нужна числом.
+    Цвета сводятся через COLOR_MAP («синий» и «blue» — один цвет).
+
+    Args:
+        text: Исходное название товара
+
+    Returns:
+        Кортеж (ram, rom, inches, color): память "8/256" → 8 и 256,
+        диагональ в дюймах, цвет из COLOR_MAP; отсутствующее — None
+    """
+    s0 = (s or "").lower()
+    m = RE_STORAGE.search(s0)
+    ram, rom = (int(m.group(1)), int(m.group(2))) if m else (None, None)
+    m = RE_INCHES.search(s0)
+    inches = float(m.group(1).replace(',', '.')) if m else None
+    color = next((COLOR_MAP[tok] for tok in RE_WORD.findall(s0) if tok in COLOR_MAP), None)
+    return ram, rom, inches, color
+
 # ----------------- Функция 3: Безопасное заполнение пустоты -----------------
 def safe_fill_empty(norm_list, orig_list):
     """
@@ -246,7 +760,7 @@ def safe_fill_empty(norm_list, orig_list):
     return out
 
 # ----------------- Функция 4: Лексический показатель -----------------
-@lru_cache(maxsize=50000)
+@bounded_cache(LEXICAL_CACHE_BYTES)
 def lexical_score(a: str, b: str) -> float:
     """
     Вычисляет лексическое сходство между двумя строками в диапазоне [0, 1].
@@ -262,7 +776,7 @@ def lexical_score(a: str, b: str) -> float:
     Returns:
         Оценка схожести от 0.0 (разные) до 1.0 (идентичные)
     """
-    if RAPIDFUZZ_AVAILABLE:
+    if rapidfuzz_available():
         try:
             return fuzz.token_set_ratio(a, b) / 100.0
         except Exception:
@@ -277,8 +791,257 @@ def lexical_score(a: str, b: str) -> float:
     seq = SequenceMatcher(None, a, b).ratio()
     return 0.6 * jacc + 0.4 * seq
 
+def batch_lexical_scores(a_list, b_list, workers=-1):
+    """
+    Вычисляет lexical_score для списка пар (a_list[i], b_list[i]) за один вызов.
+
+    При наличии rapidfuzz.process.cpdist все пары оцениваются в нативном коде
+    (в том числе параллельно при workers=-1), без питоновского цикла и хэширования
+    пар в кэше lexical_score. Иначе — поэлементный вызов lexical_score.
+
+    Args:
+        a_list: Первые строки пар
+        b_list: Вторые строки пар (той же длины)
+        workers: Количество потоков rapidfuzz (-1 — все ядра)
+
+    Returns:
+        np.ndarray оценок в диапазоне [0, 1], shape (len(a_list),)
+    """
+    if not a_list:
+        return np.zeros(0)
+    if rapidfuzz_available() and cpdist is not None:
+        try:
+            return cpdist(a_list, b_list, scorer=fuzz.token_set_ratio, dtype=np.float64,
+                          workers=workers) / 100.0
+        except Exception:
+            pass
+    return np.array([lexical_score(a, b) for a, b in zip(a_list, b_list)])
+
+def _unique_tokens_len(toks):
+    """Длина строки из уникальных токенов, соединённых пробелом."""
+    uniq = set(toks)
+    return max(0, sum(map(len, uniq)) + len(uniq) - 1)
+
+class TokenizedTitles:
+    """
+    Нормализованные названия, разбитые на токены один раз.
+
+    Каждое название хранится как frozenset целочисленных id токенов: по ним
+    считаются пересечения и вложенность в batch_lexical_scores_tokenized
+    и границы prune_candidates. Словарь vocab общий для каталога и новых
+    товаров: токены новых товаров, которых нет в каталоге, получают
+    временные id (encode), не расширяя словарь каталога.
+
+    При заданных rows разбираются только эти названия (например, строки
+    каталога, попавшие в кандидаты), остальные позиции sets — None:
+    индексация по номеру строки каталога при этом не меняется.
+
+    Attributes:
+        vocab: Словарь токен -> id
+        sets: Список frozenset id токенов каждого названия
+        lengths: array('I') длин строк из уникальных токенов через пробел
+            (то, что сравнивает token_set_ratio; см. combined_upper_bound)
+    """
+
+    def __init__(self, texts=(), vocab=None, rows=None):
+        self.vocab = {} if vocab is None else vocab
+        if rows is None:
+            self.sets = []
+            self.lengths = array('I')
+            self.extend(texts)
+            return
+        self.sets = [None] * len(texts)
+        self.lengths = array('I', bytes(4 * len(texts)))
+        for j in rows:
+            self.sets[j], self.lengths[j] = self._tokenize(texts[j])
+
+    def __len__(self):
+        return len(self.sets)
+
+    def _tokenize(self, text):
+        """frozenset id токенов и длина уникальных токенов; словарь расширяется."""
+        vocab = self.vocab
+        toks = text.split()
+        for tok in toks:
+            if tok not in vocab:
+                vocab[tok] = len(vocab)
+        return frozenset(map(vocab.__getitem__, toks)), _unique_tokens_len(toks)
+
+    def extend(self, texts):
+        """Добавляет названия, расширяя словарь новыми токенами."""
+        for text in texts:
+            ids, length = self._tokenize(text)
+            self.sets.append(ids)
+            self.lengths.append(length)
+
+    def encode(self, texts):
+        """
+        Токенизирует тексты словарём self.vocab, не изменяя его.
+
+        Returns:
+            TokenizedTitles с тем же vocab; неизвестные токены получают id >= len(vocab)
+        """
+        vocab = self.vocab
+        extra = {}
+        out = TokenizedTitles(vocab=vocab)
+        for text in texts:
+            ids = set()
+            toks = text.split()
+            for tok in toks:
+                tid = vocab.get(tok)
+                if tid is None:
+                    tid = extra.setdefault(tok, len(vocab) + len(extra))
+                ids.add(tid)
+            out.sets.append(frozenset(ids))
+            out.lengths.append(_unique_tokens_len(toks))
+        return out
+
+def batch_lexical_scores_tokenized(a_list, b_list, a_sets, b_sets, workers=-1):
+    """
+    batch_lexical_scores по заранее токенизированным парам (см. TokenizedTitles).
+
+    С rapidfuzz: token_set_ratio равен 100, если множества токенов пересекаются
+    и одно содержится в другом (в том числе равны) — такие пары получают 1.0
+    без вызова rapidfuzz, остальные оцениваются batch_lexical_scores.
+    Без rapidfuzz Jaccard считается по готовым множествам id, а не по split().
+
+    Args:
+        a_list, b_list: Строки пар
+        a_sets, b_sets: frozenset id токенов тех же строк
+
+    Returns:
+        np.ndarray оценок в диапазоне [0, 1], shape (len(a_list),)
+    """
+    out = np.empty(len(a_list))
+    if rapidfuzz_available():
+        rest = []
+        for pos, (sa, sb) in enumerate(zip(a_sets, b_sets)):
+            inter = len(sa & sb)
+            if inter and (inter == len(sa) or inter == len(sb)):
+                out[pos] = 1.0
+            else:
+                rest.append(pos)
+        if rest:
+            out[rest] = batch_lexical_scores([a_list[p] for p in rest], [b_list[p] for p in rest], workers)
+        return out
+    for pos, (sa, sb) in enumerate(zip(a_sets, b_sets)):
+        if not sa and not sb:
+            out[pos] = 1.0
+            continue
+        inter = len(sa & sb)
+        jacc = inter / max(1, len(sa) + len(sb) - inter)
+        out[pos] = 0.6 * jacc + 0.4 * SequenceMatcher(None, a_list[pos], b_list[pos]).ratio()
+    return out
+
 # ----------------- Функция 5: Построить tfidf_index -----------------
-def build_tfidf_index(cat_norm, new_norm):
+def smooth_idf(df, n_docs, dtype):
+    """
+    Сглаженный IDF, как у TfidfVectorizer(smooth_idf=True), побитно:
+    ln((n_docs + 1) / (df + 1)) + 1 в типе dtype.
+
+    Args:
+        df: Документная частота признаков
+        n_docs: Число документов
+        dtype: Тип результата (np.float32 / np.float64)
+
+    Returns:
+        np.ndarray IDF признаков
+    """
+    return np.log(dtype(n_docs + 1) / (np.asarray(df).astype(dtype) + dtype(1))) + dtype(1)
+
+class HashingTfidf:
+    """
+    TF-IDF поверх HashingVectorizer: n-граммы хэшируются в n_features корзин,
+    хранится только вектор IDF.
+
+    Словарь n-грамм (TfidfVectorizer.vocabulary_) на большом каталоге занимает
+    больше памяти, чем сама матрица, и долго сериализуется; здесь размер
+    модели фиксирован, а transform не зависит от общего состояния, поэтому
+    каталог можно векторизовать независимыми кусками. Редкие коллизии хэшей
+    слегка завышают сходство строк с общими корзинами.
+
+    Интерфейс совпадает с используемой частью TfidfVectorizer: fit, transform,
+    idf_, analyzer, ngram_range, token_pattern, dtype.
+    """
+
+    features = "hashing"
+
+    def __init__(self, analyzer='char_wb', ngram_range=TFIDF_CHAR_NGRAM, token_pattern=r"(?u)\b\w+\b",
+                 n_features=HASHING_N_FEATURES, dtype=np.float32, idf=None):
+        self.analyzer = analyzer
+        self.ngram_range = tuple(ngram_range)
+        self.token_pattern = token_pattern
+        self.n_features = n_features
+        self.dtype = dtype
+        self.idf_ = idf
+        self._hasher = HashingVectorizer(analyzer=analyzer, ngram_range=self.ngram_range,
+                                         token_pattern=token_pattern, n_features=n_features,
+                                         alternate_sign=False, norm=None, dtype=dtype)
+
+    def fit(self, docs):
+        """
+        Считает IDF по документам (сглаженный, как у TfidfVectorizer).
+
+        Args:
+            docs: Нормализованные тексты
+
+        Returns:
+            self
+        """
+        df = self.document_frequency(docs)
+        if not df.any():
+            raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+        self.idf_ = smooth_idf(df, len(docs), self.dtype)
+        return self
+
+    def document_frequency(self, docs):
+        """Число документов с каждой хэш-корзиной; df кусков каталога складываются."""
+        return np.bincount(self._hasher.transform(docs).indices, minlength=self.n_features)
+
+    def transform(self, docs):
+        """
+        Векторизует тексты: счётчики корзин × IDF с L2-нормировкой строк.
+
+        Args:
+            docs: Нормализованные тексты
+
+        Returns:
+            CSR матрица shape (len(docs), n_features) в dtype
+        """
+        from sklearn.preprocessing import normalize
+        m = self._hasher.transform(docs).tocsr()
+        m.data *= self.idf_[m.indices]
+        return normalize(m, norm="l2", copy=False)
+
+def _fit_vectorizer(docs, dtype=None, features=None):
+    """
+    Обучает TfidfVectorizer: char n-grams, при ошибке — word n-grams.
+
+    Args:
+        docs: Нормализованные тексты для построения словаря и IDF
+        dtype: Тип весов матрицы (по умолчанию TFIDF_DTYPE)
+        features: "vocab" — словарь n-грамм, "hashing" — HashingTfidf
+            (по умолчанию TFIDF_FEATURES)
+
+    Returns:
+        Обученный TfidfVectorizer или HashingTfidf
+    """
+    dtype = np.dtype(dtype or TFIDF_DTYPE).type
+    if (features or TFIDF_FEATURES) == "hashing":
+        try:
+            return HashingTfidf('char_wb', TFIDF_CHAR_NGRAM, dtype=dtype).fit(docs)
+        except Exception:
+            return HashingTfidf('word', (1, 2), dtype=dtype).fit(docs)
+    try:
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=TFIDF_CHAR_NGRAM, min_df=1, dtype=dtype)
+        vectorizer.fit(docs)
+    except Exception:
+        vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1,2), token_pattern=r"(?u)\b\w+\b", min_df=1,
+                                     dtype=dtype)
+        vectorizer.fit(docs)
+    return vectorizer
+
+def build_tfidf_index(cat_norm, new_norm, dtype=None, features=None, extra_docs=()):
     """
     Строит TF-IDF индексы для грубого поиска кандидатов.
     
@@ -290,26 +1053,185 @@ def build_tfidf_index(cat_norm, new_norm):
     Args:
         catalog_texts: Нормализованные тексты каталога
         new_texts: Нормализованные тексты новых товаров
+        dtype: Тип весов: float32 (по умолчанию TFIDF_DTYPE) вдвое экономит память
+            матриц и сходств, порядок кандидатов практически не меняется
+        features: Режим признаков "vocab" или "hashing" (по умолчанию TFIDF_FEATURES)
+        extra_docs: Тексты, участвующие только в обучении словаря и IDF
+            (новые товары, уже найденные точным совпадением)
         
     Returns:
         Кортеж (vectorizer, cat_tfidf_matrix, new_tfidf_matrix)
         Если sklearn недоступен, возвращает (None, None, None)
     """
-    if not TFIDF_AVAILABLE:
+    if not tfidf_available():
         return None, None, None
-    all_docs = cat_norm + new_norm
-    try:
-        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=TFIDF_CHAR_NGRAM, min_df=1)
-        vectorizer.fit(all_docs)
-    except Exception:
-        vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1,2), token_pattern=r"(?u)\b\w+\b", min_df=1)
-        vectorizer.fit(all_docs)
+    vectorizer = _fit_vectorizer(list(cat_norm) + list(new_norm) + list(extra_docs), dtype, features)
     cat_tfidf = vectorizer.transform(cat_norm)
     new_tfidf = vectorizer.transform(new_norm)
     return vectorizer, cat_tfidf, new_tfidf
 
 # ----------------- Функция 6: Поиск кандидата -----------------
-def candidate_search(i_new, new_norm_text, cat_tfidf, new_tfidf, cat_tokens, cat_norm_all, top_k=TOP_K_CANDIDATES):
+def _topk_row(cols, data, top_k, n_cat, fill=True):
+    """
+    Выбирает top_k лучших кандидатов из одной строки разреженной матрицы сходств.
+
+    Вместо полной сортировки строки используется np.argpartition (O(nnz)),
+    затем сортируются только выбранные k элементов. Порядок детерминирован:
+    по убыванию сходства, при равенстве — по возрастанию индекса в каталоге
+    (в том числе на границе k-го элемента). Если ненулевых сходств меньше top_k
+    и fill=True, список дополняется нулевыми кандидатами с наименьшими индексами.
+
+    Args:
+        cols: Индексы столбцов (позиции в каталоге) ненулевых элементов строки
+        data: Значения сходства для cols
+        top_k: Максимальное количество кандидатов
+        n_cat: Размер каталога
+        fill: Дополнять ли результат нулевыми кандидатами до top_k
+
+    Returns:
+        Список кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    k = min(top_k, n_cat)
+    if k <= 0:
+        return []
+    if len(data) > k:
+        kth = data[np.argpartition(-data, k - 1)[k - 1]]
+        above = np.flatnonzero(data > kth)
+        ties = np.flatnonzero(data == kth)
+        ties = ties[np.argsort(cols[ties], kind="stable")][:k - len(above)]
+        sel = np.concatenate([above, ties])
+    else:
+        sel = np.arange(len(data))
+    sel = sel[np.lexsort((cols[sel], -data[sel]))]
+    out = [(int(cols[j]), float(data[j])) for j in sel]
+    if fill and len(out) < k:
+        # добиваем нулевыми кандидатами, как это делала полная сортировка
+        present = {j for j, _ in out}
+        j = 0
+        while len(out) < k:
+            if j not in present:
+                out.append((j, 0.0))
+            j += 1
+    return out
+
+def _topk_sparse_rows(sim, top_k, n_cat, fill=True):
+    """
+    Применяет _topk_row к каждой строке CSR матрицы сходств.
+
+    Args:
+        sim: scipy.sparse CSR матрица сходств, shape (M, N)
+        top_k: Максимальное количество кандидатов для каждой строки
+        n_cat: Размер каталога (N)
+        fill: Дополнять ли строки нулевыми кандидатами (см. _topk_row)
+
+    Returns:
+        Список списков кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    indptr, indices, data = sim.indptr, sim.indices, sim.data
+    return [_topk_row(indices[indptr[r]:indptr[r + 1]], data[indptr[r]:indptr[r + 1]], top_k, n_cat, fill)
+            for r in range(sim.shape[0])]
+
+class TokenInvertedIndex:
+    """
+    Инвертированный индекс токен → строки каталога для fallback поиска без sklearn.
+
+    Поиск затрагивает только строки, у которых есть хотя бы один общий токен
+    с запросом: пересечения считаются подсчётом вхождений в posting-листах
+    (np.unique(..., return_counts=True)), а не перебором всего каталога.
+
+    Attributes:
+        postings: Словарь токен → np.ndarray индексов строк каталога
+        sizes: Количество уникальных токенов в каждой строке каталога
+    """
+
+    def __init__(self, cat_tokens):
+        lists = {}
+        for j, toks in enumerate(cat_tokens):
+            for tok in toks:
+                lists.setdefault(tok, []).append(j)
+        self.postings = {tok: np.array(rows, dtype=np.int64) for tok, rows in lists.items()}
+        self.sizes = np.array([len(toks) for toks in cat_tokens], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def search(self, tokens, top_k=TOP_K_CANDIDATES, row_mask=None):
+        """
+        Находит top_k строк каталога с наибольшим Jaccard по токенам.
+
+        Результат совпадает с полным перебором: строки без общих токенов
+        (Jaccard = 0) добавляются в порядке индексов, только если пересекающихся
+        строк меньше top_k (без row_mask).
+
+        Args:
+            tokens: Множество токенов запроса
+            top_k: Максимальное количество кандидатов
+            row_mask: Булева маска допустимых строк каталога (или None)
+
+        Returns:
+            Список кортежей (индекс_в_каталоге, jaccard)
+        """
+        lists = [self.postings[tok] for tok in tokens if tok in self.postings]
+        if lists:
+            rows, inter = np.unique(np.concatenate(lists), return_counts=True)
+            jacc = inter / np.maximum(1, len(tokens) + self.sizes[rows] - inter)
+        else:
+            rows, jacc = np.zeros(0, dtype=np.int64), np.zeros(0)
+        if row_mask is not None:
+            keep = row_mask[rows]
+            return _topk_row(rows[keep], jacc[keep], top_k, len(self.sizes), fill=False)
+        return _topk_row(rows, jacc, top_k, len(self.sizes))
+
+def token_signature(text):
+    """Ключ ExactMatchIndex: токены нормализованной строки в отсортированном порядке."""
+    return " ".join(sorted(text.split()))
+
+class ExactMatchIndex:
+    """
+    Хэш-таблица сигнатура → строки каталога для точных совпадений.
+
+    Сигнатура — отсортированные токены нормализованного названия, поэтому
+    одинаковые после нормализации названия и перестановки слов дают один
+    ключ. У таких пар совпадают char_wb TF-IDF векторы и множества токенов,
+    а token_set_ratio rapidfuzz равен 1, т.е. полный конвейер дал бы им
+    оценку 1.0 — её можно выдать без поиска кандидатов и точной оценки.
+    Без rapidfuzz lexical_score штрафует перестановку слов (SequenceMatcher),
+    поэтому сигнатурой служит сама нормализованная строка.
+
+    Attributes:
+        rows: Словарь сигнатура → список индексов строк каталога (по возрастанию)
+        ordered: Сигнатура учитывает порядок слов (rapidfuzz не установлен)
+    """
+
+    def __init__(self, cat_norm, ordered=None):
+        self.ordered = not rapidfuzz_available() if ordered is None else ordered
+        self.rows = {}
+        for j, text in enumerate(cat_norm):
+            self.rows.setdefault(self.signature(text), []).append(j)
+
+    def signature(self, text):
+        """Ключ хэш-таблицы для нормализованного названия."""
+        return text if self.ordered else token_signature(text)
+
+    def lookup(self, text, row_mask=None, limit=TOP_K_CANDIDATES):
+        """
+        Находит строки каталога с той же сигнатурой.
+
+        Args:
+            text: Нормализованное название
+            row_mask: Булева маска допустимых строк каталога (или None)
+            limit: Максимальное количество строк (None — все)
+
+        Returns:
+            Список индексов строк каталога (пустой — совпадений нет)
+        """
+        rows = self.rows.get(self.signature(text), ())
+        if row_mask is not None:
+            rows = [j for j in rows if row_mask[j]]
+        return list(rows[:limit])
+
+def candidate_search(i_new, new_norm_text, cat_tfidf, new_tfidf, cat_tokens, cat_norm_all, top_k=TOP_K_CANDIDATES,
+                     token_index=None, row_mask=None):
     """
     Выполняет грубый поиск кандидатов-дубликатов для нового товара.
     
@@ -325,48 +1247,67 @@ def candidate_search(i_new, new_norm_text, cat_tfidf, new_tfidf, cat_tokens, cat
         catalog_normalized: Список нормализованных текстов каталога
         catalog_tokens: Предвычисленные токены каталога (для fallback)
         top_k: Максимальное количество возвращаемых кандидатов
+        token_index: Готовый TokenInvertedIndex (иначе строится из catalog_tokens)
+        row_mask: Булева маска допустимых строк каталога (или None)
         
     Returns:
         Список кортежей (индекс_в_каталоге, оценка_сходства)
     """
-    if TFIDF_AVAILABLE and cat_tfidf is not None and new_tfidf is not None:
+    if cat_tfidf is not None and new_tfidf is not None and tfidf_available():
         try:
             v = new_tfidf[i_new]
-            sims = linear_kernel(v, cat_tfidf).flatten()
-            idxs = sims.argsort()[::-1][:top_k]
-            return [(int(j), float(sims[j])) for j in idxs]
+            sims = (v @ cat_tfidf.T).tocsr()
+            if row_mask is not None:
+                keep = row_mask[sims.indices]
+                return _topk_row(sims.indices[keep], sims.data[keep], top_k, cat_tfidf.shape[0], fill=False)
+            return _topk_sparse_rows(sims, top_k, cat_tfidf.shape[0])[0]
         except Exception as e:
             raise e
     else:
-        # token overlap
-        ntoks = set(new_norm_text.split())
-        scores = []
-        for j, ctoks in enumerate(cat_tokens):
-            jacc = len(ntoks & ctoks) / max(1, len(ntoks | ctoks))
-            scores.append((j, jacc))
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_k]
+        # token overlap через инвертированный индекс
+        if token_index is None:
+            token_index = TokenInvertedIndex(cat_tokens)
+        return token_index.search(set(new_norm_text.split()), top_k, row_mask)
+# Транспонированная матрица последнего каталога: сервис и потоковый режим
+# ищут по одному каталогу много раз, а транспонирование стоит O(nnz каталога)
+_CAT_T_CACHE = [None, None]   # [weakref на cat_tfidf, cat_tfidf.T в CSR]
+
+def _transposed_catalog(cat_tfidf):
+    """cat_tfidf.T в CSR, закэшированная для последней переданной матрицы каталога."""
+    ref, cat_t = _CAT_T_CACHE
+    if ref is None or ref() is not cat_tfidf:
+        cat_t = cat_tfidf.T.tocsr()
+        _CAT_T_CACHE[:] = [weakref.ref(cat_tfidf), cat_t]
+    return cat_t
+
 def batch_candidate_search_tfidf(new_tfidf: Any, 
                                 cat_tfidf: Any, 
-                                top_k: int=TOP_K_CANDIDATES
+                                top_k: int=TOP_K_CANDIDATES,
+                                chunk_size: int=CANDIDATE_CHUNK_SIZE,
+                                row_mask: Any=None,
+                                fill: bool=True
                                 ) -> Optional[List[List[Tuple[int, float]]]]:
     """
-    Выполняет пакетный поиск кандидатов-дубликатов для всех новых товаров одновременно.
+    Выполняет пакетный поиск кандидатов-дубликатов для всех новых товаров.
     
     Алгоритм:
-    1. Вычисляет матрицу косинусных сходств между всеми новыми товарами и каталогом
-    2. Для каждого нового товара выбирает top_k наиболее похожих товаров из каталога
-    3. Возвращает результаты в структурированном виде
+    1. Делит новые товары на блоки по chunk_size строк
+    2. Для каждого блока считает разреженное произведение new_chunk @ cat^T
+       (плотная матрица M×N никогда не строится целиком)
+    3. Для каждой строки выбирает top_k через argpartition, без полной сортировки
     
-    Преимущества перед последовательным поиском:
-    - Векторизованные вычисления (быстрее для больших объемов)
-    - Минимизация накладных расходов на вызовы функций
-    - Эффективное использование кэша процессора
+    Пиковая память ограничена chunk_size × N вместо M × N: для 5000 новых
+    товаров и каталога в 100 000 строк это сотни мегабайт вместо ~4 ГБ.
     
     Args:
         new_tfidf: TF-IDF матрица новых товаров, shape (M, V)
         cat_tfidf: TF-IDF матрица каталога, shape (N, V)
         top_k: Максимальное количество кандидатов для каждого товара
+        chunk_size: Количество строк новых товаров в одном блоке
+        row_mask: Необязательная булева маска строк каталога, shape (N,);
+            строки с False (например, удалённые) не участвуют в поиске
+        fill: Дополнять ли списки нулевыми кандидатами до top_k (False — только
+            ненулевые сходства, как нужно шардам CatalogShards)
         
     Returns:
         Список списков, где:
@@ -377,38 +1318,36 @@ def batch_candidate_search_tfidf(new_tfidf: Any,
     Raises:
         Не генерирует исключения напрямую, возвращает None при ошибках
     """
-    if not TFIDF_AVAILABLE or cat_tfidf is None or new_tfidf is None:
+    if not tfidf_available() or cat_tfidf is None or new_tfidf is None:
         return None
     
     try:
-        # Вычисляем все попарные сходства за один вызов
-        sim_matrix = linear_kernel(new_tfidf, cat_tfidf)  # Форма (M, N)
-        
-        # Получаем количество новых товаров
-        n_new = sim_matrix.shape[0]
-        n_cat = sim_matrix.shape[1]
-        
-        # Если кандидатов меньше, чем top_k, используем всех
-        actual_top_k = min(top_k, n_cat)
-        
-        # Находим top_k для каждой строки
-        top_indices = np.argsort(-sim_matrix, axis=1)[:, :actual_top_k]
-        
-        # Собираем результаты
+        n_new = new_tfidf.shape[0]
+        chunk_size = max(1, int(chunk_size))
+
+        # Транспонируем каталог один раз: CSR @ CSR не требует конвертаций на каждом блоке
+        cat_t = _transposed_catalog(cat_tfidf)
+        rows = None
+        if row_mask is not None:
+            # Ищем только среди разрешённых строк (столбцов cat^T), затем возвращаем глобальные индексы
+            rows = np.flatnonzero(row_mask)
+            cat_t = cat_t[:, rows]
+        n_cat = cat_t.shape[1]
+
         results = []
-        for i in range(n_new):
-            row_indices = top_indices[i]
-            row_scores = sim_matrix[i, row_indices]
-            results.append([(int(idx), float(score)) 
-                        for idx, score in zip(row_indices, row_scores)])
-        
+        for start in range(0, n_new, chunk_size):
+            sim_chunk = (new_tfidf[start:start + chunk_size] @ cat_t).tocsr()
+            results.extend(_topk_sparse_rows(sim_chunk, top_k, n_cat, fill))
+
+        if rows is not None:
+            results = [[(int(rows[j]), score) for j, score in cands] for cands in results]
         return results
     except Exception as e:
         print(f"[WARN] Batch candidate search failed: {e}")
         return None
 
 # ----------------- Функция 7: Вычислительный комбинированный результат -----------------
-def compute_combined_score(a_norm, b_norm, coarse_sim):
+def compute_combined_score(a_norm, b_norm, coarse_sim, lex=None):
     """
     Вычисляет итоговую оценку схожести через комбинацию метрик.
     
@@ -420,93 +1359,339 @@ def compute_combined_score(a_norm, b_norm, coarse_sim):
         text_a_normalized: Первая нормализованная строка
         text_b_normalized: Вторая нормализованная строка
         coarse_similarity: Грубая оценка сходства (TF-IDF или Jaccard)
+        lex: Заранее вычисленный lexical_score (см. batch_lexical_scores)
         
     Returns:
         Кортеж (lexical_score, tfidf_score, combined_score)
     """
-    lex = lexical_score(a_norm, b_norm)
+    if lex is None:
+        lex = lexical_score(a_norm, b_norm)
+    lex = float(lex)
     tfidf_sim_norm = float(coarse_sim) if coarse_sim is not None else 0.0
     combined = 0.6 * lex + 0.4 * tfidf_sim_norm
     return round(lex, 4), round(tfidf_sim_norm, 4), round(combined, 4)
 
+PRUNE_MARGIN = 1e-4   # запас на округление итоговой оценки до 4 знаков
+
+def combined_upper_bound(coarse_sim, a_set, b_set, a_len, b_len):
+    """
+    Верхняя граница compute_combined_score без вызова lexical_score.
+
+    lexical_score ≤ 1; если у строк нет общих токенов, token_set_ratio
+    сравнивает строки из уникальных токенов длиной a_len и b_len, и его
+    нормированное Indel-сходство не превышает 2·min / (a_len + b_len).
+    Без rapidfuzz при пустом пересечении Jaccard = 0, и оценка ≤ 0.4.
+
+    Args:
+        coarse_sim: Грубая оценка кандидата (TF-IDF или Jaccard)
+        a_set, b_set: frozenset id токенов (TokenizedTitles.sets)
+        a_len, b_len: TokenizedTitles.lengths тех же строк
+
+    Returns:
+        Число, не меньшее итоговой оценки пары
+    """
+    if not a_set.isdisjoint(b_set):
+        lex = 1.0
+    elif rapidfuzz_available():
+        lex = 2.0 * min(a_len, b_len) / (a_len + b_len) if a_len + b_len else 1.0
+    else:
+        lex = 0.4
+    return 0.6 * lex + 0.4 * float(coarse_sim)
+
 # ----------------- Функция 8: Полный цикл процессов -----------------
-def process_all(cat_ids, cat_titles, new_ids, new_titles):
+def process_all(cat_ids, cat_titles, new_ids, new_titles, index=None, workers=SCORING_WORKERS,
+                candidates=CANDIDATE_MODE, lsh=None, blocking=USE_BLOCKING, pool=None):
     """
     Основной процесс поиска дубликатов.
     
     Алгоритм:
     1. Нормализация и предобработка текстов
-    2. Построение индексов для быстрого поиска
+    2. Построение индексов для быстрого поиска (или использование готового
+       индекса каталога: тогда векторизуются только новые товары; для входов
+       меньше SMALL_INPUT_ROWS — без TF-IDF, кандидаты по пересечению токенов)
     3. Для каждого нового товара:
        - Грубый поиск кандидатов
        - Точная оценка кандидатов
        - Фильтрация по порогу
     4. Формирование результатов
+
+    При EXACT_MATCH_FAST_PATH товары, чья сигнатура токенов совпадает
+    со строкой каталога (ExactMatchIndex), получают эти строки с оценкой 1.0
+    сразу после нормализации — после тех же блокировки и жёсткого фильтра
+    характеристик (filter_exact_hits); шаги 2-3 выполняются только для остальных.
     
     Args:
         catalog_ids: Идентификаторы товаров в каталоге
         catalog_titles: Названия товаров в каталоге
         new_ids: Идентификаторы новых товаров
         new_titles: Названия новых товаров
+        index: Готовый CatalogIndex (см. build_catalog_index/load_catalog_index);
+            если передан, каталог не нормализуется и TF-IDF не переобучается
+        workers: Число процессов для точной оценки кандидатов (1 — без пула)
+        candidates: Способ поиска кандидатов: "tfidf" или "lsh"
+        lsh: Готовый MinHashLSHIndex каталога для candidates="lsh"
+            (по умолчанию строится с LSH_BANDS/LSH_ROWS и кэшируется в index)
+        blocking: Сравнивать товар только с блоком каталога с тем же брендом,
+            категорией и памятью (см. CatalogBlocks); товары без ключей — со всем каталогом
+        pool: Готовый ScoringPool для точной оценки (вместо workers); каталог
+            пересылается его воркерам один раз на весь запуск
         
     Returns:
         Словарь с результатами поиска, готовый для сохранения в JSON
     """
+    STATS.count("new_items", len(new_ids))
     # Нормализации
-    cat_norm_local = [normalize_text_cached(t) for t in cat_titles]
-    new_norm_local = [normalize_text_cached(t) for t in new_titles]
+    with STATS.stage("normalize"):
+        new_norm_local = [normalize_text_cached(t) for t in new_titles]
+        new_norm_local = safe_fill_empty(new_norm_local, new_titles)
+        if index is None:
+            cat_norm_local = [normalize_text_cached(t) for t in cat_titles]
+            # Защита от пустых нормализованных строк
+            cat_norm_local = safe_fill_empty(cat_norm_local, cat_titles)
 
-    # Защита от пустых нормализованных строк
-    cat_norm_local = safe_fill_empty(cat_norm_local, cat_titles)
-    new_norm_local = safe_fill_empty(new_norm_local, new_titles)
+    exact_results = {}
+    if EXACT_MATCH_FAST_PATH:
+        with STATS.stage("exact_match"):
+            if index is not None:
+                exact_index = index.exact
+                if exact_index is None:
+                    exact_index = index.exact = ExactMatchIndex(index.norm)
+                exact_cat = (index.ids, index.titles, index.norm)
+                live = ~index.deleted if index.deleted.any() else None
+            else:
+                exact_index = ExactMatchIndex(cat_norm_local)
+                exact_cat = (cat_ids, cat_titles, cat_norm_local)
+                live = None
+            hits = {}
+            for i, text in enumerate(new_norm_local):
+                rows = exact_index.lookup(text, live, limit=None)
+                if rows:
+                    hits[i] = rows
+            # точные совпадения проходят те же блокировку и жёсткий фильтр, что и кандидаты
+            hits = filter_exact_hits(hits, new_titles, exact_cat[1], blocking,
+                                     index.specs if index is not None else None)
+            for i, rows in hits.items():
+                exact_results[i] = exact_match_result(i, rows[:TOP_K_CANDIDATES], *exact_cat,
+                                                      new_titles, new_norm_local)
+        STATS.count("exact_hits", len(exact_results))
+        STATS.count("matches_emitted", sum(len(r["matches"]) for r in exact_results.values()))
+    if exact_results:
+        # дальше идут только товары без точного совпадения
+        all_ids, hit_norm = new_ids, [new_norm_local[i] for i in exact_results]
+        misses = [i for i in range(len(new_ids)) if i not in exact_results]
+        new_ids = [new_ids[i] for i in misses]
+        new_titles = [new_titles[i] for i in misses]
+        new_norm_local = [new_norm_local[i] for i in misses]
+        if not misses:
+            return {nid: exact_results[i] for i, nid in enumerate(all_ids)}
 
-    # Построение TF-IDF (если возможно)
-    vectorizer, cat_tfidf, new_tfidf = build_tfidf_index(cat_norm_local, new_norm_local)
+    small = (index is None and candidates == "tfidf"
+             and len(cat_titles) < SMALL_INPUT_ROWS and len(new_titles) < SMALL_INPUT_ROWS)
+    with STATS.stage("vectorize"):
+        if index is not None:
+            # Каталог уже нормализован и векторизован — трансформируем только новые товары
+            cat_ids, cat_titles = index.ids, index.titles
+            cat_norm_local = index.norm
+            cat_tfidf = index.tfidf
+            new_tfidf = index.vectorizer.transform(new_norm_local) if index.vectorizer is not None else None
+            row_mask = ~index.deleted if index.deleted.any() else None
+        elif small:
+            # маленький вход: TF-IDF не строится и sklearn/scipy не импортируются —
+            # кандидаты ищутся по пересечению токенов (оценка tfidf тогда — их доля)
+            cat_tfidf = new_tfidf = None
+            row_mask = None
+        else:
+            # Построение TF-IDF (если возможно)
+            # IDF обучается по всем новым товарам, включая точные совпадения,
+            # чтобы оценки остальных не зависели от быстрого пути
+            vectorizer, cat_tfidf, new_tfidf = build_tfidf_index(cat_norm_local, new_norm_local,
+                                                                 extra_docs=hit_norm if exact_results else ())
+            row_mask = None
 
-    # подготовка токенов для fallback поиска
-    cat_tokens_local = [set(s.split()) for s in cat_norm_local] if not TFIDF_AVAILABLE else None
-    # ПАКЕТНЫЙ поиск кандидатов (если TF-IDF доступен)
-    if TFIDF_AVAILABLE and cat_tfidf is not None:
-        batch_candidates = batch_candidate_search_tfidf(new_tfidf, cat_tfidf, TOP_K_CANDIDATES)
-    else:
-        batch_candidates = None
+    # подготовка инвертированного индекса токенов для fallback поиска
+    token_index = None
+    if cat_tfidf is None:
+        token_index = index.token_index if index is not None else None
+        if token_index is None:
+            with STATS.stage("token_index"):
+                token_index = TokenInvertedIndex([set(s.split()) for s in cat_norm_local])
+            if index is not None:
+                index.token_index = token_index
+    if candidates == "lsh" and lsh is None:
+        if index is not None and index.lsh is not None:
+            lsh = index.lsh
+        else:
+            with STATS.stage("lsh_index"):
+                lsh = MinHashLSHIndex(cat_norm_local)
+        if index is not None:
+            index.lsh = lsh
 
-    results = {}
+    with STATS.stage("candidate_search"):
+        batch_candidates = _collect_candidates(index, cat_titles, cat_tfidf, cat_norm_local, new_norm_local,
+                                               new_tfidf, new_titles, row_mask, token_index,
+                                               candidates, lsh, blocking)
+    # токены каталога: для индекса — один раз на все пакеты,
+    # без индекса — только строки, попавшие в кандидаты этого вызова
+    with STATS.stage("tokenize"):
+        if index is None:
+            cat_tokens = TokenizedTitles(cat_norm_local, rows=candidate_rows(batch_candidates))
+        else:
+            cat_tokens = index.tokens
+            if cat_tokens is None:
+                cat_tokens = index.tokens = TokenizedTitles(cat_norm_local)
+        new_tokens = cat_tokens.encode(new_norm_local)
 
-    for i, nid in enumerate(new_ids):
-        detailed = []
-        if batch_candidates is not None:
-            cand_list = batch_candidates[i]
+    if PRUNE_CANDIDATES:
+        # кандидаты, не способные пройти порог даже с lexical = 1, не оцениваются
+        with STATS.stage("prune"):
+            n_found = sum(len(c) for c in batch_candidates)
+            batch_candidates = prune_candidates(batch_candidates, new_tokens, cat_tokens)
+        STATS.count("candidates_pruned", n_found - sum(len(c) for c in batch_candidates))
+    if SPEC_FILTER:
+        # разная память или диагональ — не дубликат, сколько бы ни совпадало в названии
+        with STATS.stage("spec_filter"):
+            if index is None:
+                cat_specs = CatalogSpecs(cat_titles, rows=candidate_rows(batch_candidates))
+            else:
+                cat_specs = index.specs
+                if cat_specs is None:
+                    cat_specs = index.specs = CatalogSpecs(index.titles)
+            batch_candidates, n_rejected = reject_spec_conflicts(batch_candidates, CatalogSpecs(new_titles),
+                                                                 cat_specs)
+        STATS.count("candidates_rejected_specs", n_rejected)
+    STATS.count("candidates_scored", sum(len(c) for c in batch_candidates))
+
+    # Точная оценка кандидатов: в текущем процессе или в пуле воркеров
+    with STATS.stage("scoring"):
+        if pool is not None and len(new_ids) > 1:
+            scored = pool.map(batch_candidates, cat_ids, cat_titles, cat_norm_local, new_titles, new_norm_local,
+                              cat_tokens.sets, new_tokens.sets)
+        elif workers > 1 and len(new_ids) > 1:
+            scored = score_candidates_parallel(batch_candidates, cat_ids, cat_titles, cat_norm_local,
+                                               new_titles, new_norm_local, workers,
+                                               cat_tokens.sets, new_tokens.sets)
         else:
-            cand_list = candidate_search(
-                i, 
-                new_norm_local[i],
-                cat_tfidf, 
-                new_tfidf, 
-                cat_tokens_local, 
-                cat_norm_local,
-                top_k=TOP_K_CANDIDATES
+            scored = score_items(0, batch_candidates, cat_ids, cat_titles, cat_norm_local,
+                                 new_titles, new_norm_local, cat_sets=cat_tokens.sets,
+                                 new_sets=new_tokens.sets)
+    STATS.count("matches_emitted", sum(len(r["matches"]) for r in scored))
+
+    if exact_results:
+        exact_results.update(zip(misses, scored))
+        return {nid: exact_results[i] for i, nid in enumerate(all_ids)}
+    return dict(zip(new_ids, scored))
+
+def candidate_rows(cand_lists):
+    """Строки каталога, встречающиеся в списках кандидатов, по возрастанию."""
+    return sorted({idx for cands in cand_lists for idx, _ in cands})
+
+def _collect_candidates(index, cat_titles, cat_tfidf, cat_norm_local, new_norm_local, new_tfidf, new_titles,
+                        row_mask, token_index, candidates, lsh, blocking, top_k=TOP_K_CANDIDATES):
+    """
+    Грубый поиск кандидатов для всех новых товаров, с блокировкой или без.
+
+    Returns:
+        Список списков кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    shards = index.shards if index is not None else None
+    if blocking:
+        # блокировка: каждый блок новых товаров сравнивается только со своим блоком каталога
+        blocks = index.blocks if index is not None and index.blocks is not None else CatalogBlocks(cat_titles)
+        if index is not None:
+            index.blocks = blocks
+        batch_candidates = [None] * len(new_norm_local)
+        for members, block_mask in blocks.group(new_titles, row_mask):
+            sub = _search_candidates(
+                [new_norm_local[i] for i in members],
+                new_tfidf[members] if new_tfidf is not None else None,
+                cat_tfidf, cat_norm_local, block_mask, token_index, candidates, lsh, top_k, shards,
             )
-        for idx, coarse_sim in cand_list:
-            a_norm = new_norm_local[i]
-            b_norm = cat_norm_local[idx]
-            lex, tfidf_norm, combined = compute_combined_score(a_norm, b_norm, coarse_sim)
-            detailed.append({
-                "catalog_id": cat_ids[idx],
-                "catalog_title": cat_titles[idx],
-                "catalog_norm": b_norm,
-                "score_components": {"lexical": lex, "tfidf": tfidf_norm},
-                "score": combined
-            })
-        # фильтрация по порогу
-        filtered = [d for d in detailed if d["score"] >= SIMILARITY_THRESHOLD]
-        filtered.sort(key=lambda x: x["score"], reverse=True)
-        results[nid] = {
-            "new_title": new_titles[i],
-            "new_norm": new_norm_local[i],
-            "matches": filtered
-        }
-    return results
+            for i, cand_list in zip(members, sub):
+                batch_candidates[i] = cand_list
+        return batch_candidates
+    return _search_candidates(new_norm_local, new_tfidf, cat_tfidf, cat_norm_local,
+                              row_mask, token_index, candidates, lsh, top_k, shards)
+
+def _search_candidates(new_norm, new_tfidf, cat_tfidf, cat_norm, row_mask, token_index, candidates, lsh,
+                       top_k=TOP_K_CANDIDATES, shards=None):
+    """
+    Грубый поиск кандидатов для группы новых товаров.
+
+    Порядок выбора: MinHash-LSH (candidates="lsh"), пакетный TF-IDF,
+    поштучный candidate_search (без sklearn или при ошибке пакетного поиска).
+
+    Args:
+        new_norm: Нормализованные названия товаров группы
+        new_tfidf: TF-IDF матрица товаров группы (или None)
+        cat_tfidf: TF-IDF матрица каталога (или None)
+        cat_norm: Нормализованные названия каталога
+        row_mask: Булева маска допустимых строк каталога (или None)
+        token_index: TokenInvertedIndex для fallback (или None)
+        candidates: "tfidf" или "lsh"
+        lsh: MinHashLSHIndex для candidates="lsh"
+        top_k: Количество кандидатов на товар
+        shards: Запущенные CatalogShards — TF-IDF поиск идёт в процессах-шардах
+
+    Returns:
+        Список списков кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    if candidates == "lsh":
+        # приближённый поиск: кандидаты из корзин LSH, ранжирование по TF-IDF (если есть)
+        return lsh_candidate_search(lsh, new_norm, top_k, new_tfidf, cat_tfidf, row_mask)
+    if shards is not None and new_tfidf is not None:
+        return shards.search(new_tfidf, top_k, row_mask)
+    # ПАКЕТНЫЙ поиск кандидатов (если TF-IDF доступен)
+    if cat_tfidf is not None and tfidf_available():
+        found = batch_candidate_search_tfidf(new_tfidf, cat_tfidf, top_k, row_mask=row_mask)
+        if found is not None:
+            return found
+    return [
+        candidate_search(
+            i, 
+            new_norm[i],
+            cat_tfidf, 
+            new_tfidf, 
+            None, 
+            cat_norm,
+            top_k=top_k,
+            token_index=token_index,
+            row_mask=row_mask
+        )
+        for i in range(len(new_norm))
+    ]
+
+def iter_process_batches(index, new_batches, workers=SCORING_WORKERS, candidates=CANDIDATE_MODE, lsh=None,
+                         blocking=USE_BLOCKING, pool=None):
+    """
+    Потоковый вариант process_all: обрабатывает новые товары пакетами.
+
+    Каталог подготавливается один раз (CatalogIndex), каждый пакет новых
+    товаров векторизуется, ищется и оценивается отдельно, а результаты
+    отдаются сразу — память не растёт с размером new_items.txt.
+
+    Args:
+        index: CatalogIndex (build_catalog_index или load_catalog_index)
+        new_batches: Итератор пакетов (ids, titles), например iter_tab_file
+        workers: Число процессов для точной оценки кандидатов
+        candidates: Способ поиска кандидатов: "tfidf" или "lsh"
+        lsh: Готовый MinHashLSHIndex каталога (для candidates="lsh")
+        blocking: Ограничивать сравнения блоками бренд/категория/память
+        pool: ScoringPool на все пакеты (по умолчанию создаётся здесь при workers > 1)
+
+    Yields:
+        Кортежи (new_id, результат) в порядке входного файла
+    """
+    own_pool = pool is None and workers > 1
+    if own_pool:
+        pool = ScoringPool(workers)
+    try:
+        for new_ids, new_titles in new_batches:
+            yield from process_all(index.ids, index.titles, new_ids, new_titles, index=index,
+                                   workers=workers, candidates=candidates, lsh=lsh,
+                                   blocking=blocking, pool=pool).items()
+    finally:
+        if own_pool:
+            pool.close()
 
 # ----------------- Функция 9: Сохраняем результат -----------------
 def save_results(results, out_path=OUTPUT_FILE):
@@ -517,29 +1702,1718 @@ def save_results(results, out_path=OUTPUT_FILE):
         results: Словарь с результатами поиска
         output_path: Путь для сохранения JSON файла
     """
-    with open(out_path, "w", encoding="utf-8") as f:
+    with _open_output(out_path, gzip_output=False) as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
     print(f"[INFO] Saved results to {out_path}")
 
+@contextmanager
+def _open_output(out_path, gzip_output=None):
+    """
+    Открывает файл результатов на запись; gzip — по флагу или расширению .gz.
+
+    Запись идёт во временный файл, который заменяет out_path (os.replace)
+    только после успешного завершения: упавший на середине потоковый запуск
+    не оставляет обрезанный JSON на месте результата.
+    """
+    if gzip_output is None:
+        gzip_output = str(out_path).endswith(".gz")
+    tmp = Path(str(out_path) + ".tmp")
+    try:
+        with (gzip.open(tmp, "wt", encoding="utf-8") if gzip_output else open(tmp, "w", encoding="utf-8")) as f:
+            yield f
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, out_path)
+
+def compact_result(info):
+    """
+    Компактная запись результата: без нормализованных строк new_norm/catalog_norm.
+
+    Args:
+        info: Результат score_new_item
+
+    Returns:
+        Новый словарь без отладочных полей
+    """
+    return {
+        "new_title": info["new_title"],
+        "matches": [{k: v for k, v in m.items() if k != "catalog_norm"} for m in info["matches"]],
+    }
+
+def save_results_stream(items, out_path=OUTPUT_FILE, gzip_output=None):
+    """
+    Пишет результаты по мере поступления, не собирая общий словарь.
+
+    Формат файла совпадает с save_results (JSON объект с indent=2).
+
+    Args:
+        items: Итератор кортежей (new_id, результат)
+        output_path: Путь для сохранения JSON файла
+        gzip_output: Сжимать gzip (None — если путь оканчивается на .gz)
+
+    Returns:
+        Количество записанных товаров
+    """
+    n = 0
+    with _open_output(out_path, gzip_output) as f:
+        f.write("{")
+        for nid, info in items:
+            body = json.dumps(info, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+            f.write(("," if n else "") + "\n  " + json.dumps(nid, ensure_ascii=False) + ": " + body)
+            n += 1
+        f.write("\n}" if n else "}")
+    print(f"[INFO] Saved {n} results to {out_path}")
+    return n
+
+def save_results_jsonl(items, out_path=OUTPUT_FILE, gzip_output=None):
+    """
+    Пишет результаты в формате JSON Lines: один объект на новый товар.
+
+    Каждая строка записывается сразу после оценки товара, без отступов;
+    идентификатор хранится в поле "new_id". Такой файл читается построчно
+    и может обрабатываться параллельно с записью.
+
+    Args:
+        items: Итератор кортежей (new_id, результат)
+        output_path: Путь для сохранения .jsonl (или .jsonl.gz)
+        gzip_output: Сжимать gzip (None — если путь оканчивается на .gz)
+
+    Returns:
+        Количество записанных товаров
+    """
+    n = 0
+    with _open_output(out_path, gzip_output) as f:
+        for nid, info in items:
+            f.write(json.dumps({"new_id": nid, **info}, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+            n += 1
+    print(f"[INFO] Saved {n} results to {out_path}")
+    return n
+
+# ----------------- Функция 10: Персистентный индекс каталога -----------------
+# Каталог между запусками меняется редко, поэтому словарь/IDF, CSR матрица каталога
+# и нормализованные названия сохраняются на диск один раз. Массивы лежат в отдельных
+# .npy файлах (np.load(mmap_mode='r') не отображает в память члены .npz архива),
+# всё остальное — в сайдкаре meta.json.
+
+INDEX_FORMAT_VERSION = 2
+INDEX_COMPACT_RATIO: float = 0.2   # доля удалённых + дописанных строк, после которой индекс пересобирается
+
+# Политика IDF при инкрементальных обновлениях — «замороженный IDF»:
+# дописанные строки векторизуются существующим словарём и IDF, их новые
+# n-граммы до компактации отбрасываются; удалённые строки только помечаются
+# в битовой маске tombstones и исключаются из поиска. Когда доля изменений
+# превышает INDEX_COMPACT_RATIO, compact_catalog_index переобучает TF-IDF
+# на живых строках, и дрейф IDF обнуляется. В режиме hashing новые n-граммы
+# не отбрасываются: их корзины получают IDF для df=0 до компактации.
+
+@dataclass
+class CatalogIndex:
+    """
+    Готовый к поиску индекс каталога.
+
+    Attributes:
+        ids: Идентификаторы товаров каталога
+        titles: Исходные названия
+        norm: Нормализованные названия (после safe_fill_empty)
+        vectorizer: Обученный TfidfVectorizer (словарь и IDF), HashingTfidf (только IDF)
+            или None без sklearn
+        tfidf: CSR матрица каталога, shape (N, V), или None без sklearn
+        deleted: Битовая маска удалённых строк (tombstones), shape (N,)
+        n_appended: Число строк, дописанных с замороженным IDF после последней сборки
+        lsh: Построенный по запросу MinHashLSHIndex (не сохраняется на диск)
+        token_index: Построенный по запросу TokenInvertedIndex для fallback без sklearn
+        blocks: Построенные по запросу CatalogBlocks для режима блокировки
+        tokens: Построенные по запросу TokenizedTitles каталога для точной оценки
+        exact: Построенный по запросу ExactMatchIndex для точных совпадений
+        shards: Запущенные CatalogShards: поиск TF-IDF кандидатов в процессах-шардах
+        specs: Построенные по запросу CatalogSpecs для жёсткого фильтра характеристик
+    """
+    ids: List[str]
+    titles: List[str]
+    norm: List[str]
+    vectorizer: Any
+    tfidf: Any
+    deleted: Any = None
+    n_appended: int = 0
+    lsh: Any = None
+    token_index: Any = None
+    blocks: Any = None
+    tokens: Any = None
+    exact: Any = None
+    shards: Any = None
+    specs: Any = None
+
+    def __post_init__(self):
+        if self.deleted is None:
+            self.deleted = np.zeros(len(self.ids), dtype=bool)
+
+    def live_rows(self):
+        """Позиции неудалённых строк каталога."""
+        return np.flatnonzero(~self.deleted)
+
+def vectorizer_features(vectorizer):
+    """Режим признаков обученного векторизатора: "hashing" или "vocab"."""
+    return getattr(vectorizer, "features", "vocab")
+
+@STATS.timed()
+def build_catalog_index(cat_ids, cat_titles, features=None, workers=1):
+    """
+    Нормализует каталог и обучает TF-IDF только на нём.
+
+    В отличие от build_tfidf_index, новые товары в словарь не попадают:
+    их n-граммы, отсутствующие в каталоге, при transform отбрасываются,
+    что не влияет на косинусное сходство с каталогом.
+
+    Без sklearn возвращается индекс только с нормализованными названиями
+    (vectorizer и tfidf равны None) — поиск тогда идёт через fallback.
+
+    При workers > 1 каталог делится на непрерывные куски, которые
+    нормализуются, подсчитываются и векторизуются в пуле процессов
+    (см. _build_catalog_index_parallel); результат совпадает с однопроцессным.
+
+    Args:
+        cat_ids: Идентификаторы товаров каталога
+        cat_titles: Названия товаров каталога
+        features: Режим признаков "vocab" или "hashing" (по умолчанию TFIDF_FEATURES)
+        workers: Число процессов для сборки
+
+    Returns:
+        CatalogIndex
+    """
+    if workers > 1 and len(cat_titles) >= 2 * workers:
+        return _build_catalog_index_parallel(cat_ids, cat_titles, features, workers)
+    cat_norm = [normalize_text_cached(t) for t in cat_titles]
+    cat_norm = safe_fill_empty(cat_norm, cat_titles)
+    if not tfidf_available():
+        return CatalogIndex(list(cat_ids), list(cat_titles), cat_norm, None, None)
+    vectorizer = _fit_vectorizer(cat_norm, features=features)
+    cat_tfidf = vectorizer.transform(cat_norm).tocsr()
+    return CatalogIndex(list(cat_ids), list(cat_titles), cat_norm, vectorizer, cat_tfidf)
+
+def _split_rows(items, parts):
+    """Делит список на parts непрерывных кусков почти равной длины."""
+    bounds = np.linspace(0, len(items), parts + 1).astype(int)
+    return [items[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+def _normalize_shard(titles):
+    """Нормализует кусок каталога в процессе-воркере."""
+    return [normalize_text_cached(t) for t in titles]
+
+def _shard_document_frequency(task):
+    """
+    Документная частота признаков куска каталога в процессе-воркере.
+
+    Returns:
+        np.ndarray по корзинам для HashingTfidf, иначе словарь n-грамма → df
+    """
+    vectorizer, docs = task
+    if isinstance(vectorizer, HashingTfidf):
+        return vectorizer.document_frequency(docs)
+    analyze = vectorizer.build_analyzer()
+    df = {}
+    for doc in docs:
+        for g in set(analyze(doc)):
+            df[g] = df.get(g, 0) + 1
+    return df
+
+def _init_transform_worker(vectorizer):
+    """Initializer пула векторизации: обученный векторизатор передаётся воркеру один раз."""
+    _WORKER_STATE["vectorizer"] = vectorizer
+
+def _transform_shard(docs):
+    """Векторизует кусок каталога в процессе-воркере."""
+    return _WORKER_STATE["vectorizer"].transform(docs).tocsr()
+
+def _fit_vectorizer_parallel(executor, shards, n_docs, features=None):
+    """
+    Обучает векторизатор по кускам: df считается в воркерах и суммируется.
+
+    Словарь собирается так же, как в TfidfVectorizer.fit — признаки в порядке
+    сортировки, IDF через smooth_idf, — поэтому векторизатор совпадает
+    с _fit_vectorizer по всем строкам сразу.
+
+    Args:
+        executor: Пул процессов
+        shards: Куски нормализованных названий
+        n_docs: Общее число названий
+        features: Режим признаков (по умолчанию TFIDF_FEATURES)
+
+    Returns:
+        Обученный TfidfVectorizer / HashingTfidf или None, если char n-грамм нет
+    """
+    dtype = np.dtype(TFIDF_DTYPE).type
+    if (features or TFIDF_FEATURES) == "hashing":
+        vectorizer = HashingTfidf('char_wb', TFIDF_CHAR_NGRAM, dtype=dtype)
+        df = sum(executor.map(_shard_document_frequency, [(vectorizer, docs) for docs in shards]))
+        if not df.any():
+            return None
+        vectorizer.idf_ = smooth_idf(df, n_docs, dtype)
+        return vectorizer
+    template = TfidfVectorizer(analyzer='char_wb', ngram_range=TFIDF_CHAR_NGRAM, min_df=1, dtype=dtype)
+    total = {}
+    for part in executor.map(_shard_document_frequency, [(template, docs) for docs in shards]):
+        for g, n in part.items():
+            total[g] = total.get(g, 0) + n
+    if not total:
+        return None
+    vocab = sorted(total)
+    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=TFIDF_CHAR_NGRAM, min_df=1, dtype=dtype,
+                                 vocabulary={g: j for j, g in enumerate(vocab)})
+    vectorizer.idf_ = smooth_idf([total[g] for g in vocab], n_docs, dtype)
+    return vectorizer
+
+def _build_catalog_index_parallel(cat_ids, cat_titles, features, workers):
+    """
+    build_catalog_index в пуле процессов: нормализация, df и transform по кускам,
+    матрица каталога собирается sparse.vstack.
+
+    Returns:
+        CatalogIndex
+    """
+    title_shards = _split_rows(list(cat_titles), workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        raw = [n for part in executor.map(_normalize_shard, title_shards) for n in part]
+        # кэш родителя не видел этих вызовов — переносим результаты (для --norm-cache и повторов)
+        normalize_text_cached.update(zip(cat_titles, raw))
+        cat_norm = safe_fill_empty(raw, cat_titles)
+        if not tfidf_available():
+            return CatalogIndex(list(cat_ids), list(cat_titles), cat_norm, None, None)
+        norm_shards = _split_rows(cat_norm, workers)
+        vectorizer = _fit_vectorizer_parallel(executor, norm_shards, len(cat_norm), features)
+    if vectorizer is None:
+        # без char n-грамм — word n-grams, как в _fit_vectorizer
+        vectorizer = _fit_vectorizer(cat_norm, features=features)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_transform_worker,
+                             initargs=(vectorizer,)) as executor:
+        cat_tfidf = sparse.vstack(list(executor.map(_transform_shard, norm_shards)), format="csr")
+    print(f"[DEBUG] Built catalog index in {workers} processes: {cat_tfidf.shape[0]} rows")
+    return CatalogIndex(list(cat_ids), list(cat_titles), cat_norm, vectorizer, cat_tfidf)
+
+def _save_npy(path, arr):
+    """
+    Атомарно сохраняет массив: пишет во временный файл и переименовывает.
+
+    Старый файл может быть отображён в память текущим индексом — замена через
+    os.replace не трогает его inode, поэтому открытые mmap остаются валидными.
+    """
+    tmp = Path(str(path) + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, np.asarray(arr))
+    os.replace(tmp, path)
+
+@STATS.timed()
+def save_catalog_index(index, path=INDEX_DIR):
+    """
+    Сохраняет индекс каталога на диск.
+
+    Структура каталога path:
+        tfidf_data.npy, tfidf_indices.npy, tfidf_indptr.npy — CSR матрица
+        idf.npy — вектор IDF
+        deleted.npy — битовая маска удалённых строк
+        meta.json — параметры векторизатора, словарь, ids, titles, norm
+
+    Args:
+        index: CatalogIndex для сохранения
+        path: Каталог для файлов индекса (создаётся при необходимости)
+
+    Raises:
+        RuntimeError: Если у индекса нет TF-IDF (sklearn недоступен)
+    """
+    if index.tfidf is None:
+        raise RuntimeError("Catalog index requires scikit-learn")
+    p = Path(path)
+    p.mkdir(parents=True, exist_ok=True)
+    m = index.tfidf.tocsr()
+    _save_npy(p / "tfidf_data.npy", m.data)
+    _save_npy(p / "tfidf_indices.npy", m.indices)
+    _save_npy(p / "tfidf_indptr.npy", m.indptr)
+    _save_npy(p / "idf.npy", index.vectorizer.idf_)
+    _save_npy(p / "deleted.npy", index.deleted)
+    vec = index.vectorizer
+    meta = {
+        "version": INDEX_FORMAT_VERSION,
+        "shape": list(m.shape),
+        "n_appended": index.n_appended,
+        "vectorizer": {
+            "features": vectorizer_features(vec),
+            "analyzer": vec.analyzer,
+            "ngram_range": list(vec.ngram_range),
+            "token_pattern": vec.token_pattern,
+            "n_features": getattr(vec, "n_features", None),
+        },
+        # в режиме hashing словаря нет: признаки восстанавливаются хэшем
+        "vocabulary": ({k: int(v) for k, v in vec.vocabulary_.items()}
+                       if vectorizer_features(vec) == "vocab" else None),
+        "ids": index.ids,
+        "titles": index.titles,
+        "norm": index.norm,
+    }
+    tmp = p / "meta.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, p / "meta.json")
+    print(f"[INFO] Saved catalog index ({m.shape[0]} rows, {m.shape[1]} features) to {path}")
+
+@STATS.timed()
+def load_catalog_index(path=INDEX_DIR, mmap=True):
+    """
+    Загружает индекс каталога, сохранённый save_catalog_index.
+
+    CSR массивы открываются через np.load(mmap_mode='r'): страницы матрицы
+    подгружаются ОС по мере обращения и разделяются между процессами.
+
+    Args:
+        path: Каталог с файлами индекса
+        mmap: Отображать массивы в память вместо полного чтения
+
+    Returns:
+        CatalogIndex
+
+    Raises:
+        FileNotFoundError: Если индекс не найден
+        RuntimeError: Если sklearn недоступен
+        ValueError: Если версия формата не поддерживается
+    """
+    if not tfidf_available():
+        raise RuntimeError("Catalog index requires scikit-learn")
+    p = Path(path)
+    if not (p / "meta.json").exists():
+        raise FileNotFoundError(f"Catalog index not found: {path}")
+    with open(p / "meta.json", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != INDEX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported catalog index version: {meta.get('version')}")
+
+    mode = 'r' if mmap else None
+    data = np.load(p / "tfidf_data.npy", mmap_mode=mode)
+    indices = np.load(p / "tfidf_indices.npy", mmap_mode=mode)
+    indptr = np.load(p / "tfidf_indptr.npy", mmap_mode=mode)
+    tfidf = sparse.csr_matrix((data, indices, indptr), shape=tuple(meta["shape"]), copy=False)
+
+    params = meta["vectorizer"]
+    if params.get("features", "vocab") == "hashing":
+        vectorizer = HashingTfidf(params["analyzer"], params["ngram_range"], params["token_pattern"],
+                                  n_features=params["n_features"], dtype=data.dtype.type,
+                                  idf=np.load(p / "idf.npy"))
+    else:
+        vectorizer = TfidfVectorizer(
+            analyzer=params["analyzer"],
+            ngram_range=tuple(params["ngram_range"]),
+            token_pattern=params["token_pattern"],
+            vocabulary=meta["vocabulary"],
+            dtype=data.dtype.type,   # индексы до float32 хранят float64 — новые строки в том же типе
+        )
+        vectorizer.idf_ = np.load(p / "idf.npy")
+    deleted = np.load(p / "deleted.npy")
+    print(f"[DEBUG] Loaded catalog index from {path}: {tfidf.shape[0]} rows, {int(deleted.sum())} deleted")
+    return CatalogIndex(meta["ids"], meta["titles"], meta["norm"], vectorizer, tfidf,
+                        deleted=deleted, n_appended=meta["n_appended"])
+
+def delete_from_catalog_index(index, ids):
+    """
+    Помечает товары каталога удалёнными (tombstone) без пересборки матрицы.
+
+    Args:
+        index: CatalogIndex
+        ids: Идентификаторы удаляемых товаров
+
+    Returns:
+        Количество реально помеченных строк (неизвестные и уже удалённые id пропускаются)
+    """
+    wanted = set(ids)
+    rows = [j for j, cid in enumerate(index.ids) if cid in wanted and not index.deleted[j]]
+    index.deleted[rows] = True
+    return len(rows)
+
+def append_to_catalog_index(index, ids, titles):
+    """
+    Дописывает товары в индекс с замороженным словарём и IDF.
+
+    Новые строки сразу доступны для поиска. Если id уже есть в индексе,
+    старая строка помечается удалённой (обновление = удаление + добавление).
+
+    Args:
+        index: CatalogIndex
+        ids: Идентификаторы новых товаров каталога
+        titles: Их названия
+
+    Returns:
+        Количество добавленных строк
+
+    Raises:
+        RuntimeError: Если у индекса нет TF-IDF (sklearn недоступен)
+    """
+    if not ids:
+        return 0
+    if index.tfidf is None:
+        raise RuntimeError("Catalog index requires scikit-learn")
+    delete_from_catalog_index(index, ids)
+    norm = [normalize_text_cached(t) for t in titles]
+    norm = safe_fill_empty(norm, titles)
+    add_tfidf = index.vectorizer.transform(norm)
+    index.tfidf = sparse.vstack([index.tfidf, add_tfidf], format="csr")
+    index.ids = list(index.ids) + list(ids)
+    index.titles = list(index.titles) + list(titles)
+    index.norm = list(index.norm) + norm
+    index.deleted = np.concatenate([index.deleted, np.zeros(len(ids), dtype=bool)])
+    index.n_appended += len(ids)
+    index.lsh = None
+    index.token_index = None
+    index.blocks = None
+    index.tokens = None
+    index.exact = None
+    index.specs = None
+    return len(ids)
+
+def needs_compaction(index, ratio=INDEX_COMPACT_RATIO):
+    """
+    Проверяет, накопилось ли достаточно изменений для пересборки индекса.
+
+    Args:
+        index: CatalogIndex
+        ratio: Допустимая доля удалённых и дописанных строк
+
+    Returns:
+        True, если индекс стоит компактировать
+    """
+    n = len(index.ids)
+    return n > 0 and (int(index.deleted.sum()) + index.n_appended) / n > ratio
+
+def compact_catalog_index(index, workers=1):
+    """
+    Пересобирает индекс по живым строкам: физически удаляет tombstones
+    и переобучает словарь/IDF (устраняет дрейф IDF от дописанных строк).
+
+    Args:
+        index: CatalogIndex
+        workers: Число процессов для сборки (см. build_catalog_index)
+
+    Returns:
+        Новый CatalogIndex
+    """
+    live = index.live_rows()
+    features = vectorizer_features(index.vectorizer) if index.vectorizer is not None else None
+    return build_catalog_index([index.ids[j] for j in live], [index.titles[j] for j in live], features, workers)
+
+# ----------------- Функция 11: Точная оценка кандидатов -----------------
+def score_new_item(i, cand_list, cat_ids, cat_titles, cat_norm, new_titles, new_norm, lex_scores=None):
+    """
+    Точно оценивает кандидатов одного нового товара и фильтрует по порогу.
+
+    Args:
+        i: Индекс нового товара
+        cand_list: Кандидаты [(индекс_в_каталоге, грубая_оценка), ...]
+        cat_ids: Идентификаторы товаров каталога
+        cat_titles: Названия товаров каталога
+        cat_norm: Нормализованные названия каталога
+        new_titles: Названия новых товаров
+        new_norm: Нормализованные названия новых товаров
+        lex_scores: Заранее вычисленные lexical_score для cand_list (или None)
+
+    Returns:
+        Словарь {"new_title", "new_norm", "matches"} для JSON результата
+    """
+    detailed = []
+    a_norm = new_norm[i]
+    for pos, (idx, coarse_sim) in enumerate(cand_list):
+        b_norm = cat_norm[idx]
+        pre_lex = lex_scores[pos] if lex_scores is not None else None
+        lex, tfidf_norm, combined = compute_combined_score(a_norm, b_norm, coarse_sim, pre_lex)
+        detailed.append({
+            "catalog_id": cat_ids[idx],
+            "catalog_title": cat_titles[idx],
+            "catalog_norm": b_norm,
+            "score_components": {"lexical": lex, "tfidf": tfidf_norm},
+            "score": combined
+        })
+    # фильтрация по порогу
+    filtered = [d for d in detailed if d["score"] >= SIMILARITY_THRESHOLD]
+    filtered.sort(key=lambda x: x["score"], reverse=True)
+    return {
+        "new_title": new_titles[i],
+        "new_norm": a_norm,
+        "matches": filtered
+    }
+
+def prune_candidates(cand_lists, new_tokens, cat_tokens, threshold=SIMILARITY_THRESHOLD):
+    """
+    Убирает кандидатов, чья верхняя граница оценки ниже порога.
+
+    Кандидаты идут по убыванию грубой оценки, поэтому, как только даже
+    lexical = 1 не дотягивает до порога (0.6 + 0.4·coarse < threshold),
+    остаток списка отбрасывается целиком; остальные проверяются через
+    combined_upper_bound. Итоговые совпадения не меняются: отброшенные
+    кандидаты всё равно не прошли бы фильтр score_new_item.
+
+    Args:
+        cand_lists: Кандидаты [(индекс_в_каталоге, грубая_оценка), ...] для каждого нового товара
+        new_tokens: TokenizedTitles новых товаров
+        cat_tokens: TokenizedTitles каталога
+        threshold: Порог итоговой оценки
+
+    Returns:
+        Новые списки кандидатов (порядок сохраняется)
+    """
+    floor = threshold - PRUNE_MARGIN
+    min_coarse = (floor - 0.6) / 0.4
+    cat_sets, cat_lengths = cat_tokens.sets, cat_tokens.lengths
+    out = []
+    for i, cands in enumerate(cand_lists):
+        a_set, a_len = new_tokens.sets[i], new_tokens.lengths[i]
+        kept = []
+        for idx, sim in cands:
+            if sim < min_coarse:
+                break
+            if combined_upper_bound(sim, a_set, cat_sets[idx], a_len, cat_lengths[idx]) >= floor:
+                kept.append((idx, sim))
+        out.append(kept)
+    return out
+
+def filter_exact_hits(hits, new_titles, cat_titles, blocking=USE_BLOCKING, cat_specs=None):
+    """
+    Отбрасывает точные совпадения, которые отверг бы обычный конвейер.
+
+    При blocking строка каталога должна быть в блоке нового товара
+    (известные у обоих ключи extract_block_keys совпадают, как в
+    CatalogBlocks.mask); при SPEC_FILTER пара не должна противоречить по
+    характеристикам (spec_conflicts). Ключи и характеристики извлекаются
+    только для строк из hits.
+
+    Args:
+        hits: Словарь индекс_нового_товара → строки каталога (ExactMatchIndex.lookup)
+        new_titles: Исходные названия новых товаров
+        cat_titles: Исходные названия каталога
+        blocking: Проверять ключи блокировки
+        cat_specs: Готовые CatalogSpecs каталога (или None — только по строкам hits)
+
+    Returns:
+        Словарь того же вида без отвергнутых строк и без товаров, у которых строк не осталось
+    """
+    if blocking:
+        out = {}
+        for i, rows in hits.items():
+            keys = extract_block_keys(new_titles[i])
+            rows = [j for j in rows
+                    if not any(a is not None and b is not None and a != b
+                               for a, b in zip(keys, extract_block_keys(cat_titles[j])))]
+            if rows:
+                out[i] = rows
+        hits = out
+    if SPEC_FILTER and hits:
+        items = list(hits)
+        cand_lists = [[(j, 1.0) for j in hits[i]] for i in items]
+        if cat_specs is None:
+            cat_specs = CatalogSpecs(cat_titles, rows=candidate_rows(cand_lists))
+        cand_lists, n_rejected = reject_spec_conflicts(cand_lists, CatalogSpecs([new_titles[i] for i in items]),
+                                                       cat_specs)
+        STATS.count("candidates_rejected_specs", n_rejected)
+        hits = {i: [j for j, _ in cands] for i, cands in zip(items, cand_lists) if cands}
+    return hits
+
+def exact_match_result(i, rows, cat_ids, cat_titles, cat_norm, new_titles, new_norm):
+    """
+    Результат нового товара с точными совпадениями (ExactMatchIndex) в формате score_new_item.
+
+    Args:
+        i: Индекс нового товара
+        rows: Строки каталога с той же сигнатурой токенов
+        cat_ids, cat_titles, cat_norm: Данные каталога
+        new_titles, new_norm: Данные новых товаров
+
+    Returns:
+        Словарь {"new_title", "new_norm", "matches"}, у всех совпадений score 1.0
+    """
+    return {
+        "new_title": new_titles[i],
+        "new_norm": new_norm[i],
+        "matches": [{
+            "catalog_id": cat_ids[idx],
+            "catalog_title": cat_titles[idx],
+            "catalog_norm": cat_norm[idx],
+            "score_components": {"lexical": 1.0, "tfidf": 1.0},
+            "score": 1.0,
+        } for idx in rows],
+    }
+
+def score_items(start, cand_lists, cat_ids, cat_titles, cat_norm, new_titles, new_norm, lex_workers=-1,
+                cat_sets=None, new_sets=None):
+    """
+    Оценивает отрезок новых товаров [start, start + len(cand_lists)).
+
+    При BATCH_LEXICAL все пары (новый товар, кандидат) отрезка собираются
+    в плоские списки и оцениваются одним вызовом batch_lexical_scores
+    (batch_lexical_scores_tokenized, если переданы множества токенов).
+
+    Args:
+        start: Индекс первого нового товара отрезка
+        cand_lists: Кандидаты для каждого товара отрезка
+        cat_ids, cat_titles, cat_norm: Данные каталога
+        new_titles, new_norm: Данные новых товаров
+        lex_workers: Потоки rapidfuzz для пакетной оценки
+        cat_sets, new_sets: TokenizedTitles.sets каталога и новых товаров (или None)
+
+    Returns:
+        Список результатов score_new_item
+    """
+    lex_lists = [None] * len(cand_lists)
+    if BATCH_LEXICAL:
+        a_flat = [new_norm[start + off] for off, cands in enumerate(cand_lists) for _ in cands]
+        b_flat = [cat_norm[idx] for cands in cand_lists for idx, _ in cands]
+        if cat_sets is not None and new_sets is not None:
+            a_sets = [new_sets[start + off] for off, cands in enumerate(cand_lists) for _ in cands]
+            b_sets = [cat_sets[idx] for cands in cand_lists for idx, _ in cands]
+            flat = batch_lexical_scores_tokenized(a_flat, b_flat, a_sets, b_sets, lex_workers)
+        else:
+            flat = batch_lexical_scores(a_flat, b_flat, lex_workers)
+        pos = 0
+        for off, cands in enumerate(cand_lists):
+            lex_lists[off] = flat[pos:pos + len(cands)]
+            pos += len(cands)
+    return [score_new_item(start + off, cands, cat_ids, cat_titles, cat_norm,
+                           new_titles, new_norm, lex_lists[off])
+            for off, cands in enumerate(cand_lists)]
+
+# Строки каталога передаются воркеру один раз через initializer и живут в нём
+# всё время работы пула (ScoringPool), а не с каждой задачей или пакетом:
+# задачи несут только свой отрезок новых товаров, списки кандидатов и
+# множества токенов тех строк каталога, что в них встречаются.
+_WORKER_STATE = {}
+
+def _init_scoring_worker(cat_ids, cat_titles, cat_norm):
+    """Initializer ProcessPoolExecutor: сохраняет каталог в глобальном состоянии воркера."""
+    _WORKER_STATE.update(cat_ids=cat_ids, cat_titles=cat_titles, cat_norm=cat_norm)
+
+def _score_shard(shard):
+    """Оценивает отрезок новых товаров в процессе-воркере."""
+    cand_lists, new_titles, new_norm, cat_sets, new_sets = shard
+    st = _WORKER_STATE
+    # параллелизм уже обеспечен пулом процессов — rapidfuzz внутри воркера однопоточный
+    return score_items(0, cand_lists, st["cat_ids"], st["cat_titles"], st["cat_norm"],
+                       new_titles, new_norm, lex_workers=1, cat_sets=cat_sets, new_sets=new_sets)
+
+class ScoringPool:
+    """
+    Пул процессов точной оценки, переживающий вызовы process_all.
+
+    Каталог пересылается воркерам один раз — при первом map или после смены
+    каталога (другой список cat_norm или его длина), поэтому пакеты потокового
+    режима и повторные вызовы не сериализуют каталог заново.
+
+    Attributes:
+        workers: Количество процессов
+    """
+
+    def __init__(self, workers):
+        self.workers = int(workers)
+        self._executor = None
+        self._catalog = self._cat_ref = None
+
+    def _ensure(self, cat_ids, cat_titles, cat_norm):
+        if self._executor is not None and self._catalog == (id(cat_norm), len(cat_norm)):
+            return
+        self.close()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_scoring_worker,
+                                             initargs=(cat_ids, cat_titles, cat_norm))
+        self._catalog = (id(cat_norm), len(cat_norm))
+        self._cat_ref = cat_norm   # держит id(cat_norm) занятым, пока пул привязан к каталогу
+
+    def map(self, cand_lists, cat_ids, cat_titles, cat_norm, new_titles, new_norm, cat_sets=None, new_sets=None):
+        """
+        Оценивает новые товары в воркерах пула.
+
+        Новые товары делятся на непрерывные отрезки (по ~4 на воркер для
+        балансировки), executor.map возвращает их в исходном порядке.
+
+        Args:
+            cand_lists: Кандидаты для каждого нового товара
+            cat_ids, cat_titles, cat_norm: Данные каталога
+            new_titles, new_norm: Данные новых товаров
+            cat_sets, new_sets: Множества токенов (см. score_items)
+
+        Returns:
+            Список результатов score_new_item в порядке новых товаров
+        """
+        self._ensure(cat_ids, cat_titles, cat_norm)
+        n = len(cand_lists)
+        step = max(1, -(-n // (self.workers * 4)))
+        shards = []
+        for start in range(0, n, step):
+            part = cand_lists[start:start + step]
+            stop = start + len(part)
+            part_sets = None
+            if cat_sets is not None and new_sets is not None:
+                part_sets = {idx: cat_sets[idx] for cands in part for idx, _ in cands}
+            shards.append((part, new_titles[start:stop], new_norm[start:stop], part_sets,
+                           new_sets[start:stop] if part_sets is not None else None))
+        return [item for part in self._executor.map(_score_shard, shards) for item in part]
+
+    def close(self):
+        """Останавливает процессы пула."""
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = self._catalog = self._cat_ref = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def score_candidates_parallel(cand_lists, cat_ids, cat_titles, cat_norm, new_titles, new_norm, workers,
+                              cat_sets=None, new_sets=None):
+    """
+    Оценивает новые товары во временном ScoringPool (на один вызов).
+
+    Args:
+        cand_lists: Кандидаты для каждого нового товара
+        cat_ids, cat_titles, cat_norm: Данные каталога
+        new_titles, new_norm: Данные новых товаров
+        workers: Количество процессов
+        cat_sets, new_sets: Множества токенов (см. score_items)
+
+    Returns:
+        Список результатов score_new_item в порядке новых товаров
+    """
+    with ScoringPool(workers) as pool:
+        return pool.map(cand_lists, cat_ids, cat_titles, cat_norm, new_titles, new_norm, cat_sets, new_sets)
+
+# ----------------- Функция 12: MinHash-LSH индекс кандидатов -----------------
+# Приближённая альтернатива полному перебору каталога: сигнатуры MinHash по
+# символьным шинглам нормализованных названий режутся на LSH_BANDS полос по
+# LSH_ROWS значений; кандидатами считаются строки, совпавшие с запросом хотя бы
+# в одной полосе. Вероятность попасть в кандидаты для пары с Jaccard s равна
+# 1 - (1 - s^rows)^bands: больше полос — выше recall, больше строк — меньше
+# кандидатов и быстрее поиск.
+
+LSH_PRIME = (1 << 31) - 1
+LSH_SIGNATURE_CHUNK = 2048   # документов на блок при вычислении сигнатур
+
+def _shingle_hashes(text, n=LSH_SHINGLE):
+    """Хэши (crc32) уникальных символьных шинглов длины n; короткая строка — один шингл."""
+    shingles = {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+    return np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64,
+                       count=len(shingles))
+
+class MinHashLSHIndex:
+    """
+    MinHash-LSH индекс над нормализованными названиями каталога.
+
+    Корзины каждой полосы хранятся как отсортированный массив ключей и
+    соответствующих строк каталога; поиск корзины — np.searchsorted.
+
+    Attributes:
+        bands: Количество полос
+        rows: Значений сигнатуры в полосе
+        signatures: Сигнатуры каталога, shape (N, bands * rows), uint32
+    """
+
+    def __init__(self, texts, bands=LSH_BANDS, rows=LSH_ROWS, seed=42):
+        self.bands = int(bands)
+        self.rows = int(rows)
+        rng = np.random.RandomState(seed)
+        n_perm = self.bands * self.rows
+        self._a = rng.randint(1, LSH_PRIME, size=n_perm).astype(np.uint64)
+        self._b = rng.randint(0, LSH_PRIME, size=n_perm).astype(np.uint64)
+        self._mix = rng.randint(1, 2 ** 62, size=self.rows, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+        self.signatures = self.signature(texts)
+        keys = self._band_keys(self.signatures)
+        self._order = np.argsort(keys, axis=0, kind="stable").T          # (bands, N)
+        self._sorted_keys = np.take_along_axis(keys, self._order.T, axis=0).T
+
+    def signature(self, texts):
+        """
+        Вычисляет MinHash сигнатуры для списка строк.
+
+        Args:
+            texts: Нормализованные строки
+
+        Returns:
+            np.ndarray shape (len(texts), bands * rows), dtype uint32
+        """
+        n_perm = self.bands * self.rows
+        out = np.empty((len(texts), n_perm), dtype=np.uint32)
+        for start in range(0, len(texts), LSH_SIGNATURE_CHUNK):
+            parts = [_shingle_hashes(t) for t in texts[start:start + LSH_SIGNATURE_CHUNK]]
+            offsets = np.cumsum([0] + [len(h) for h in parts[:-1]])
+            flat = np.concatenate(parts)
+            hashed = (flat[:, None] * self._a[None, :] + self._b[None, :]) % np.uint64(LSH_PRIME)
+            out[start:start + len(parts)] = np.minimum.reduceat(hashed, offsets, axis=0)
+        return out
+
+    def _band_keys(self, signatures):
+        """Сворачивает значения каждой полосы в один uint64 ключ корзины, shape (M, bands)."""
+        sig = signatures.astype(np.uint64).reshape(len(signatures), self.bands, self.rows)
+        with np.errstate(over="ignore"):
+            return (sig * self._mix).sum(axis=2)
+
+    def candidates(self, signatures, limit=None):
+        """
+        Находит строки каталога, делящие с запросом хотя бы одну корзину.
+
+        Число общих полос растёт с Jaccard, поэтому при пуле больше limit
+        остаются limit строк с наибольшим числом общих полос (при равенстве —
+        с меньшим индексом): частые шинглы не раздувают пул до тысяч строк.
+
+        Args:
+            signatures: Сигнатуры запросов, shape (M, bands * rows)
+            limit: Максимальный размер пула на запрос (None — без ограничения)
+
+        Returns:
+            Список np.ndarray уникальных индексов каталога для каждого запроса
+        """
+        keys = self._band_keys(signatures)
+        lo = np.empty_like(keys, dtype=np.int64)
+        hi = np.empty_like(keys, dtype=np.int64)
+        for b in range(self.bands):
+            lo[:, b] = np.searchsorted(self._sorted_keys[b], keys[:, b], side="left")
+            hi[:, b] = np.searchsorted(self._sorted_keys[b], keys[:, b], side="right")
+        out = []
+        for q in range(len(keys)):
+            parts = [self._order[b, lo[q, b]:hi[q, b]] for b in range(self.bands) if hi[q, b] > lo[q, b]]
+            if not parts:
+                out.append(np.zeros(0, dtype=np.int64))
+                continue
+            rows, hits = np.unique(np.concatenate(parts), return_counts=True)
+            if limit is not None and len(rows) > limit:
+                # rows отсортированы, а argsort stable — при равенстве остаётся меньший индекс
+                rows = np.sort(rows[np.argsort(-hits, kind="stable")[:limit]])
+            out.append(rows)
+        return out
+
+def lsh_candidate_search(lsh, new_norm, top_k=TOP_K_CANDIDATES, new_tfidf=None, cat_tfidf=None, row_mask=None,
+                         limit=LSH_MAX_CANDIDATES, chunk_size=CANDIDATE_CHUNK_SIZE):
+    """
+    Ищет top_k кандидатов через MinHash-LSH вместо полного перебора каталога.
+
+    Кандидаты из корзин LSH (не больше limit на запрос) ранжируются косинусом
+    TF-IDF, если матрицы доступны, иначе — долей совпавших значений сигнатуры
+    (оценка Jaccard по шинглам). Пары (запрос, кандидат) оцениваются пакетом
+    по chunk_size запросов: строки обеих матриц выбираются для всех пар блока
+    сразу и перемножаются поэлементно, без питоновского цикла по запросам.
+    До top_k нулями не дополняется.
+
+    Args:
+        lsh: MinHashLSHIndex каталога
+        new_norm: Нормализованные названия новых товаров
+        top_k: Максимальное количество кандидатов
+        new_tfidf: TF-IDF матрица новых товаров (или None)
+        cat_tfidf: TF-IDF матрица каталога (или None)
+        row_mask: Булева маска допустимых строк каталога (или None)
+        limit: Предел пула корзин на запрос (см. MinHashLSHIndex.candidates)
+        chunk_size: Количество запросов в одном блоке ранжирования
+
+    Returns:
+        Список списков кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    sigs = lsh.signature(new_norm)
+    n_cat = len(lsh.signatures)
+    pools = lsh.candidates(sigs, limit)
+    if row_mask is not None:
+        pools = [rows[row_mask[rows]] for rows in pools]
+    use_tfidf = cat_tfidf is not None and new_tfidf is not None
+    chunk_size = max(1, int(chunk_size))
+    results = []
+    for start in range(0, len(pools), chunk_size):
+        chunk = pools[start:start + chunk_size]
+        lens = [len(rows) for rows in chunk]
+        if not sum(lens):
+            results.extend([] for _ in chunk)
+            continue
+        pair_q = np.repeat(np.arange(start, start + len(chunk)), lens)
+        pair_rows = np.concatenate(chunk)
+        if use_tfidf:
+            scores = np.asarray(cat_tfidf[pair_rows].multiply(new_tfidf[pair_q]).sum(axis=1)).ravel()
+        else:
+            scores = (lsh.signatures[pair_rows] == sigs[pair_q]).mean(axis=1)
+        for rows, part in zip(chunk, np.split(scores, np.cumsum(lens)[:-1])):
+            results.append(_topk_row(rows, part, top_k, n_cat, fill=False))
+    return results
+
+def lsh_recall_report(cat_norm, new_norm, exact_candidates, configs, top_k=TOP_K_CANDIDATES,
+                      new_tfidf=None, cat_tfidf=None):
+    """
+    Сравнивает MinHash-LSH с точным поиском TF-IDF для набора (bands, rows).
+
+    Recall@k — доля точных top_k кандидатов с положительным сходством,
+    найденных LSH. Время — построение индекса и поиск всех запросов.
+
+    Args:
+        cat_norm: Нормализованные названия каталога
+        new_norm: Нормализованные названия новых товаров
+        exact_candidates: Результат batch_candidate_search_tfidf
+        configs: Список пар (bands, rows)
+        top_k: Количество кандидатов
+        new_tfidf, cat_tfidf: TF-IDF матрицы для ранжирования кандидатов LSH
+
+    Returns:
+        Список словарей с полями bands, rows, recall, build_sec, query_sec,
+        avg_candidates (средний размер объединения корзин)
+    """
+    report = []
+    exact_sets = [{j for j, sim in cands if sim > 0} for cands in exact_candidates]
+    for bands, rows in configs:
+        t0 = time.perf_counter()
+        lsh = MinHashLSHIndex(cat_norm, bands=bands, rows=rows)
+        t1 = time.perf_counter()
+        approx = lsh_candidate_search(lsh, new_norm, top_k, new_tfidf, cat_tfidf)
+        t2 = time.perf_counter()
+        found = sum(len(ex & {j for j, _ in ap}) for ex, ap in zip(exact_sets, approx))
+        total = sum(len(ex) for ex in exact_sets)
+        pool = lsh.candidates(lsh.signature(new_norm))
+        report.append({
+            "bands": bands, "rows": rows,
+            "recall": round(found / total, 4) if total else 1.0,
+            "build_sec": round(t1 - t0, 4), "query_sec": round(t2 - t1, 4),
+            "avg_candidates": round(float(np.mean([len(p) for p in pool])), 1) if pool else 0.0,
+        })
+    return report
+
+def run_lsh_report(index, new_titles, out_path, extra=None):
+    """
+    Строит отчёт lsh_recall_report по сетке (bands, rows), печатает и сохраняет в JSON.
+
+    Args:
+        index: CatalogIndex с TF-IDF (точный путь для сравнения)
+        new_titles: Названия новых товаров
+        out_path: Путь JSON отчёта
+        extra: Дополнительная пара (bands, rows) к стандартной сетке
+    """
+    if index.tfidf is None:
+        raise RuntimeError("LSH recall report requires scikit-learn for the exact TF-IDF path")
+    new_norm = safe_fill_empty([normalize_text_cached(t) for t in new_titles], new_titles)
+    new_tfidf = index.vectorizer.transform(new_norm)
+    t0 = time.perf_counter()
+    exact = batch_candidate_search_tfidf(new_tfidf, index.tfidf, TOP_K_CANDIDATES)
+    exact_sec = time.perf_counter() - t0
+    configs = [(8, 2), (16, 4), (32, 4), (20, 5), (16, 8)]
+    if extra is not None and tuple(extra) not in configs:
+        configs.append(tuple(extra))
+    report = {
+        "catalog_size": len(index.ids), "new_items": len(new_titles), "top_k": TOP_K_CANDIDATES,
+        "exact_query_sec": round(exact_sec, 4),
+        "lsh": lsh_recall_report(index.norm, new_norm, exact, configs, TOP_K_CANDIDATES,
+                                 new_tfidf, index.tfidf),
+    }
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] exact TF-IDF search: {report['exact_query_sec']}s")
+    for row in report["lsh"]:
+        print(f"[INFO] LSH bands={row['bands']} rows={row['rows']}: recall={row['recall']} "
+              f"build={row['build_sec']}s query={row['query_sec']}s candidates~{row['avg_candidates']}")
+    print(f"[INFO] Saved LSH report to {out_path}")
+
+# ----------------- Функция 13: Блокировка по бренду/категории/памяти -----------------
+class CatalogBlocks:
+    """
+    Коды ключей блокировки (extract_block_keys) для всех строк каталога.
+
+    Строка каталога попадает в блок нового товара, если по каждому ключу,
+    известному у нового товара, значения совпадают или у строки каталога
+    этот ключ не определён (отсутствие ключа не исключает строку).
+
+    Attributes:
+        codes: Ключ → np.ndarray кодов значений, -1 — ключ не найден
+        vocab: Ключ → словарь значение → код
+    """
+
+    KEYS = ("brand", "category", "storage")
+
+    def __init__(self, cat_titles):
+        n = len(cat_titles)
+        self.vocab = {k: {} for k in self.KEYS}
+        self.codes = {k: np.full(n, -1, dtype=np.int32) for k in self.KEYS}
+        for j, title in enumerate(cat_titles):
+            for k, v in zip(self.KEYS, extract_block_keys(title)):
+                if v is not None:
+                    self.codes[k][j] = self.vocab[k].setdefault(v, len(self.vocab[k]))
+
+    def mask(self, keys):
+        """
+        Булева маска строк каталога из блока с ключами keys.
+
+        Args:
+            keys: Кортеж (brand, category, storage) нового товара
+
+        Returns:
+            np.ndarray bool, или None если у товара нет ни одного ключа (полный перебор)
+        """
+        if all(v is None for v in keys):
+            return None
+        m = None
+        for k, v in zip(self.KEYS, keys):
+            if v is None:
+                continue
+            col = self.codes[k]
+            part = (col == self.vocab[k].get(v, -2)) | (col == -1)
+            m = part if m is None else m & part
+        return m
+
+    def group(self, new_titles, row_mask=None):
+        """
+        Группирует новые товары по ключам блокировки.
+
+        Args:
+            new_titles: Исходные названия новых товаров
+            row_mask: Дополнительная маска допустимых строк каталога (или None)
+
+        Yields:
+            Кортежи (список индексов новых товаров, маска строк каталога или None)
+        """
+        groups = {}
+        for i, title in enumerate(new_titles):
+            groups.setdefault(extract_block_keys(title), []).append(i)
+        for keys, members in groups.items():
+            m = self.mask(keys)
+            if m is None:
+                m = row_mask
+            elif row_mask is not None:
+                m = m & row_mask
+            yield members, m
+
+# ----------------- Функция 14: Самодедупликация каталога -----------------
+CLUSTERS_FILE = "catalog_clusters.json"   # результат --self-dedup по умолчанию
+# Порог пары для кластеров выше SIMILARITY_THRESHOLD: кластеры транзитивны,
+# и цепочка пар по 0.8 склеивает товары, которые друг на друга не похожи
+CLUSTER_THRESHOLD: float = 0.90
+
+class UnionFind:
+    """
+    Система непересекающихся множеств: объединение по размеру, сжатие путей делением пополам.
+
+    Если заданы keys (ключи блокировки каждого элемента, см. extract_block_keys),
+    множество помнит известные значения ключей своих элементов, и union
+    отказывается объединять множества с противоречащими значениями — так
+    цепочка похожих пар не склеивает, например, 4/64 и 8/128 в один кластер.
+    """
+
+    def __init__(self, n, keys=None):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.keys = [tuple(k) for k in keys] if keys is not None else None
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """
+        Объединяет множества a и b.
+
+        Returns:
+            True, если множества объединены или уже совпадали; False при конфликте ключей
+        """
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return True
+        if self.keys is not None:
+            ka, kb = self.keys[ra], self.keys[rb]
+            if any(x is not None and y is not None and x != y for x, y in zip(ka, kb)):
+                return False
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        if self.keys is not None:
+            self.keys[ra] = tuple(x if x is not None else y for x, y in zip(self.keys[ra], self.keys[rb]))
+        return True
+
+def self_join_pairs(index, candidates=CANDIDATE_MODE, blocking=USE_BLOCKING, top_k=TOP_K_CANDIDATES,
+                    threshold=SIMILARITY_THRESHOLD, lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS):
+    """
+    Находит пары почти-дубликатов внутри каталога.
+
+    Строки с одинаковым нормализованным названием и одинаковыми ключами
+    блокировки (extract_block_keys) сразу связываются парами с оценкой 1.0
+    (звездой вокруг первой строки группы), а поиск идёт только по
+    представителям групп. Ключи в группе нужны потому, что нормализация
+    убирает категорию: «Смартфон X» и «Планшет X» дают одну строку, и звезда
+    вокруг телефона была бы целиком отвергнута cluster_pairs. Они ищутся сами по себе тем же
+    поиском кандидатов, что и в process_all (TF-IDF, MinHash-LSH, блокировка),
+    по top_k соседей на название — вместо N² сравнений получается не более
+    N·top_k пар. Пары (i, j) и (j, i) сливаются, затем оцениваются
+    compute_combined_score и фильтруются по threshold.
+
+    Args:
+        index: CatalogIndex каталога
+        candidates: "tfidf" или "lsh"
+        blocking: Искать пары только внутри блоков бренд/категория/память
+        top_k: Соседей на уникальное название
+        threshold: Минимальная итоговая оценка пары
+        lsh_bands, lsh_rows: Параметры MinHashLSHIndex для candidates="lsh"
+
+    Returns:
+        Список кортежей (i, j, score), i < j — позиции в каталоге
+    """
+    groups = {}
+    for i in index.live_rows().tolist():
+        groups.setdefault((index.norm[i], extract_block_keys(index.titles[i])), []).append(i)
+    reps = [rows[0] for rows in groups.values()]
+    pairs = [(rows[0], r, 1.0) for rows in groups.values() for r in rows[1:]]
+    STATS.count("exact_duplicates", len(pairs))
+
+    norm = [index.norm[r] for r in reps]
+    titles = [index.titles[r] for r in reps]
+    tfidf = index.tfidf[reps] if index.tfidf is not None else None
+    token_index = TokenInvertedIndex([set(s.split()) for s in norm]) if tfidf is None else None
+    lsh = MinHashLSHIndex(norm, bands=lsh_bands, rows=lsh_rows) if candidates == "lsh" else None
+
+    with STATS.stage("self_candidates"):
+        # +1: название обычно находит само себя
+        cand_lists = _collect_candidates(None, titles, tfidf, norm, norm, tfidf, titles,
+                                         None, token_index, candidates, lsh, blocking, top_k + 1)
+    coarse = {}
+    for u, cands in enumerate(cand_lists):
+        for v, sim in cands:
+            if v != u:
+                coarse.setdefault((u, v) if u < v else (v, u), sim)
+
+    with STATS.stage("self_scoring"):
+        tokens = TokenizedTitles(norm)
+        sets, lengths = tokens.sets, tokens.lengths
+        keys = list(coarse)
+        if PRUNE_CANDIDATES:
+            floor = threshold - PRUNE_MARGIN
+            keys = [(u, v) for u, v in keys
+                    if combined_upper_bound(coarse[(u, v)], sets[u], sets[v], lengths[u], lengths[v]) >= floor]
+            STATS.count("pairs_pruned", len(coarse) - len(keys))
+        if SPEC_FILTER and keys:
+            specs = CatalogSpecs(titles)
+            conflict = spec_conflicts(specs, specs, np.array([u for u, _ in keys]), np.array([v for _, v in keys]))
+            keys = [key for key, bad in zip(keys, conflict.tolist()) if not bad]
+            STATS.count("pairs_rejected_specs", int(conflict.sum()))
+        STATS.count("pairs_scored", len(keys))
+        lex = batch_lexical_scores_tokenized([norm[u] for u, _ in keys], [norm[v] for _, v in keys],
+                                             [sets[u] for u, _ in keys], [sets[v] for _, v in keys])
+        for (u, v), l in zip(keys, lex):
+            score = compute_combined_score(norm[u], norm[v], coarse[(u, v)], l)[2]
+            if score >= threshold:
+                i, j = reps[u], reps[v]
+                pairs.append((i, j, score) if i < j else (j, i, score))
+    return pairs
+
+def cluster_pairs(n, pairs, keys=None):
+    """
+    Объединяет пары дубликатов в кластеры через UnionFind.
+
+    Пары объединяются от лучшей оценки к худшей; при заданных keys пара,
+    соединяющая кластеры с разными брендом/категорией/памятью, пропускается.
+    Каноническим представителем кластера выбирается строка с наибольшей
+    суммой оценок своих пар внутри кластера (самая «центральная»),
+    при равенстве — встретившаяся в каталоге раньше.
+
+    Args:
+        n: Число строк каталога
+        pairs: Пары (i, j, score) из self_join_pairs
+        keys: Ключи блокировки строк каталога (или None — без проверки)
+
+    Returns:
+        Список кластеров (canonical, members, pairs): members — позиции по
+        возрастанию, pairs — пары внутри кластера; кластеры по убыванию размера
+    """
+    uf = UnionFind(n, keys)
+    for i, j, _ in sorted(pairs, key=lambda p: (-p[2], p[0], p[1])):
+        uf.union(i, j)
+    weight = {}
+    edges = {}
+    for p in pairs:
+        root = uf.find(p[0])
+        if root != uf.find(p[1]):
+            continue
+        edges.setdefault(root, []).append(p)
+        weight[p[0]] = weight.get(p[0], 0.0) + p[2]
+        weight[p[1]] = weight.get(p[1], 0.0) + p[2]
+    members = {}
+    for i in sorted(weight):
+        members.setdefault(uf.find(i), []).append(i)
+    clusters = []
+    for root, rows in members.items():
+        canonical = max(rows, key=lambda r: (weight[r], -r))
+        clusters.append((canonical, rows, edges[root]))
+    clusters.sort(key=lambda c: (-len(c[1]), c[1][0]))
+    return clusters
+
+def find_catalog_clusters(index, candidates=CANDIDATE_MODE, blocking=USE_BLOCKING,
+                          threshold=CLUSTER_THRESHOLD, lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS):
+    """
+    Самодедупликация каталога: пары дубликатов и их кластеры.
+
+    Args:
+        index: CatalogIndex каталога
+        candidates, blocking: Как в process_all
+        threshold: Минимальная оценка пары для объединения в кластер
+        lsh_bands, lsh_rows: Параметры MinHash-LSH для candidates="lsh"
+
+    Returns:
+        Список словарей кластеров, готовый для сохранения в JSON
+    """
+    pairs = self_join_pairs(index, candidates, blocking, threshold=threshold,
+                            lsh_bands=lsh_bands, lsh_rows=lsh_rows)
+    with STATS.stage("clustering"):
+        keys = [extract_block_keys(t) for t in index.titles]
+        clusters = cluster_pairs(len(index.ids), pairs, keys)
+    STATS.count("clusters", len(clusters))
+    ids, titles = index.ids, index.titles
+    return [
+        {
+            "canonical_id": ids[canonical],
+            "canonical_title": titles[canonical],
+            "size": len(rows),
+            "members": [{"catalog_id": ids[r], "catalog_title": titles[r]} for r in rows],
+            "pairs": [{"a": ids[i], "b": ids[j], "score": score} for i, j, score in edges],
+        }
+        for canonical, rows, edges in clusters
+    ]
+
+def save_clusters(clusters, out_path=CLUSTERS_FILE, gzip_output=None):
+    """
+    Сохраняет кластеры дубликатов каталога в JSON (gzip по расширению .gz или флагу).
+
+    Args:
+        clusters: Результат find_catalog_clusters
+        out_path: Путь к выходному файлу
+        gzip_output: Сжимать gzip (None — по расширению)
+    """
+    with _open_output(out_path, gzip_output) as f:
+        json.dump({"clusters": clusters}, f, ensure_ascii=False, indent=2)
+    print(f"[INFO] Saved {len(clusters)} duplicate clusters to {out_path}")
+
+# ----------------- Функция 15: Шардированный поиск по каталогу -----------------
+# Для каталога, чья матрица не помещается в один процесс: каждый процесс-шард
+# читает из сохранённого индекса (mmap) только свой непрерывный кусок строк,
+# координатор рассылает всем шардам матрицу новых товаров и сливает их
+# top-k списки кучей. Результат совпадает с batch_candidate_search_tfidf.
+
+def load_catalog_shard(path, lo, hi):
+    """
+    Читает строки [lo, hi) TF-IDF матрицы сохранённого индекса.
+
+    meta.json (словарь, названия) не читается: число признаков берётся
+    из длины idf.npy, а с диска загружаются только страницы нужных строк.
+
+    Args:
+        path: Каталог индекса (см. save_catalog_index)
+        lo, hi: Границы куска строк
+
+    Returns:
+        CSR матрица shape (hi - lo, V)
+    """
+    p = Path(path)
+    indptr = np.load(p / "tfidf_indptr.npy", mmap_mode='r')
+    start, end = int(indptr[lo]), int(indptr[hi])
+    data = np.array(np.load(p / "tfidf_data.npy", mmap_mode='r')[start:end])
+    indices = np.array(np.load(p / "tfidf_indices.npy", mmap_mode='r')[start:end])
+    n_features = len(np.load(p / "idf.npy", mmap_mode='r'))
+    return sparse.csr_matrix((data, indices, np.asarray(indptr[lo:hi + 1]) - start), shape=(hi - lo, n_features))
+
+def _catalog_shard_loop(conn, path, lo, hi):
+    """
+    Цикл процесса-шарда: держит свой кусок каталога и отвечает на запросы поиска.
+
+    Запрос — (new_tfidf, top_k, row_mask куска или None), ответ — ненулевые
+    top-k кандидаты с глобальными индексами или исключение; None завершает цикл.
+    """
+    tfidf_available()
+    shard = load_catalog_shard(path, lo, hi)
+    conn.send(shard.shape[0])
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:   # координатор завершился, не вызвав close()
+            break
+        if msg is None:
+            break
+        new_tfidf, top_k, mask = msg
+        try:
+            found = batch_candidate_search_tfidf(new_tfidf, shard, top_k, row_mask=mask, fill=False)
+            if found is None:
+                raise RuntimeError(f"shard [{lo}, {hi}) search failed")
+            conn.send([[(lo + j, score) for j, score in cands] for cands in found])
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+def merge_topk(shard_lists, top_k, n_cat, row_mask=None):
+    """
+    Сливает отсортированные top-k списки шардов в глобальный top-k.
+
+    Порядок как у _topk_row: по убыванию сходства, при равенстве — по
+    возрастанию индекса; если ненулевых кандидатов меньше top_k, список
+    дополняется нулевыми кандидатами с наименьшими допустимыми индексами.
+
+    Args:
+        shard_lists: Для каждого шарда — списки кандидатов по новым товарам
+        top_k: Количество кандидатов
+        n_cat: Размер каталога
+        row_mask: Булева маска допустимых строк каталога (или None)
+
+    Returns:
+        Список списков кортежей (индекс_в_каталоге, оценка_сходства)
+    """
+    k = min(top_k, n_cat if row_mask is None else int(np.count_nonzero(row_mask)))
+    results = []
+    for lists in zip(*shard_lists):
+        best = list(heapq.merge(*lists, key=lambda c: (-c[1], c[0])))[:k]
+        if len(best) < k:
+            present = {j for j, _ in best}
+            j = 0
+            while len(best) < k:
+                if j not in present and (row_mask is None or row_mask[j]):
+                    best.append((j, 0.0))
+                j += 1
+        results.append(best)
+    return results
+
+class CatalogShards:
+    """
+    Пул процессов-шардов для TF-IDF поиска кандидатов по сохранённому индексу.
+
+    Каталог делится на n_shards непрерывных кусков строк; каждый процесс
+    держит в памяти только свой кусок и его транспонированную копию, так что
+    пиковая память одного процесса — примерно 1/n_shards матрицы каталога.
+    Координатору (process_all с index.shards) матрица каталога не нужна:
+    он векторизует новые товары, рассылает их шардам и сливает ответы
+    merge_topk. Шарды обслуживают индекс в том виде, в каком он сохранён
+    на диске; удалённые строки исключаются маской координатора.
+
+    Использование:
+        index = load_catalog_index(path)
+        with CatalogShards(path, 4) as index.shards:
+            process_all([], [], new_ids, new_titles, index=index)
+    """
+
+    def __init__(self, path, n_shards):
+        indptr = np.load(Path(path) / "tfidf_indptr.npy", mmap_mode='r')
+        self.n_rows = len(indptr) - 1
+        n_shards = max(1, min(int(n_shards), self.n_rows))
+        self.bounds = np.linspace(0, self.n_rows, n_shards + 1).astype(int)
+        ctx = multiprocessing.get_context()
+        self._conns, self._procs = [], []
+        for lo, hi in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_catalog_shard_loop, args=(child, str(path), lo, hi), daemon=True)
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        for conn in self._conns:
+            conn.recv()   # шард загрузил свой кусок
+        print(f"[DEBUG] Started {n_shards} catalog shards over {self.n_rows} rows")
+
+    def __len__(self):
+        return len(self._procs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def search(self, new_tfidf, top_k=TOP_K_CANDIDATES, row_mask=None):
+        """
+        Ищет top_k кандидатов во всех шардах.
+
+        Args:
+            new_tfidf: TF-IDF матрица новых товаров, shape (M, V)
+            top_k: Количество кандидатов
+            row_mask: Булева маска допустимых строк каталога, shape (N,), или None
+
+        Returns:
+            То же, что batch_candidate_search_tfidf(new_tfidf, cat_tfidf, top_k, row_mask=row_mask)
+        """
+        bounds = self.bounds
+        for s, conn in enumerate(self._conns):
+            mask = None if row_mask is None else np.asarray(row_mask[bounds[s]:bounds[s + 1]])
+            conn.send((new_tfidf, top_k, mask))
+        parts = [conn.recv() for conn in self._conns]
+        for part in parts:
+            if isinstance(part, Exception):
+                raise part
+        STATS.count("shard_queries", len(parts))
+        return merge_topk(parts, top_k, self.n_rows, row_mask)
+
+    def close(self):
+        """Останавливает процессы-шарды."""
+        for conn in self._conns:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, BrokenPipeError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._conns, self._procs = [], []
+
+# ----------------- Функция 16: Характеристики и жёсткий фильтр -----------------
+SPEC_COLORS = sorted(set(COLOR_MAP.values()))   # код цвета — позиция в этом списке
+
+class CatalogSpecs:
+    """
+    Характеристики названий (extract_specs) в типизированных столбцах NumPy.
+
+    Столбцы выровнены со строками каталога (или новых товаров), поэтому
+    проверка всех пар кандидатов сводится к индексированию массивов.
+
+    При заданных rows извлекаются только эти строки (кандидаты пакета),
+    остальные остаются «не указано» и ни с чем не конфликтуют.
+
+    Attributes:
+        ram, rom: np.ndarray int32 памяти "ram/rom", -1 — не указана
+        inches: np.ndarray float32 диагонали в дюймах, NaN — не указана
+        color: np.ndarray int16 кода цвета (SPEC_COLORS), -1 — не указан
+    """
+
+    def __init__(self, titles, rows=None):
+        n = len(titles)
+        self.ram = np.full(n, -1, dtype=np.int32)
+        self.rom = np.full(n, -1, dtype=np.int32)
+        self.inches = np.full(n, np.nan, dtype=np.float32)
+        self.color = np.full(n, -1, dtype=np.int16)
+        colors = {c: k for k, c in enumerate(SPEC_COLORS)}
+        for j in range(n) if rows is None else rows:
+            ram, rom, inches, color = extract_specs(titles[j])
+            if ram is not None:
+                self.ram[j], self.rom[j] = ram, rom
+            if inches is not None:
+                self.inches[j] = inches
+            if color is not None:
+                self.color[j] = colors[color]
+
+    def __len__(self):
+        return len(self.ram)
+
+def spec_conflicts(new_specs, cat_specs, new_rows, cat_rows, keys=SPEC_FILTER_KEYS):
+    """
+    Маска пар с противоречащими характеристиками: значение известно у обоих
+    товаров и различается. Неизвестная характеристика пару не отклоняет.
+
+    Args:
+        new_specs, cat_specs: CatalogSpecs новых товаров и каталога
+        new_rows, cat_rows: np.ndarray позиций пар в new_specs и cat_specs
+        keys: Проверяемые характеристики: "storage", "inches", "color"
+
+    Returns:
+        np.ndarray bool shape (len(new_rows),), True — пару нужно отклонить
+    """
+    conflict = np.zeros(len(new_rows), dtype=bool)
+    if "storage" in keys:
+        for a, b in ((new_specs.ram[new_rows], cat_specs.ram[cat_rows]),
+                     (new_specs.rom[new_rows], cat_specs.rom[cat_rows])):
+            conflict |= (a >= 0) & (b >= 0) & (a != b)
+    if "inches" in keys:
+        a, b = new_specs.inches[new_rows], cat_specs.inches[cat_rows]
+        with np.errstate(invalid="ignore"):
+            conflict |= np.abs(a - b) > SCREEN_INCH_TOLERANCE   # NaN сравнивается как False
+    if "color" in keys:
+        a, b = new_specs.color[new_rows], cat_specs.color[cat_rows]
+        conflict |= (a >= 0) & (b >= 0) & (a != b)
+    return conflict
+
+def reject_spec_conflicts(cand_lists, new_specs, cat_specs, keys=SPEC_FILTER_KEYS):
+    """
+    Убирает из списков кандидатов пары с противоречащими характеристиками.
+
+    Все пары проверяются одной векторной маской spec_conflicts.
+
+    Args:
+        cand_lists: Кандидаты [(индекс_в_каталоге, оценка), ...] для каждого нового товара
+        new_specs: CatalogSpecs новых товаров (в порядке cand_lists)
+        cat_specs: CatalogSpecs каталога
+        keys: Проверяемые характеристики
+
+    Returns:
+        Кортеж (новые списки кандидатов, число отклонённых пар)
+    """
+    lens = [len(c) for c in cand_lists]
+    total = sum(lens)
+    if not total:
+        return cand_lists, 0
+    new_rows = np.repeat(np.arange(len(cand_lists)), lens)
+    cat_rows = np.fromiter((idx for cands in cand_lists for idx, _ in cands), dtype=np.int64, count=total)
+    conflict = spec_conflicts(new_specs, cat_specs, new_rows, cat_rows, keys)
+    n_rejected = int(conflict.sum())
+    if not n_rejected:
+        return cand_lists, 0
+    keep = (~conflict).tolist()
+    out, pos = [], 0
+    for cands in cand_lists:
+        out.append([c for c, ok in zip(cands, keep[pos:pos + len(cands)]) if ok])
+        pos += len(cands)
+    return out, n_rejected
+
 # ----------------- main -----------------
-def main():
+def main(argv=None):
     """
     Главная функция приложения.
     
     Выполняет полный цикл:
-    1. Загрузка данных
+    1. Загрузка данных (или готового индекса каталога)
     2. Поиск дубликатов
     3. Сохранение результатов
+
+    Args:
+        argv: Аргументы командной строки (по умолчанию sys.argv[1:])
     """
+    parser = argparse.ArgumentParser(description="Fuzzy product duplicate finder")
+    parser.add_argument("--catalog", default=CATALOG_FILE, help="файл каталога ID<TAB>Title")
+    parser.add_argument("--new", default=NEW_FILE, help="файл новых товаров ID<TAB>Title")
+    parser.add_argument("--output", default=OUTPUT_FILE, help="JSON файл результатов")
+    parser.add_argument("--build-index", metavar="DIR", nargs="?", const=INDEX_DIR,
+                        help="построить индекс каталога, сохранить в DIR и выйти")
+    parser.add_argument("--index", metavar="DIR", nargs="?", const=INDEX_DIR,
+                        help="использовать сохранённый индекс каталога вместо --catalog")
+    parser.add_argument("--add", metavar="FILE",
+                        help="дописать товары ID<TAB>Title из FILE в --index и выйти")
+    parser.add_argument("--delete", metavar="ID", nargs="+",
+                        help="пометить товары удалёнными в --index и выйти")
+    parser.add_argument("--compact", action="store_true",
+                        help="пересобрать --index по живым строкам и выйти")
+    parser.add_argument("--workers", type=int, default=SCORING_WORKERS,
+                        help="число процессов для точной оценки кандидатов и сборки индекса каталога")
+    parser.add_argument("--shards", type=int, metavar="N",
+                        help="искать кандидатов по --index в N процессах-шардах (каталог делится по строкам)")
+    parser.add_argument("--chunk-size", type=int, metavar="N",
+                        help="потоковый режим: читать и обрабатывать новые товары пакетами по N")
+    parser.add_argument("--format", choices=("json", "jsonl"), default="json",
+                        help="формат результатов: JSON объект или JSON Lines (по строке на товар; "
+                             "пакетная обработка и запись по мере оценки — вместе с --chunk-size)")
+    parser.add_argument("--gzip", action="store_true", default=None,
+                        help="сжимать результаты gzip (включается и расширением .gz)")
+    parser.add_argument("--compact-output", action="store_true",
+                        help="не писать нормализованные строки new_norm/catalog_norm")
+    parser.add_argument("--candidates", choices=("tfidf", "lsh"), default=CANDIDATE_MODE,
+                        help="поиск кандидатов: точный TF-IDF или приближённый MinHash-LSH")
+    parser.add_argument("--lsh-bands", type=int, default=LSH_BANDS, help="полос MinHash-LSH")
+    parser.add_argument("--lsh-rows", type=int, default=LSH_ROWS, help="строк сигнатуры в полосе LSH")
+    parser.add_argument("--features", choices=("vocab", "hashing"), default=TFIDF_FEATURES,
+                        help="признаки TF-IDF: словарь n-грамм или HashingVectorizer с сохранённым IDF")
+    parser.add_argument("--blocking", action="store_true", default=USE_BLOCKING,
+                        help="сравнивать товары только внутри блоков бренд/категория/память")
+    parser.add_argument("--lsh-report", metavar="FILE",
+                        help="сравнить recall/время LSH с точным TF-IDF, записать JSON отчёт и выйти")
+    parser.add_argument("--self-dedup", metavar="FILE", nargs="?", const=CLUSTERS_FILE,
+                        help="найти кластеры дубликатов внутри каталога, записать в FILE и выйти")
+    parser.add_argument("--cluster-threshold", type=float, default=CLUSTER_THRESHOLD,
+                        help="минимальная оценка пары для объединения в кластер (--self-dedup)")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="записать время/память по стадиям и счётчики в FILE (JSON, .prom — Prometheus)")
+    parser.add_argument("--norm-cache", metavar="FILE", default=NORM_CACHE_FILE,
+                        help="загрузить кэш нормализации из FILE и сохранить его туда после запуска")
+    args = parser.parse_args(argv)
+
     print("[INFO] Starting duplicate-finder pipeline")
-    cat_ids, cat_titles = load_tab_file(CATALOG_FILE)
-    new_ids, new_titles = load_tab_file(NEW_FILE)
+    STATS.reset()
+    if args.norm_cache:
+        load_normalize_cache(args.norm_cache)
+    if args.build_index:
+        with STATS.stage("load_catalog"):
+            cat_ids, cat_titles = load_tab_file(args.catalog)
+        save_catalog_index(build_catalog_index(cat_ids, cat_titles, args.features, args.workers), args.build_index)
+        if args.norm_cache:
+            save_normalize_cache(args.norm_cache)
+        if args.stats:
+            STATS.save(args.stats)
+        return
+
+    if args.add or args.delete or args.compact:
+        if not args.index:
+            parser.error("--add/--delete/--compact require --index")
+        index = load_catalog_index(args.index)
+        if args.delete:
+            print(f"[INFO] Deleted {delete_from_catalog_index(index, args.delete)} rows")
+        if args.add:
+            add_ids, add_titles = load_tab_file(args.add)
+            print(f"[INFO] Appended {append_to_catalog_index(index, add_ids, add_titles)} rows")
+        if args.compact or needs_compaction(index):
+            index = compact_catalog_index(index, args.workers)
+            print(f"[INFO] Compacted catalog index to {len(index.ids)} rows")
+        save_catalog_index(index, args.index)
+        return
+
+    index = None
+    if args.index:
+        index = load_catalog_index(args.index)
+        cat_ids, cat_titles = index.ids, index.titles
+    else:
+        with STATS.stage("load_catalog"):
+            cat_ids, cat_titles = load_tab_file(args.catalog)
     if not cat_ids:
         print("[WARN] catalog appears empty after parsing — check file format and encoding")
-    if not new_ids:
-        print("[WARN] new_items appears empty after parsing — nothing to do")
-    results = process_all(cat_ids, cat_titles, new_ids, new_titles)
-    save_results(results)
+
+    if args.lsh_report:
+        run_lsh_report(index or build_catalog_index(cat_ids, cat_titles, args.features, args.workers), load_tab_file(args.new)[1],
+                       args.lsh_report, extra=(args.lsh_bands, args.lsh_rows))
+        return
+
+    if args.self_dedup:
+        if index is None:
+            index = build_catalog_index(cat_ids, cat_titles, args.features, args.workers)
+        clusters = find_catalog_clusters(index, args.candidates, args.blocking, args.cluster_threshold,
+                                         args.lsh_bands, args.lsh_rows)
+        save_clusters(clusters, args.self_dedup, args.gzip)
+        if args.norm_cache:
+            save_normalize_cache(args.norm_cache)
+        if args.stats:
+            STATS.save(args.stats)
+        return
+
+    lsh = None
+    if args.candidates == "lsh":
+        # LSH строится по нормализованному каталогу, поэтому нужен готовый индекс
+        if index is None:
+            index = build_catalog_index(cat_ids, cat_titles, args.features, args.workers)
+        lsh = index.lsh = MinHashLSHIndex(index.norm, bands=args.lsh_bands, rows=args.lsh_rows)
+    if index is None and args.features != TFIDF_FEATURES:
+        # режим признаков задан флагом — IDF обучается по каталогу, как в потоковом режиме
+        index = build_catalog_index(cat_ids, cat_titles, args.features, args.workers)
+    if args.shards and args.shards > 1:
+        if not args.index:
+            parser.error("--shards requires --index")
+        index.shards = CatalogShards(args.index, args.shards)
+
+    # один пул точной оценки на весь запуск: каталог уходит воркерам один раз
+    pool = ScoringPool(args.workers) if args.workers > 1 else None
+    results = None
+    if args.chunk_size:
+        # потоковый режим: словарь TF-IDF строится только по каталогу,
+        # новые товары читаются, оцениваются и пишутся пакетами
+        if index is None:
+            index = build_catalog_index(cat_ids, cat_titles, args.features, args.workers)
+        batches = iter_tab_file(args.new, args.chunk_size)
+        items = iter_process_batches(index, batches, args.workers, args.candidates, lsh, args.blocking, pool)
+    else:
+        with STATS.stage("load_new"):
+            new_ids, new_titles = load_tab_file(args.new)
+        if not new_ids:
+            print("[WARN] new_items appears empty after parsing — nothing to do")
+        results = process_all(cat_ids, cat_titles, new_ids, new_titles, index=index, workers=args.workers,
+                              candidates=args.candidates, lsh=lsh, blocking=args.blocking, pool=pool)
+        items = results.items()
+
+    if args.compact_output:
+        items = ((nid, compact_result(info)) for nid, info in items)
+    # в потоковом режиме стадии поиска и оценки выполняются внутри save_results
+    with STATS.stage("save_results"):
+        if args.format == "jsonl":
+            save_results_jsonl(items, args.output, args.gzip)
+        elif results is None or args.compact_output or args.gzip or str(args.output).endswith(".gz"):
+            save_results_stream(items, args.output, args.gzip)
+        else:
+            save_results(results, args.output)
+    if index is not None and index.shards is not None:
+        index.shards.close()
+    if pool is not None:
+        pool.close()
+    if args.norm_cache:
+        save_normalize_cache(args.norm_cache)
+    if args.stats:
+        STATS.save(args.stats)
+    if results is None:
+        return
 
     # краткий вывод в консоль
     for nid, info in results.items():
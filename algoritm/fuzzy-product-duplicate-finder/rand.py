@@ -7,35 +7,52 @@ colors = ['синий', 'черный', 'белый', 'красный', 'зел
 storages = ['4/64GB', '8/128GB', '12/256GB', '16/512GB']
 screens = ['6.1"', '6.7"', '10.1"', '11"', '12.3"']
 
-# Генерация catalog.txt
-with open('catalog.txt', 'w', encoding='utf-8') as f:
-    for i in range(100000):  # 1000 товаров в каталоге
-        brand = random.choice(brands)
-        typ = random.choice(types)
-        model = random.choice(models)
-        color = random.choice(colors)
-        storage = random.choice(storages)
-        screen = random.choice(screens)
-        title = f"{typ} {brand} {model} {screen} {storage} {color}"
-        f.write(f"{1000+i}\t{title}\n")
-
-# Генерация new_items.txt
-with open('new_items.txt', 'w', encoding='utf-8') as f:
-    for i in range(5000):  # 200 новых товаров
-        if i % 5 == 0:
-            # вставим «почти дубликаты» из каталога
-            cat_idx = random.randint(0, 999)
-            title_base = f"{types[cat_idx%len(types)]} {brands[cat_idx%len(brands)]} {models[cat_idx%len(models)]} {screens[cat_idx%len(screens)]} {storages[cat_idx%len(storages)]} {colors[cat_idx%len(colors)]}"
-            # немного изменяем: удаляем слово, меняем регистр
-            title = title_base.replace(' ', '  ').upper() if random.random()<0.5 else title_base.lower()
-        else:
-            brand = random.choice(brands)
-            typ = random.choice(types)
-            model = random.choice(models)
-            color = random.choice(colors)
-            storage = random.choice(storages)
-            screen = random.choice(screens)
+
+def generate(catalog_path='catalog.txt', new_path='new_items.txt', n_catalog=100000, n_new=5000, seed=None):
+    """
+    Генерирует тестовые catalog.txt и new_items.txt.
+
+    Args:
+        catalog_path: Куда записать каталог
+        new_path: Куда записать новые товары
+        n_catalog: Количество товаров в каталоге
+        n_new: Количество новых товаров (каждый пятый — «почти дубликат»)
+        seed: Зерно генератора для воспроизводимых наборов (None — случайные)
+    """
+    rng = random.Random(seed)
+
+    # Генерация catalog.txt
+    with open(catalog_path, 'w', encoding='utf-8') as f:
+        for i in range(n_catalog):
+            brand = rng.choice(brands)
+            typ = rng.choice(types)
+            model = rng.choice(models)
+            color = rng.choice(colors)
+            storage = rng.choice(storages)
+            screen = rng.choice(screens)
             title = f"{typ} {brand} {model} {screen} {storage} {color}"
-        f.write(f"{2000+i}\t{title}\n")
+            f.write(f"{1000+i}\t{title}\n")
+
+    # Генерация new_items.txt
+    with open(new_path, 'w', encoding='utf-8') as f:
+        for i in range(n_new):
+            if i % 5 == 0:
+                # вставим «почти дубликаты» из каталога
+                cat_idx = rng.randint(0, 999)
+                title_base = f"{types[cat_idx%len(types)]} {brands[cat_idx%len(brands)]} {models[cat_idx%len(models)]} {screens[cat_idx%len(screens)]} {storages[cat_idx%len(storages)]} {colors[cat_idx%len(colors)]}"
+                # немного изменяем: удаляем слово, меняем регистр
+                title = title_base.replace(' ', '  ').upper() if rng.random()<0.5 else title_base.lower()
+            else:
+                brand = rng.choice(brands)
+                typ = rng.choice(types)
+                model = rng.choice(models)
+                color = rng.choice(colors)
+                storage = rng.choice(storages)
+                screen = rng.choice(screens)
+                title = f"{typ} {brand} {model} {screen} {storage} {color}"
+            f.write(f"{2000+i}\t{title}\n")
+
 
-print("Test files 'catalog.txt' (1000 items) and 'new_items.txt' (200 items) generated.")
\ No newline at end of file
+if __name__ == "__main__":
+    generate()
+    print("Test files 'catalog.txt' (100000 items) and 'new_items.txt' (5000 items) generated.")
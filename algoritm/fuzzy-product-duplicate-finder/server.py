@@ -0,0 +1,186 @@
+"""
+server.py — HTTP сервис поиска дубликатов с прогретым индексом каталога.
+
+Индекс каталога (python exam.py --build-index DIR) загружается один раз при
+старте, поэтому запрос не платит за запуск процесса, импорт sklearn и
+обучение TF-IDF. Одиночные запросы /match складываются в микропакеты:
+запросы, пришедшие в течение MICROBATCH_WAIT_MS, оцениваются одним вызовом
+exam.process_all (одно произведение разреженных матриц на пакет).
+
+Для каталога, не помещающегося в один процесс, DUPFINDER_SHARDS=N запускает
+N процессов-шардов (exam.CatalogShards), каждый со своим куском матрицы.
+
+Запуск:
+    DUPFINDER_INDEX=catalog_index uvicorn server:app --port 8000
+"""
+
+import asyncio
+import os
+
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request, status
+from pydantic import BaseModel
+
+import exam
+
+
+INDEX_DIR = os.getenv("DUPFINDER_INDEX", exam.INDEX_DIR)
+SHARDS = int(os.getenv("DUPFINDER_SHARDS", "0"))   # >1 — поиск кандидатов в процессах-шардах
+MICROBATCH_MAX = 64          # максимум одиночных запросов в одном пакете
+MICROBATCH_WAIT_MS = 2.0     # сколько ждать попутчиков после первого запроса пакета
+
+
+class MatchRequest(BaseModel):
+    title: str
+    id: Optional[str] = None
+
+class BatchMatchRequest(BaseModel):
+    items: List[MatchRequest]
+
+class Match(BaseModel):
+    catalog_id: str
+    catalog_title: str
+    score: float
+    score_components: dict
+
+class MatchResponse(BaseModel):
+    id: Optional[str] = None
+    new_title: str
+    new_norm: str
+    matches: List[Match]
+
+class BatchMatchResponse(BaseModel):
+    results: List[MatchResponse]
+
+
+class MatchService:
+    """
+    Прогретый индекс каталога и очередь микропакетов.
+
+    Вся работа с индексом идёт в одном потоке-исполнителе: кэши exam
+    не потокобезопасны, а event loop не блокируется на CPU-работе.
+    """
+
+    def __init__(self, index, max_batch=MICROBATCH_MAX, wait_ms=MICROBATCH_WAIT_MS):
+        self.index = index
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000.0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._task = None
+
+    def match_titles(self, titles, ids=None):
+        """Синхронно оценивает названия против каталога (в потоке-исполнителе)."""
+        keys = [str(k) for k in range(len(titles))]
+        results = exam.process_all(self.index.ids, self.index.titles, keys, titles, index=self.index)
+        return [dict(results[k], id=ids[n] if ids else None) for n, k in enumerate(keys)]
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._batch_loop())
+        # прогрев: первый вызов строит токены каталога и импортирует ленивые части;
+        # сам прогрев в /stats не попадает
+        await self.run(self.match_titles, ["warmup"])
+        await self.run(exam.STATS.reset)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+        if self.index.shards is not None:
+            self.index.shards.close()
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def match_one(self, item):
+        """Ставит одиночный запрос в очередь микропакетов и ждёт результат."""
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _batch_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            exam.STATS.count("microbatches")
+            try:
+                results = await self.run(self.match_titles, [it.title for it, _ in batch], [it.id for it, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res)
+
+
+router = APIRouter(tags=["Match"])
+
+def get_service(request: Request) -> MatchService:
+    service = getattr(request.app.state, "service", None)
+    if service is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Catalog index is not loaded")
+    return service
+
+@router.post("/match", response_model=MatchResponse, status_code=status.HTTP_200_OK, description="Дубликаты одного названия в каталоге")
+async def match(item: MatchRequest, request: Request) -> dict:
+    return await get_service(request).match_one(item)
+
+@router.post("/match/batch", response_model=BatchMatchResponse, status_code=status.HTTP_200_OK, description="Дубликаты списка названий одним пакетом")
+async def match_batch(body: BatchMatchRequest, request: Request) -> dict:
+    service = get_service(request)
+    if not body.items:
+        return {"results": []}
+    results = await service.run(service.match_titles, [it.title for it in body.items], [it.id for it in body.items])
+    return {"results": results}
+
+@router.get("/health", status_code=status.HTTP_200_OK, description="Состояние сервиса и размер каталога")
+async def health(request: Request) -> dict:
+    index = get_service(request).index
+    return {"status": "ok", "catalog_size": len(index.ids) - int(index.deleted.sum())}
+
+@router.get("/stats", status_code=status.HTTP_200_OK, description="Время стадий, счётчики и кэши с момента старта")
+async def stats(request: Request) -> dict:
+    # снимок — в потоке-исполнителе: там же оценка меняет STATS.stages/counters
+    service = get_service(request)
+    return await service.run(exam.STATS.snapshot)
+
+
+def create_app(index_dir=INDEX_DIR, shards=SHARDS):
+    """
+    Создаёт приложение; индекс из index_dir загружается при старте (lifespan).
+
+    Args:
+        index_dir: Каталог индекса, сохранённого exam.py --build-index
+        shards: Число процессов-шардов для поиска кандидатов (0/1 — без шардов)
+    """
+    @asynccontextmanager
+    async def lifespan(app):
+        index = exam.load_catalog_index(index_dir)
+        if shards > 1:
+            index.shards = exam.CatalogShards(index_dir, shards)
+        service = MatchService(index)
+        await service.start()
+        app.state.service = service
+        yield
+        await service.stop()
+
+    app = FastAPI(title="Fuzzy product duplicate finder", lifespan=lifespan)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
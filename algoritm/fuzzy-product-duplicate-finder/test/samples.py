@@ -0,0 +1,18 @@
+"""Общие тестовые данные: маленький каталог и новые позиции к нему."""
+
+CATALOG = [
+    "Смартфон Xiaomi Redmi Note 12 Pro 8/256GB синий",
+    "Телефон Huawei P60 Pro 12/512GB черный",
+    'Планшет Irbis TX97 10.1" 4/64GB',
+    "Xiaomi Robot Vacuum Cleaner S10+",
+    "HUAWEI Watch GT 4 46mm",
+    "Смартфон Samsung Galaxy S23 8/128GB черный",
+    "Планшет Lenovo Tab P11 11\" 6/128GB серый",
+]
+CATALOG_IDS = [str(1000 + i) for i in range(len(CATALOG))]
+NEW = [
+    "Xiaomi Redmi Note 12 Pro 8/256 Синий",
+    "Huawei P60 Pro 12/512 Black",
+    "Планшет IRBIS TX97 10.1 дюйм 4/64 ГБ",
+    "Робот-пылесос Xiaomi S10+",
+]
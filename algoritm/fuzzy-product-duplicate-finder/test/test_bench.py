@@ -0,0 +1,30 @@
+import bench
+import rand
+
+
+def test_generate_is_seeded(tmp_path):
+    rand.generate(tmp_path / "c1.txt", tmp_path / "n1.txt", 50, 10, seed=7)
+    rand.generate(tmp_path / "c2.txt", tmp_path / "n2.txt", 50, 10, seed=7)
+    assert (tmp_path / "c1.txt").read_text(encoding="utf-8") == (tmp_path / "c2.txt").read_text(encoding="utf-8")
+    assert len((tmp_path / "n1.txt").read_text(encoding="utf-8").splitlines()) == 10
+
+
+def test_run_tier_reports_every_stage(tmp_path):
+    rand.generate(tmp_path / "c.txt", tmp_path / "n.txt", 200, 20, seed=1)
+    result = bench.run_tier(tmp_path / "c.txt", tmp_path / "n.txt")
+    stages = result["stages"]
+    assert list(stages) == ["import_libs", "load_tab_file", "normalize", "build_tfidf_index", "candidate_search", "scoring"]
+    assert all(s["sec"] >= 0 for s in stages.values())
+    assert result["precision"]["dtype"] == "float32"
+    assert result["precision"]["topk_recall"] >= bench.MIN_TOPK_RECALL
+
+
+def test_find_regressions():
+    base = {"tiers": {"1k": {"stages": {"normalize": {"sec": 1.0}, "scoring": {"sec": 0.01}}}}}
+    cur = {"tiers": {"1k": {"stages": {"normalize": {"sec": 1.5}, "scoring": {"sec": 0.05}}}}}
+    assert bench.find_regressions(cur, base, tolerance=0.25) == ["1k/normalize: 1.0s -> 1.5s"]
+
+
+def test_find_regressions_flags_topk_precision():
+    cur = {"tiers": {"1k": {"stages": {}, "precision": {"topk_recall": 0.9}}}}
+    assert bench.find_regressions(cur, {}) == ["1k/precision: top-k recall vs float64 0.9"]
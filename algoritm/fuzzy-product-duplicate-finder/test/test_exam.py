@@ -0,0 +1,609 @@
+import numpy as np
+import pytest
+
+import exam
+
+from .samples import CATALOG, CATALOG_IDS, NEW
+
+
+needs_tfidf = pytest.mark.skipif(not exam.tfidf_available(), reason="sklearn is not installed")
+
+
+def _tfidf():
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    new_norm = [exam.normalize_text(t) for t in NEW]
+    return exam.build_tfidf_index(cat_norm, new_norm)
+
+
+@needs_tfidf
+@pytest.mark.parametrize("chunk_size", [1, 3, 256])
+def test_batch_candidate_search_matches_dense(chunk_size):
+    _, cat_tfidf, new_tfidf = _tfidf()
+    dense = (new_tfidf @ cat_tfidf.T).toarray()
+    res = exam.batch_candidate_search_tfidf(new_tfidf, cat_tfidf, top_k=3, chunk_size=chunk_size)
+    assert len(res) == len(NEW)
+    for row, cands in zip(dense, res):
+        expected = sorted(range(len(row)), key=lambda j: (-row[j], j))[:3]
+        assert [j for j, _ in cands] == expected
+        assert [s for _, s in cands] == pytest.approx([row[j] for j in expected])
+
+
+@needs_tfidf
+def test_batch_candidate_search_top_k_larger_than_catalog():
+    _, cat_tfidf, new_tfidf = _tfidf()
+    res = exam.batch_candidate_search_tfidf(new_tfidf, cat_tfidf, top_k=100)
+    assert all(len(c) == len(CATALOG) for c in res)
+    assert all(sorted(j for j, _ in c) == list(range(len(CATALOG))) for c in res)
+
+
+def test_topk_row_breaks_ties_by_index():
+    cols = np.array([5, 1, 3, 0])
+    data = np.array([0.5, 0.9, 0.5, 0.5])
+    assert exam._topk_row(cols, data, 3, 10) == [(1, 0.9), (0, 0.5), (3, 0.5)]
+    assert exam._topk_row(cols[:1], data[:1], 3, 10) == [(5, 0.5), (0, 0.0), (1, 0.0)]
+
+
+@needs_tfidf
+def test_catalog_index_roundtrip(tmp_path):
+    built = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    exam.save_catalog_index(built, tmp_path / "idx")
+    loaded = exam.load_catalog_index(tmp_path / "idx")
+
+    assert loaded.ids == CATALOG_IDS and loaded.titles == CATALOG and loaded.norm == built.norm
+    assert (loaded.tfidf != built.tfidf).nnz == 0
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    assert (exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, index=loaded)
+            == exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, index=built))
+
+
+@needs_tfidf
+@pytest.mark.parametrize("features", ["vocab", "hashing"])
+def test_parallel_index_build_matches_serial(features):
+    serial = exam.build_catalog_index(CATALOG_IDS, CATALOG, features)
+    parallel = exam.build_catalog_index(CATALOG_IDS, CATALOG, features, workers=2)
+    assert parallel.norm == serial.norm
+    assert np.array_equal(parallel.vectorizer.idf_, serial.vectorizer.idf_)
+    assert parallel.tfidf.dtype == serial.tfidf.dtype
+    assert (parallel.tfidf != serial.tfidf).nnz == 0
+    if features == "vocab":
+        assert parallel.vectorizer.vocabulary_ == serial.vectorizer.vocabulary_
+
+
+@needs_tfidf
+def test_catalog_shards_match_single_search(tmp_path):
+    exam.save_catalog_index(exam.build_catalog_index(CATALOG_IDS, CATALOG), tmp_path / "idx")
+    index = exam.load_catalog_index(tmp_path / "idx")
+    new_tfidf = index.vectorizer.transform([exam.normalize_text(t) for t in NEW + ["zzz qqq"]])
+    mask = np.ones(len(CATALOG), dtype=bool)
+    mask[[1, 4]] = False
+    with exam.CatalogShards(tmp_path / "idx", 3) as shards:
+        assert len(shards) == 3
+        for top_k in (2, 5, 20):
+            for row_mask in (None, mask):
+                assert (shards.search(new_tfidf, top_k, row_mask)
+                        == exam.batch_candidate_search_tfidf(new_tfidf, index.tfidf, top_k, row_mask=row_mask))
+        index.shards = shards
+        new_ids = [str(2000 + i) for i in range(len(NEW))]
+        sharded = exam.process_all([], [], new_ids, NEW, index=index)
+    index.shards = None
+    assert sharded == exam.process_all([], [], new_ids, NEW, index=index)
+
+
+@needs_tfidf
+def test_hashing_features_index(tmp_path):
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    built = exam.build_catalog_index(CATALOG_IDS, CATALOG, features="hashing")
+    assert isinstance(built.vectorizer, exam.HashingTfidf)
+    assert built.tfidf.shape == (len(CATALOG), exam.HASHING_N_FEATURES)
+    exam.save_catalog_index(built, tmp_path / "idx")
+    loaded = exam.load_catalog_index(tmp_path / "idx")
+    assert exam.vectorizer_features(loaded.vectorizer) == "hashing"
+    assert (loaded.tfidf != built.tfidf).nnz == 0
+
+    def matched(res):
+        return {(k, m["catalog_id"]) for k, v in res.items() for m in v["matches"]}
+    hashed = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, index=loaded)
+    vocab = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, index=exam.build_catalog_index(CATALOG_IDS, CATALOG))
+    assert matched(hashed) == matched(vocab)
+
+
+@needs_tfidf
+def test_catalog_index_append_and_delete(tmp_path):
+    index = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    assert exam.delete_from_catalog_index(index, ["1000", "missing"]) == 1
+    assert exam.append_to_catalog_index(index, ["1100"], ["Смартфон Xiaomi Redmi 13C 4/128GB"]) == 1
+    exam.save_catalog_index(index, tmp_path / "idx")
+    index = exam.load_catalog_index(tmp_path / "idx")
+    assert index.n_appended == 1 and index.deleted.tolist() == [True] + [False] * len(CATALOG)
+
+    res = exam.process_all([], [], ["1", "2"], [NEW[0], "Xiaomi Redmi 13C 4/128"], index=index)
+    assert all(m["catalog_id"] != "1000" for m in res["1"]["matches"])
+    assert res["2"]["matches"][0]["catalog_id"] == "1100"
+
+    compacted = exam.compact_catalog_index(index)
+    assert compacted.ids == CATALOG_IDS[1:] + ["1100"]
+    assert compacted.n_appended == 0 and not compacted.deleted.any()
+
+
+def test_process_all_workers_preserve_order():
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    single = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    parallel = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, workers=2)
+    assert list(parallel) == new_ids
+    assert parallel == single
+
+
+def test_scoring_pool_ships_catalog_once():
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    index = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    batches = [(new_ids[:2], NEW[:2]), (new_ids[2:], NEW[2:])]
+    single = dict(exam.iter_process_batches(index, iter(batches)))
+    with exam.ScoringPool(2) as pool:
+        parallel = dict(exam.iter_process_batches(index, iter(batches), pool=pool))
+        executor = pool._executor
+        parallel.update(exam.process_all(CATALOG_IDS, CATALOG, new_ids[:2], NEW[:2], index=index, pool=pool))
+        assert pool._executor is executor
+    assert parallel == single
+
+
+def test_batch_lexical_scores_match_pairwise():
+    a = [exam.normalize_text(t) for t in NEW for _ in CATALOG]
+    b = [exam.normalize_text(t) for _ in NEW for t in CATALOG]
+    batch = exam.batch_lexical_scores(a, b)
+    assert batch.tolist() == [exam.lexical_score(x, y) for x, y in zip(a, b)]
+    assert exam.batch_lexical_scores([], []).shape == (0,)
+
+
+def _legacy_normalize(s):
+    # прежняя реализация normalize_text: отдельный re.sub на каждый ключ словарей
+    import re
+    if not s:
+        return ""
+    s0 = s.lower()
+    s0 = s0.replace('"', ' inch ').replace('”', ' inch ').replace('“', ' inch ')
+    for mapping in (exam.UNIT_MAP, exam.GENERIC_MAP, exam.COLOR_MAP):
+        for k, v in mapping.items():
+            s0 = re.sub(r'\b' + re.escape(k) + r'\b', v, s0)
+    s0 = exam.RE_DIGIT_SLASH_DIGIT.sub(r'\1/\2', s0)
+    s0 = exam.RE_DIGIT_LETTER.sub(r'\1 \2', s0)
+    s0 = exam.RE_LETTER_DIGIT.sub(r'\1 \2', s0)
+    s0 = exam.RE_PUNCTUATION.sub(' ', s0)
+    s0 = exam.RE_MULTISPACE.sub(' ', s0).strip()
+    for k, v in exam.BRAND_FIXES.items():
+        s0 = s0.replace(k, v)
+    return s0
+
+
+def test_normalize_text_parity_with_legacy():
+    import itertools
+    corpus = CATALOG + NEW + [
+        "", "   ", "Телефон", "ДЮЙМА 6.7 дюйм", "Пылесос-робот белый", "Робот-пылесос серебристый",
+        "Смартфон 12 ГБайт / 256 гигабайт черный/белый", "Часы 46мм Красный", "mb мб МБ Gb",
+        "Планшет «Lenovo» 11” 6/128GB серый", "чёрный зелёный", "blacksilver телефоны",
+    ]
+    types = ['Смартфон', 'Телефон', 'Планшет', 'Робот-пылесос', 'Часы']
+    colors = ['синий', 'черный', 'белый', 'красный', 'зелёный', 'серебристый']
+    storages = ['4/64GB', '8/128GB', '12/256GB', '16/512GB']
+    screens = ['6.1"', '6.7"', '10.1"', '11"', '12.3"']
+    for typ, color, storage, screen in itertools.product(types, colors, storages, screens):
+        title = f"{typ} Xiaomi Note {screen} {storage} {color}"
+        corpus += [title, title.upper().replace(' ', '  '), title.lower()]
+    for title in corpus:
+        assert exam.normalize_text(title) == _legacy_normalize(title), title
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-8-sig", "cp1251", "utf-16"])
+def test_load_tab_file_detects_encoding(tmp_path, encoding):
+    path = tmp_path / "items.txt"
+    path.write_text("1001\tСмартфон Xiaomi\n\n1002  Телефон Huawei\n", encoding=encoding)
+    assert exam.load_tab_file(path) == (["1001", "1002"], ["Смартфон Xiaomi", "Телефон Huawei"])
+
+
+def test_load_tab_file_falls_back_after_sniffed_sample(tmp_path):
+    path = tmp_path / "items.txt"
+    path.write_bytes(b"1\tascii only\n" * 10 + "2\tчерный\n".encode("cp1251"))
+    ids, titles = exam.load_tab_file(path)
+    assert exam.detect_encoding(path, sample_size=16) == "utf-8"
+    assert titles[-1] == "черный" and len(ids) == 11
+
+
+def test_iter_tab_file_batches(tmp_path):
+    path = tmp_path / "items.txt"
+    path.write_text("".join(f"{i}\tTitle {i}\n" for i in range(7)), encoding="utf-8")
+    batches = list(exam.iter_tab_file(path, batch_size=3))
+    assert [len(ids) for ids, _ in batches] == [3, 3, 1]
+    assert batches[2] == (["6"], ["Title 6"])
+
+
+def test_iter_tab_file_checks_encoding_before_first_batch(tmp_path):
+    path = tmp_path / "items.txt"
+    path.write_bytes(b"1\tascii only\n" * 10000 + "2\tчерный\n".encode("cp1251"))
+    batches = list(exam.iter_tab_file(path, batch_size=4096))
+    assert batches[-1][1][-1] == "черный"
+
+
+def test_save_results_stream_keeps_previous_output_on_error(tmp_path):
+    out = tmp_path / "a.json"
+    out.write_text("{}", encoding="utf-8")
+
+    def items():
+        yield "1", {"new_title": "x", "matches": []}
+        raise IOError("broken input")
+
+    with pytest.raises(IOError):
+        exam.save_results_stream(items(), out)
+    assert out.read_text(encoding="utf-8") == "{}"
+    assert list(tmp_path.iterdir()) == [out]
+
+
+def test_save_results_stream_matches_save_results(tmp_path):
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    index = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    batches = [(new_ids[:3], NEW[:3]), (new_ids[3:], NEW[3:])]
+    exam.save_results_stream(exam.iter_process_batches(index, iter(batches)), tmp_path / "a.json")
+    exam.save_results(exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, index=index), tmp_path / "b.json")
+    assert (tmp_path / "a.json").read_text(encoding="utf-8") == (tmp_path / "b.json").read_text(encoding="utf-8")
+
+
+def test_save_results_jsonl_gzip_compact(tmp_path):
+    import gzip
+    import json
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    results = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    items = ((nid, exam.compact_result(info)) for nid, info in results.items())
+    assert exam.save_results_jsonl(items, tmp_path / "out.jsonl.gz") == len(NEW)
+
+    with gzip.open(tmp_path / "out.jsonl.gz", "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [r["new_id"] for r in rows] == new_ids
+    assert all("new_norm" not in r for r in rows)
+    assert all("catalog_norm" not in m for r in rows for m in r["matches"])
+    assert rows[0]["matches"][0]["score"] == results["2000"]["matches"][0]["score"]
+
+
+def test_main_jsonl_scores_match_json(tmp_path):
+    import json
+    cat, new = tmp_path / "catalog.txt", tmp_path / "new.txt"
+    cat.write_text("".join(f"{1000 + i}\t{t}\n" for i, t in enumerate(CATALOG)), encoding="utf-8")
+    new.write_text("".join(f"{2000 + i}\t{t}\n" for i, t in enumerate(NEW)), encoding="utf-8")
+    exam.main(["--catalog", str(cat), "--new", str(new), "--output", str(tmp_path / "out.json")])
+    exam.main(["--catalog", str(cat), "--new", str(new), "--output", str(tmp_path / "out.jsonl"), "--format", "jsonl"])
+    as_json = json.loads((tmp_path / "out.json").read_text(encoding="utf-8"))
+    with open(tmp_path / "out.jsonl", encoding="utf-8") as f:
+        as_jsonl = {r.pop("new_id"): r for r in map(json.loads, f)}
+    assert as_jsonl == as_json
+
+
+def test_minhash_lsh_finds_near_duplicates():
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    new_norm = [exam.normalize_text(t) for t in NEW]
+    lsh = exam.MinHashLSHIndex(cat_norm, bands=32, rows=2)
+    assert lsh.signatures.shape == (len(CATALOG), 64)
+    assert (lsh.signature(cat_norm) == lsh.signatures).all()
+
+    found = exam.lsh_candidate_search(lsh, new_norm, top_k=3)
+    assert [cands[0][0] for cands in found] == [0, 1, 2, 3]
+    assert found[2][0][1] == 1.0  # одинаковые нормализованные строки
+
+    mask = np.ones(len(CATALOG), dtype=bool)
+    mask[0] = False
+    masked = exam.lsh_candidate_search(lsh, new_norm[:1], top_k=3, row_mask=mask)
+    assert all(j != 0 for j, _ in masked[0])
+
+
+@needs_tfidf
+def test_lsh_candidate_search_batched_rerank():
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    new_norm = [exam.normalize_text(t) for t in NEW]
+    _, cat_tfidf, new_tfidf = exam.build_tfidf_index(cat_norm, new_norm)
+    lsh = exam.MinHashLSHIndex(cat_norm, bands=32, rows=2)
+    pools = lsh.candidates(lsh.signature(new_norm))
+    capped = lsh.candidates(lsh.signature(new_norm), limit=1)
+    assert all(len(c) <= 1 and set(c) <= set(p) for c, p in zip(capped, pools))
+
+    found = exam.lsh_candidate_search(lsh, new_norm, 3, new_tfidf, cat_tfidf, limit=None, chunk_size=3)
+    for q, rows in enumerate(pools):
+        scores = (cat_tfidf[rows] @ new_tfidf[q].T).toarray().ravel()
+        expected = exam._topk_row(rows, scores, 3, len(CATALOG), fill=False)
+        assert [j for j, _ in found[q]] == [j for j, _ in expected]
+        assert np.allclose([s for _, s in found[q]], [s for _, s in expected], atol=1e-6)
+
+
+def test_token_inverted_index_matches_linear_scan():
+    cat_tokens = [set(exam.normalize_text(t).split()) for t in CATALOG]
+    index = exam.TokenInvertedIndex(cat_tokens)
+    for query in [exam.normalize_text(t) for t in NEW] + ["", "unknown tokens only"]:
+        q = set(query.split())
+        scan = sorted(((j, len(q & c) / max(1, len(q | c))) for j, c in enumerate(cat_tokens)),
+                      key=lambda x: x[1], reverse=True)
+        assert index.search(q, top_k=4) == scan[:4]
+
+
+def test_process_all_fallback_without_tfidf(monkeypatch):
+    monkeypatch.setattr(exam, "TFIDF_AVAILABLE", False)
+    res = exam.process_all(CATALOG_IDS, CATALOG, ["2000", "2002"], [NEW[0], NEW[2]])
+    assert res["2000"]["matches"][0]["catalog_id"] == "1000"
+    assert res["2002"]["matches"][0]["score"] == 1.0
+
+
+def test_catalog_index_without_sklearn_raises(monkeypatch, tmp_path):
+    monkeypatch.setattr(exam, "TFIDF_AVAILABLE", False)
+    index = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    assert index.tfidf is None
+    with pytest.raises(RuntimeError, match="requires scikit-learn"):
+        exam.save_catalog_index(index, tmp_path / "ix")
+    with pytest.raises(RuntimeError, match="requires scikit-learn"):
+        exam.append_to_catalog_index(index, ["1"], ["Телефон Nokia 3310"])
+    assert not (tmp_path / "ix").exists() and len(index.ids) == len(CATALOG)
+
+
+def test_extract_block_keys():
+    assert exam.extract_block_keys(CATALOG[0]) == ("xiaomi", "phone", "8/256")
+    assert exam.extract_block_keys(NEW[0]) == ("xiaomi", None, "8/256")
+    assert exam.extract_block_keys(NEW[3]) == ("xiaomi", "vacuum", None)
+    assert exam.extract_block_keys("Apple iPhone 15 128 ГБ") == ("apple", None, None)
+    assert exam.extract_block_keys("Нечто без ключей") == (None, None, None)
+
+
+def test_catalog_blocks_keep_rows_without_key():
+    blocks = exam.CatalogBlocks(CATALOG)
+    assert blocks.mask((None, None, None)) is None
+    xiaomi = blocks.mask(("xiaomi", None, "8/256"))
+    assert np.flatnonzero(xiaomi).tolist() == [0, 3]  # у робота-пылесоса нет памяти
+    assert not blocks.mask(("nokia", None, None)).any()
+
+
+def test_process_all_blocking_keeps_true_duplicates():
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    plain = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    blocked = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW, blocking=True)
+    for nid in new_ids:
+        assert [m["catalog_id"] for m in blocked[nid]["matches"]][:1] == \
+               [m["catalog_id"] for m in plain[nid]["matches"]][:1]
+
+
+def test_stats_counts_and_exports(tmp_path):
+    import json
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    exam.STATS.reset()
+    res = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    snap = exam.STATS.snapshot()
+    assert {"normalize", "candidate_search", "scoring"} <= set(snap["stages"])
+    assert snap["counters"]["new_items"] == len(NEW)
+    assert snap["counters"]["matches_emitted"] == sum(len(r["matches"]) for r in res.values())
+    assert "normalize_text_cached" in snap["caches"]
+
+    exam.STATS.save(tmp_path / "stats.json")
+    assert json.loads((tmp_path / "stats.json").read_text(encoding="utf-8"))["counters"] == snap["counters"]
+    exam.STATS.save(tmp_path / "stats.prom")
+    prom = (tmp_path / "stats.prom").read_text(encoding="utf-8")
+    assert 'dupfinder_stage_seconds{stage="scoring"}' in prom
+    assert f'dupfinder_events{{name="new_items"}} {len(NEW)}' in prom
+
+
+def test_byte_budget_cache_evicts_by_size():
+    calls = []
+    cache = exam.ByteBudgetCache(lambda s: calls.append(s) or s.upper(), max_bytes=1000)
+    assert cache("abc") == "ABC" and cache("abc") == "ABC"
+    assert calls == ["abc"] and cache.cache_info().hits == 1
+    for i in range(50):
+        cache(f"title {i}")
+    info = cache.cache_info()
+    assert info.bytes <= 1000 and info.evictions > 0
+    assert "abc" not in dict(cache.items())
+    cache("x" * 2000)
+    assert "x" * 2000 not in dict(cache.items())
+
+
+def test_normalize_cache_persists(tmp_path):
+    path = tmp_path / "norm.json"
+    exam.normalize_text_cached.cache_clear()
+    exam.normalize_text_cached(CATALOG[0])
+    assert exam.save_normalize_cache(path) == 1
+    exam.normalize_text_cached.cache_clear()
+    assert exam.load_normalize_cache(path) == 1
+    exam.normalize_text_cached(CATALOG[0])
+    assert exam.normalize_text_cached.cache_info().hits == 1
+
+    exam.normalize_text_cached.cache_clear()
+    exam.BRAND_FIXES["zz"] = "z"
+    try:
+        assert exam.load_normalize_cache(path) == 0
+    finally:
+        del exam.BRAND_FIXES["zz"]
+
+
+def test_tokenized_lexical_scores_match_strings():
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    new_norm = [exam.normalize_text(t) for t in NEW] + ["xiaomi", "неизвестный токен"]
+    cat_tokens = exam.TokenizedTitles(cat_norm)
+    vocab_size = len(cat_tokens.vocab)
+    new_tokens = cat_tokens.encode(new_norm)
+    assert len(cat_tokens.vocab) == vocab_size
+    assert all(len(ids) == len(set(s.split())) for ids, s in zip(new_tokens.sets, new_norm))
+
+    pairs = [(a, b) for a in range(len(new_norm)) for b in range(len(cat_norm))]
+    a_list = [new_norm[a] for a, _ in pairs]
+    b_list = [cat_norm[b] for _, b in pairs]
+    res = exam.batch_lexical_scores_tokenized(a_list, b_list, [new_tokens.sets[a] for a, _ in pairs],
+                                              [cat_tokens.sets[b] for _, b in pairs])
+    assert res == pytest.approx([exam.lexical_score(a, b) for a, b in zip(a_list, b_list)])
+
+
+def test_self_dedup_clusters():
+    titles = CATALOG + NEW + [CATALOG[0]]
+    ids = [str(1000 + i) for i in range(len(titles))]
+    clusters = exam.find_catalog_clusters(exam.build_catalog_index(ids, titles), threshold=0.85)
+    by_member = {m["catalog_id"]: c for c in clusters for m in c["members"]}
+    xiaomi = by_member["1000"]
+    assert {m["catalog_id"] for m in xiaomi["members"]} == {"1000", "1007", "1011"}
+    assert xiaomi["canonical_id"] in {"1000", "1011"}
+    assert {"a": "1000", "b": "1011", "score": 1.0} in xiaomi["pairs"]
+    assert by_member["1002"] is by_member["1009"]
+    assert "1005" not in by_member
+
+
+def test_self_dedup_exact_group_with_conflicting_category():
+    titles = ["Смартфон Xiaomi Pad 6 8/256GB", "Планшет Xiaomi Pad 6 8/256GB", "Планшет Xiaomi Pad 6 8/256GB"]
+    clusters = exam.find_catalog_clusters(exam.build_catalog_index(["1", "2", "3"], titles))
+    assert [[m["catalog_id"] for m in c["members"]] for c in clusters] == [["2", "3"]]
+
+
+def test_union_find_refuses_conflicting_keys():
+    uf = exam.UnionFind(3, keys=[("xiaomi", None, "8/256"), ("xiaomi", "phone", None), ("xiaomi", None, "4/64")])
+    assert uf.union(0, 1)
+    assert not uf.union(1, 2)
+    assert uf.find(0) == uf.find(1) != uf.find(2)
+
+
+def test_import_does_not_load_optional_libraries():
+    import os
+    import subprocess
+    import sys
+    code = "import sys, exam; print(sorted(m for m in ('sklearn', 'scipy', 'rapidfuzz') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(exam.__file__)),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "[]"
+
+
+@needs_tfidf
+def test_small_input_skips_tfidf(monkeypatch):
+    import os
+    import subprocess
+    import sys
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    exam.STATS.reset()
+    fast = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    assert "token_index" in exam.STATS.stages
+    monkeypatch.setattr(exam, "SMALL_INPUT_ROWS", 0)
+    full = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    # оценки tfidf различаются (доля общих токенов вместо косинуса), лучшие совпадения — нет
+    assert [r["matches"][0]["catalog_id"] for r in fast.values()] == \
+        [r["matches"][0]["catalog_id"] for r in full.values()]
+
+    code = ("import sys, exam; exam.process_all(['1', '2'], ['Xiaomi Note 12', 'Huawei P60'], ['3'], ['xiaomi note']); "
+            "print(sorted(m for m in ('sklearn', 'scipy') if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(exam.__file__)),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip().splitlines()[-1] == "[]"
+
+
+@needs_tfidf
+def test_float32_tfidf_topk_matches_float64():
+    cat_norm = [exam.normalize_text_cached(t) for t in CATALOG]
+    new_norm = [exam.normalize_text_cached(t) for t in NEW]
+    _, cat32, new32 = exam.build_tfidf_index(cat_norm, new_norm)
+    _, cat64, new64 = exam.build_tfidf_index(cat_norm, new_norm, dtype="float64")
+    assert cat32.dtype == np.float32 and cat64.dtype == np.float64
+    top32 = exam.batch_candidate_search_tfidf(new32, cat32, 3)
+    top64 = exam.batch_candidate_search_tfidf(new64, cat64, 3)
+    assert [[i for i, _ in row] for row in top32] == [[i for i, _ in row] for row in top64]
+    assert np.allclose([s for row in top32 for _, s in row], [s for row in top64 for _, s in row], atol=1e-6)
+
+
+def test_exact_match_fast_path(monkeypatch):
+    new = NEW + ["  SAMSUNG galaxy s23 черный 8/128GB смартфон "]
+    new_ids = [str(2000 + i) for i in range(len(new))]
+    res = exam.process_all(CATALOG_IDS, CATALOG, new_ids, new)
+    hit = res[new_ids[-1]]["matches"]
+    assert [m["catalog_id"] for m in hit] == ["1005"]
+    assert hit[0]["score"] == 1.0 and hit[0]["score_components"] == {"lexical": 1.0, "tfidf": 1.0}
+
+    monkeypatch.setattr(exam, "EXACT_MATCH_FAST_PATH", False)
+    full = exam.process_all(CATALOG_IDS, CATALOG, new_ids, new)
+    assert [m["catalog_id"] for m in full[new_ids[-1]]["matches"]][:1] == ["1005"]
+    # остальные товары оцениваются так же, как без быстрого пути
+    assert all(res[k] == full[k] for k in new_ids[:-1])
+
+
+def test_exact_match_without_rapidfuzz_keeps_word_order(monkeypatch):
+    monkeypatch.setattr(exam, "RAPIDFUZZ_AVAILABLE", False)
+    exam.lexical_score.cache_clear()
+    new = ["черный 8/128GB S23 Galaxy Samsung", CATALOG[5]]
+    res = exam.process_all(CATALOG_IDS, CATALOG, ["1", "2"], new)
+    monkeypatch.setattr(exam, "EXACT_MATCH_FAST_PATH", False)
+    assert exam.process_all(CATALOG_IDS, CATALOG, ["1", "2"], new) == res
+    assert res["1"]["matches"][0]["score"] < 1.0
+    assert res["2"]["matches"][0]["score"] == 1.0
+    exam.lexical_score.cache_clear()
+
+
+def test_exact_match_respects_blocking_and_specs():
+    catalog = ["Смартфон Xiaomi Pad 6 8/256GB", 'Планшет Lenovo Tab P11 11" 6/128GB']
+    new = ["Планшет Xiaomi Pad 6 8/256GB", "Планшет Lenovo Tab P11 11 дюйм 6/128GB"]
+    ids, new_ids = ["1000", "1001"], ["2000", "2001"]
+    assert exam.normalize_text(new[0]) == exam.normalize_text(catalog[0])
+    assert exam.process_all(ids, catalog, new_ids, new)["2000"]["matches"][0]["score"] == 1.0
+
+    exam.STATS.reset()
+    blocked = exam.process_all(ids, catalog, new_ids, new, blocking=True)
+    assert all(m["catalog_id"] != "1000" for m in blocked["2000"]["matches"])
+    assert exam.STATS.counters["exact_hits"] == 1
+    assert [m["catalog_id"] for m in blocked["2001"]["matches"]] == ["1001"]
+
+    hits = exam.filter_exact_hits({0: [0]}, ['Планшет Lenovo Tab P11 10.1" 6/128GB'], catalog[1:], blocking=False)
+    assert hits == {}
+
+
+@needs_tfidf
+def test_exact_match_skips_deleted_rows():
+    index = exam.build_catalog_index(CATALOG_IDS, CATALOG)
+    exam.delete_from_catalog_index(index, ["1005"])
+    res = exam.process_all([], [], ["1"], [CATALOG[5]], index=index)
+    assert all(m["catalog_id"] != "1005" for m in res["1"]["matches"])
+
+
+def test_prune_candidates_keeps_every_match(monkeypatch):
+    new_ids = [str(2000 + i) for i in range(len(NEW))]
+    exam.STATS.reset()
+    pruned = exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW)
+    assert exam.STATS.counters["candidates_pruned"] > 0
+    monkeypatch.setattr(exam, "PRUNE_CANDIDATES", False)
+    assert exam.process_all(CATALOG_IDS, CATALOG, new_ids, NEW) == pruned
+
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    new_norm = [exam.normalize_text(t) for t in NEW]
+    cat_tokens = exam.TokenizedTitles(cat_norm)
+    new_tokens = cat_tokens.encode(new_norm)
+    for i, a in enumerate(new_norm):
+        for j, b in enumerate(cat_norm):
+            bound = exam.combined_upper_bound(0.3, new_tokens.sets[i], cat_tokens.sets[j],
+                                              new_tokens.lengths[i], cat_tokens.lengths[j])
+            assert bound >= exam.compute_combined_score(a, b, 0.3)[2] - exam.PRUNE_MARGIN
+
+
+def test_spec_filter_rejects_conflicting_candidates(monkeypatch):
+    assert exam.extract_specs('Планшет Irbis TX97 10.1" 4/64GB') == (4, 64, 10.1, None)
+    assert exam.extract_specs("iPhone 15 6,1 дюйма Синий") == (None, None, 6.1, "blue")
+
+    catalog = ["Смартфон Xiaomi Redmi Note 12 Pro 8/256GB синий",
+               "Смартфон Xiaomi Redmi Note 12 Pro 8/128GB синий",
+               'Планшет Lenovo Tab P11 11" 6/128GB серый',
+               'Планшет Lenovo Tab P11 10.1" 6/128GB серый']
+    new = ["Xiaomi Redmi Note 12 Pro 8/256 синий", 'Планшет Lenovo Tab P11 11" 6/128GB', "Xiaomi Redmi Note 12 Pro"]
+    ids = [str(1000 + i) for i in range(len(catalog))]
+    new_ids = [str(2000 + i) for i in range(len(new))]
+
+    exam.STATS.reset()
+    res = exam.process_all(ids, catalog, new_ids, new)
+    assert exam.STATS.counters["candidates_rejected_specs"] > 0
+    assert {m["catalog_id"] for m in res["2000"]["matches"]} == {"1000"}
+    assert {m["catalog_id"] for m in res["2001"]["matches"]} == {"1002"}
+    # без характеристик в названии кандидат не отклоняется
+    assert {"1000", "1001"} <= {m["catalog_id"] for m in res["2002"]["matches"]}
+
+    monkeypatch.setattr(exam, "SPEC_FILTER", False)
+    assert "1001" in {m["catalog_id"] for m in exam.process_all(ids, catalog, new_ids, new)["2000"]["matches"]}
+
+
+def test_candidate_rows_only_tokens_and_specs():
+    cat_norm = [exam.normalize_text(t) for t in CATALOG]
+    full_tokens = exam.TokenizedTitles(cat_norm)
+    part_tokens = exam.TokenizedTitles(cat_norm, rows=[1, 5])
+    assert part_tokens.sets[0] is None and len(part_tokens) == len(CATALOG)
+    assert part_tokens.lengths[5] == full_tokens.lengths[5]
+    assert len(part_tokens.sets[5]) == len(full_tokens.sets[5])
+
+    full_specs = exam.CatalogSpecs(CATALOG)
+    part_specs = exam.CatalogSpecs(CATALOG, rows=[2])
+    assert part_specs.inches[2] == full_specs.inches[2] and part_specs.rom[0] == -1
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient
+
+import exam
+import server
+
+from .samples import CATALOG, CATALOG_IDS, NEW
+
+
+@pytest.fixture(params=[0, 2], ids=["single", "sharded"])
+def client(tmp_path, request):
+    if not exam.tfidf_available():
+        pytest.skip("sklearn is not installed")
+    exam.save_catalog_index(exam.build_catalog_index(CATALOG_IDS, CATALOG), tmp_path / "ix")
+    with TestClient(server.create_app(tmp_path / "ix", shards=request.param)) as c:
+        yield c
+
+
+def test_match_single_and_batch_agree(client):
+    single = [client.post("/match", json={"title": t, "id": str(n)}).json() for n, t in enumerate(NEW)]
+    batch = client.post("/match/batch", json={"items": [{"title": t, "id": str(n)} for n, t in enumerate(NEW)]})
+    assert batch.status_code == 200
+    assert batch.json()["results"] == single
+    assert single[0]["id"] == "0"
+    assert single[0]["matches"][0]["catalog_id"] == "1000"
+
+
+def test_health_and_stats(client):
+    assert client.get("/health").json() == {"status": "ok", "catalog_size": len(CATALOG)}
+    assert "new_items" not in client.get("/stats").json()["counters"]   # прогрев не считается
+    client.post("/match", json={"title": NEW[0]})
+    counters = client.get("/stats").json()["counters"]
+    assert counters["microbatches"] >= 1 and counters["new_items"] == 1